@@ -0,0 +1,212 @@
+import os
+import abc
+import hmac
+import sqlite3
+import hashlib
+import binascii
+from collections import OrderedDict
+from .parser import IntelConfigParser
+
+hashprefix = 'pbkdf2_sha256'
+
+def hashpassword(password, iterations = 100000, salt = None):
+    '''Return a salted PBKDF2 hash of the password, suitable for storing'''
+    if salt is None:
+        salt = binascii.hexlify(os.urandom(8)).decode('ascii')
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt.encode('ascii'), iterations)
+    return '%s$%i$%s$%s' % (hashprefix, iterations, salt, binascii.hexlify(digest).decode('ascii'))
+
+def ishashed(stored):
+    '''Return True if the stored password is a hash and not plaintext'''
+    return stored.startswith(hashprefix + '$')
+
+def checkpassword(password, stored):
+    '''Check the password against a stored hash (or a legacy plaintext password)'''
+    if not ishashed(stored):
+        return hmac.compare_digest(password.encode('utf-8'), stored.encode('utf-8'))
+    prefix, iterations, salt, digest = stored.split('$', 3)
+    return hmac.compare_digest(hashpassword(password, int(iterations), salt), stored)
+
+def verifypassword(password, stored, iterations = 100000):
+    '''Check the password, returning whether it is valid and a new hash for it
+
+    The new hash is only given if the password was valid but stored as
+    plaintext, so the account can be upgraded.  This can be slow, so the hub
+    runs it in a worker thread.
+    '''
+    valid = checkpassword(password, stored)
+    if valid and stored and not ishashed(stored):
+        return valid, hashpassword(password, iterations)
+    return valid, None
+
+class AccountStore(abc.ABC):
+    '''Base class for account storage
+
+    Stores behave like a read only dictionary of nick -> account, where each
+    account is a dictionary with name, password, op, and args keys, so the hub
+    can use them the same way it used the old accounts dictionary.  Accounts
+    are fetched from the backend as needed, and the most recently used ones
+    (including nicks that don't have accounts) are kept in an LRU cache.
+
+    Subclasses need to implement fetch, store, delete, and names, and can't
+    be created until they do.
+    '''
+    def __init__(self, cachesize = 1000):
+        self.cachesize = cachesize
+        self.cache = OrderedDict()
+
+    def __contains__(self, nick):
+        return self.get(nick) is not None
+
+    def __getitem__(self, nick):
+        account = self.get(nick)
+        if account is None:
+            raise KeyError(nick)
+        return account
+
+    def __iter__(self):
+        return iter(self.names())
+
+    def __len__(self):
+        return len(self.names())
+
+    @abc.abstractmethod
+    def delete(self, nick):
+        '''Remove the account from the backend'''
+
+    @abc.abstractmethod
+    def fetch(self, nick):
+        '''Return the account for the nick from the backend, or None'''
+
+    def get(self, nick, default = None):
+        cache = self.cache
+        if nick in cache:
+            cache.move_to_end(nick)
+            account = cache[nick]
+        else:
+            account = self.fetch(nick)
+            cache[nick] = account
+            if len(cache) > self.cachesize:
+                cache.popitem(last = False)
+        if account is None:
+            return default
+        return account
+
+    def keys(self):
+        return self.names()
+
+    @abc.abstractmethod
+    def names(self):
+        '''Return a list of all account names'''
+
+    def removeaccount(self, nick):
+        '''Remove the account for nick'''
+        self.cache.pop(nick, None)
+        self.delete(nick)
+
+    def setaccount(self, nick, password, op = False, args = ''):
+        '''Create or replace the account for nick
+
+        password should already be hashed (see hashpassword), unless it is
+        blank, which lets the account log in without a password.
+        '''
+        account = {'name':nick, 'password':password, 'op':bool(op), 'args':args}
+        self.store(account)
+        self.cache.pop(nick, None)
+
+    @abc.abstractmethod
+    def store(self, account):
+        '''Write the account to the backend'''
+
+class INIAccountStore(AccountStore):
+    '''Accounts stored in the dchub-accounts section of an INI file
+
+    The entire file is read into memory, with lines in the format:
+
+        nick = password|opflag|extradata
+
+    Changes are made to the parser, and written to disk with hub.writefile.
+    '''
+    truebools = 'yt1'
+
+    def __init__(self, filename, cachesize = 1000):
+        AccountStore.__init__(self, cachesize)
+        self.filename = filename
+        self.accounts = {}
+        self.parser = IntelConfigParser()
+        self.parser.read(filename)
+        if self.parser.has_section('dchub-accounts'):
+            for key, value in self.parser.items('dchub-accounts'):
+                password, op, args = value.split('|', 2)
+                op = bool(op and op.lower() in self.truebools)
+                self.accounts[key] = {'name':key, 'password': password, 'op':op, 'args':args}
+
+    def delete(self, nick):
+        self.accounts.pop(nick, None)
+        if self.parser.has_section('dchub-accounts'):
+            self.parser.remove_option('dchub-accounts', nick)
+
+    def fetch(self, nick):
+        return self.accounts.get(nick)
+
+    def get(self, nick, default = None):
+        # Everything is already in memory, so there is no need for the cache
+        return self.accounts.get(nick, default)
+
+    def names(self):
+        return list(self.accounts.keys())
+
+    def store(self, account):
+        self.accounts[account['name']] = account
+        if not self.parser.has_section('dchub-accounts'):
+            self.parser.add_section('dchub-accounts')
+        self.parser.set('dchub-accounts', account['name'], '%s|%i|%s' % (account['password'], account['op'], account['args']))
+
+class SQLiteAccountStore(AccountStore):
+    '''Accounts stored in an SQLite database, looked up by nick as needed
+
+    The nick is the primary key, so lookups use the table's index instead of
+    loading every account into memory.  The table is created if the database
+    doesn't have one.
+    '''
+    def __init__(self, filename, cachesize = 1000):
+        AccountStore.__init__(self, cachesize)
+        self.filename = filename
+        self.db = sqlite3.connect(filename)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS accounts (name TEXT PRIMARY KEY,
+            password TEXT NOT NULL, op INTEGER NOT NULL DEFAULT 0, args TEXT NOT NULL DEFAULT '')''')
+        self.db.commit()
+
+    def __len__(self):
+        # Counted by the database, so the names don't have to be fetched
+        return self.db.execute('SELECT COUNT(*) FROM accounts').fetchone()[0]
+
+    def close(self):
+        self.db.close()
+
+    def delete(self, nick):
+        self.db.execute('DELETE FROM accounts WHERE name = ?', (nick, ))
+        self.db.commit()
+
+    def fetch(self, nick):
+        row = self.db.execute('SELECT name, password, op, args FROM accounts WHERE name = ?', (nick, )).fetchone()
+        if row is None:
+            return None
+        return {'name':row[0], 'password':row[1], 'op':bool(row[2]), 'args':row[3]}
+
+    def importaccounts(self, store):
+        '''Copy all the accounts from another store into this one'''
+        for nick in store.names():
+            account = store[nick]
+            self.db.execute('INSERT OR REPLACE INTO accounts VALUES (?, ?, ?, ?)',
+              (nick, account['password'], int(account['op']), account['args']))
+        self.db.commit()
+        self.cache.clear()
+
+    def names(self):
+        return [row[0] for row in self.db.execute('SELECT name FROM accounts')]
+
+    def store(self, account):
+        self.db.execute('INSERT OR REPLACE INTO accounts VALUES (?, ?, ?, ?)',
+          (account['name'], account['password'], int(account['op']), account['args']))
+        self.db.commit()
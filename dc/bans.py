@@ -0,0 +1,281 @@
+import os
+import time
+import heapq
+import ipaddress
+
+class BanList(object):
+    '''Banned nicks, IPs, IP prefixes and networks, each with an expiry time
+
+    Entries use the same format as BanBot:
+
+        %SomeNick       bans the nick SomeNick
+        12.34.56.       bans every IP starting with 12.34.56.
+        12.34.56.78     bans that IP (and any IP it is a textual prefix of)
+        10.1.0.0/16     bans the network (IPv4 or IPv6 CIDR notation)
+
+    Nick bans are kept in a dictionary, textual prefixes in a character trie,
+    and networks in a binary trie per address family, so checking an IP takes
+    time proportional to the length of the address, not the number of bans.
+    Expiry times are kept in a heap, so purge only touches expired entries.
+
+    The list behaves like a dictionary of entry -> banned until time, so code
+    written for the old hub.bans dictionary keeps working.  Bots that replace
+    hub.bans with a dictionary have its entries loaded instead (see
+    DCHub.setbans).
+
+    Bans are persisted in an append-only journal, one "entry banneduntil" line
+    per change (the same format as the old bans file).  A ban time in the past
+    removes the entry when the journal is replayed.  Once the journal grows
+    to compactratio times the number of bans, it is rewritten with just the
+    current bans.
+    '''
+    compactratio = 4
+    mincompactsize = 1000
+
+    def __init__(self, filename = None):
+        self.filename = filename
+        self.entries = {}
+        self.expiries = []
+        self.prefixes = {}
+        self.networks = {4: [None, None, None], 6: [None, None, None]}
+        self.journalsize = 0
+
+    def __contains__(self, entry):
+        return entry in self.entries
+
+    def __delitem__(self, entry):
+        self.remove(entry)
+
+    def __getitem__(self, entry):
+        return self.entries[entry]
+
+    def __iter__(self):
+        return iter(list(self.entries))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __setitem__(self, entry, banuntil):
+        self.add(entry, banuntil)
+
+    def add(self, entry, banuntil, write = True):
+        '''Ban entry until the given time, replacing any existing ban
+
+        Raises ValueError if the entry isn't a nick, IP prefix, or network.
+        '''
+        banuntil = int(banuntil)
+        if entry in self.entries:
+            self.entries[entry] = banuntil
+        else:
+            if entry.startswith('%'):
+                if len(entry) < 2:
+                    raise ValueError('empty nick')
+            elif '/' in entry:
+                network = ipaddress.ip_network(entry, strict = False)
+                self.settrienode(network, entry)
+            else:
+                self.checkprefix(entry)
+                node = self.prefixes
+                for char in entry:
+                    node = node.setdefault(char, {})
+                node[None] = entry
+            self.entries[entry] = banuntil
+        heapq.heappush(self.expiries, (banuntil, entry))
+        if write:
+            self.writejournal(entry, banuntil)
+
+    def checkprefix(self, entry):
+        '''Raise ValueError if entry isn't the beginning of an IPv4 or IPv6 address'''
+        if not entry:
+            raise ValueError('empty entry')
+        if ':' in entry:
+            if entry.strip('0123456789abcdefABCDEF:.'):
+                raise ValueError('bad IP format')
+            return
+        parts = entry.split('.')
+        if len(parts) > 4:
+            raise ValueError('bad IP format')
+        for part in parts:
+            if not part:
+                continue
+            if not (0 <= int(part) < 256):
+                raise ValueError('bad IP format')
+
+    def clear(self):
+        '''Remove all bans'''
+        self.entries.clear()
+        del self.expiries[:]
+        self.prefixes.clear()
+        self.networks = {4: [None, None, None], 6: [None, None, None]}
+        self.compact()
+
+    def compact(self):
+        '''Rewrite the journal so it only contains the current bans'''
+        if not self.filename:
+            return
+        fil = open('%s.new' % self.filename, 'w')
+        try:
+            for entry, banuntil in self.entries.items():
+                fil.write('%s %i\n' % (entry, banuntil))
+        finally:
+            fil.close()
+        os.rename('%s.new' % self.filename, self.filename)
+        self.journalsize = len(self.entries)
+
+    def findip(self, ip, curtime = None):
+        '''Return the ban entry matching the IP, or None if it isn't banned'''
+        if curtime is None:
+            curtime = time.time()
+        entries = self.entries
+        node = self.prefixes
+        for char in ip:
+            node = node.get(char)
+            if node is None:
+                break
+            entry = node.get(None)
+            if entry is not None and entries[entry] > curtime:
+                return entry
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return None
+        if address.version == 6 and address.ipv4_mapped is not None:
+            address = address.ipv4_mapped
+        node = self.networks[address.version]
+        bits = address.max_prefixlen
+        value = int(address)
+        while node is not None:
+            entry = node[2]
+            if entry is not None and entries[entry] > curtime:
+                return entry
+            bits -= 1
+            if bits < 0:
+                break
+            node = node[(value >> bits) & 1]
+        return None
+
+    def get(self, entry, default = None):
+        return self.entries.get(entry, default)
+
+    def isnickbanned(self, nick, curtime = None):
+        '''Return True if the nick is currently banned'''
+        if curtime is None:
+            curtime = time.time()
+        return self.entries.get('%' + nick, 0) > curtime
+
+    def items(self):
+        return list(self.entries.items())
+
+    def keys(self):
+        return list(self.entries.keys())
+
+    def load(self):
+        '''Replay the journal from disk, then compact it'''
+        if not self.filename or not os.path.isfile(self.filename):
+            return
+        curtime = time.time()
+        fil = open(self.filename, 'r')
+        try:
+            lines = fil.readlines()
+        finally:
+            fil.close()
+        bans = {}
+        for line in lines:
+            if not line.strip() or line[0] == '#':
+                continue
+            entry, banuntil = line.split(None, 1)
+            bans[entry] = int(banuntil)
+        for entry, banuntil in bans.items():
+            if banuntil > curtime:
+                self.add(entry, banuntil, write = False)
+        self.compact()
+
+    def nextexpiry(self):
+        '''Return the time the next ban expires, or None if there are no bans'''
+        while self.expiries:
+            banuntil, entry = self.expiries[0]
+            if self.entries.get(entry) == banuntil:
+                return banuntil
+            # Ban was removed or its time changed since it was added to the heap
+            heapq.heappop(self.expiries)
+        return None
+
+    def purge(self, curtime = None):
+        '''Remove all expired bans, returning the removed entries'''
+        if curtime is None:
+            curtime = time.time()
+        expired = []
+        expiries = self.expiries
+        while expiries and expiries[0][0] <= curtime:
+            banuntil, entry = heapq.heappop(expiries)
+            if self.entries.get(entry) == banuntil:
+                self.remove(entry, write = False)
+                expired.append(entry)
+        if expired:
+            self.writejournal()
+        return expired
+
+    def remove(self, entry, write = True):
+        '''Remove the ban for the entry'''
+        if entry not in self.entries:
+            return
+        del self.entries[entry]
+        if entry.startswith('%'):
+            pass
+        elif '/' in entry:
+            self.settrienode(ipaddress.ip_network(entry, strict = False), None)
+        else:
+            path = [self.prefixes]
+            for char in entry:
+                path.append(path[-1][char])
+            del path[-1][None]
+            # Prune the branch back to the last node still in use
+            for i in range(len(entry) - 1, -1, -1):
+                if path[i + 1]:
+                    break
+                del path[i][entry[i]]
+        if write:
+            self.writejournal(entry, 0)
+
+    def settrienode(self, network, entry):
+        '''Set the entry for the network in the binary trie for its family'''
+        node = self.networks[network.version]
+        value = int(network.network_address)
+        bits = network.max_prefixlen
+        path = []
+        for i in range(network.prefixlen):
+            bit = (value >> (bits - 1 - i)) & 1
+            if node[bit] is None:
+                if entry is None:
+                    return
+                node[bit] = [None, None, None]
+            path.append((node, bit))
+            node = node[bit]
+        node[2] = entry
+        if entry is None:
+            # Prune nodes that no longer lead to any network
+            for parent, bit in reversed(path):
+                child = parent[bit]
+                if child[0] is not None or child[1] is not None or child[2] is not None:
+                    break
+                parent[bit] = None
+
+    def values(self):
+        return list(self.entries.values())
+
+    def writejournal(self, entry = None, banuntil = 0):
+        '''Append a change to the journal, compacting it if it is too large
+
+        If entry is None, just checks whether the journal needs compacting.
+        '''
+        if not self.filename:
+            return
+        if entry is not None:
+            fil = open(self.filename, 'a')
+            try:
+                fil.write('%s %i\n' % (entry, banuntil))
+            finally:
+                fil.close()
+            self.journalsize += 1
+        if self.journalsize > max(self.mincompactsize, self.compactratio * len(self.entries)):
+            self.compact()
@@ -1,3 +1,7 @@
+from .bothost import serializeargs
+from .user import DCHubUser
+
+myinfoformat = '$MyINFO $ALL %s %s%s$ $%s%s$%s$%i$|'
 
 class DCHubBot(DCHubUser):
     '''Bot that runs in the same process as the hub
@@ -37,3 +41,42 @@ class DCHubBot(DCHubUser):
     def start(self):
         '''Initialize hub environment for bot'''
         pass
+
+class DCHubRemoteBot(DCHubUser):
+    '''Hub's stand-in for a bot running in a bot host process
+
+    The hub makes one for each bot a bot host registers (see
+    DCHub.gotbotaction), so the bot can appear in the hub like any other
+    bot.  Private messages to it and the hub functions it hooks are passed
+    on to its host as events, without waiting for the bot.
+    '''
+    isDCHubBot = True
+    isRemoteBot = True
+    def __init__(self, hub, host, nick, op = False, visible = True, description = '', hooks = ()):
+        DCHubUser.__init__(self)
+        self.hub = hub
+        self.host = host
+        self.nick = nick
+        self.ignoremessages = True
+        self.idstring = 'DCHubRemoteBot/%s' % nick
+        self.description = description
+        self.myinfo = myinfoformat % (self.nick, self.description, self.tag, self.speed, chr(self.speedclass), self.email, self.sharesize)
+        self.visible = visible
+        self.op = op
+        # Names of hub functions the bot is told about after they run
+        self.hooks = list(hooks)
+        hub.setuplimits(self)
+
+    def hook(self, functionname):
+        '''Return an execafter function that gives the host a hook event'''
+        def hook(returnobj, *args, **kwargs):
+            self.hub.givebotevent({'event': 'hook', 'bot': self.nick,
+              'function': functionname, 'args': serializeargs(args)}, self.host)
+            return returnobj
+        hook.__name__ = 'remote_%s' % functionname
+        return hook
+
+    def processcommand(self, user, command):
+        '''Pass a private message to the bot on to its host'''
+        self.hub.givebotevent({'event': 'privatemessage', 'bot': self.nick,
+          'nick': user.nick, 'message': command}, self.host)
@@ -0,0 +1,228 @@
+import importlib
+import json
+import os
+import socket
+import struct
+import sys
+import traceback
+
+def encodeframe(message):
+    '''Return the message (anything JSON can encode) as a frame'''
+    data = json.dumps(message).encode('utf-8')
+    return struct.pack('!I', len(data)) + data
+
+def serializeargs(args):
+    '''Return hub function arguments in a form JSON can encode
+
+    Users are given as their nicks, and other objects as their repr.
+    '''
+    serialized = []
+    for arg in args:
+        if arg is None or isinstance(arg, (str, int, float, bool)):
+            serialized.append(arg)
+        elif isinstance(getattr(arg, 'nick', None), str):
+            serialized.append(arg.nick)
+        else:
+            serialized.append(repr(arg))
+    return serialized
+
+class FrameReader(object):
+    '''Splits data received from a stream socket into messages'''
+    def __init__(self, maxframesize = 1048576):
+        self.maxframesize = maxframesize
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        '''Add data to the buffer, returning the messages it completes
+
+        Raises ValueError if a frame is larger than maxframesize.
+        '''
+        self.buffer += data
+        messages = []
+        while len(self.buffer) >= 4:
+            size = struct.unpack('!I', self.buffer[:4])[0]
+            if size > self.maxframesize:
+                raise ValueError('frame of %i bytes is too large' % size)
+            if len(self.buffer) < size + 4:
+                break
+            messages.append(json.loads(self.buffer[4:size + 4].decode('utf-8')))
+            del self.buffer[:size + 4]
+        return messages
+
+class BotHostConnection(object):
+    '''Hub's end of the connection to a bot host process'''
+    def __init__(self, index, process, sock):
+        self.index = index
+        self.process = process
+        self.socket = sock
+        self.socketid = sock.fileno()
+        self.reader = FrameReader()
+        self.outgoing = bytearray()
+        # Nicks of the bots the host has registered
+        self.bots = set()
+        self.idstring = 'BotHost/%i (pid %i)' % (index, process.pid)
+
+    def close(self):
+        '''Close the connection and kill the process'''
+        self.socket.close()
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+
+class RemoteBot(object):
+    '''Bot that runs in a bot host process
+
+    Subclasses in the remote bots directory are started by the bot hosts,
+    unless their active attribute is False.  Override the got* methods to
+    handle events, and use the other methods to act in the hub.  Add names
+    of hub functions to hooks to have gothook called after they run (the
+    hub doesn't wait for the bot, so hooks can't change what the hub does;
+    use a DCHubBot in the hub's bots directory for that).
+    '''
+    active = True
+    isRemoteBot = True
+    def __init__(self, host, nick = 'RemoteBot'):
+        self.host = host
+        self.nick = nick
+        self.description = ''
+        # If invisible, doesn't show up in user list
+        self.visible = True
+        # If not an op, show up as regular user instead
+        self.op = False
+        self.hooks = []
+
+    def ban(self, entry, seconds):
+        '''Ban a nick (prefixed with %), IP prefix, or network for seconds'''
+        self.host.send({'action': 'ban', 'bot': self.nick, 'entry': entry, 'seconds': seconds})
+
+    def gotchat(self, nick, message):
+        '''Handle a chat message from a user'''
+        pass
+
+    def gothook(self, functionname, args):
+        '''Handle a hooked hub function being run with args'''
+        pass
+
+    def gotjoin(self, nick, ip, op):
+        '''Handle a user logging in'''
+        pass
+
+    def gotprivatemessage(self, nick, message):
+        '''Handle a private message to the bot'''
+        pass
+
+    def gotquit(self, nick):
+        '''Handle a user leaving'''
+        pass
+
+    def kick(self, nick):
+        '''Disconnect a user'''
+        self.host.send({'action': 'kick', 'bot': self.nick, 'nick': nick})
+
+    def sendchat(self, message):
+        '''Send a chat message to the hub from the bot'''
+        self.host.send({'action': 'chat', 'bot': self.nick, 'message': message})
+
+    def sendprivatemessage(self, nick, message):
+        '''Send a private message to a user from the bot'''
+        self.host.send({'action': 'privatemessage', 'bot': self.nick, 'nick': nick, 'message': message})
+
+    def start(self):
+        '''Initialize the bot once the host has connected to the hub'''
+        pass
+
+class BotHost(object):
+    '''Process that runs bots outside of the hub
+
+    The hub starts bothosts of these processes (see DCHub.startbothost),
+    each connected to the hub by a Unix socket.  Messages in both
+    directions are frames holding a JSON object, preceded by its length.
+    The hub sends events (chat, private messages to the host's bots, joins,
+    quits, and hub functions the bots hook), and the host sends actions for
+    its bots (register, chat, privatemessage, kick, ban).
+
+    Bots are RemoteBot subclasses in the remote bots directory, and with
+    more than one host, the bot files are divided between the hosts.  A bot
+    that is slow, busy, or crashes only holds up its own host, which the
+    hub restarts if it exits or stops reading events.  This module only
+    uses the standard library, so the host runs it as a script without
+    importing the rest of the hub.
+    '''
+    def __init__(self, sock, botsdir, index = 0, count = 1):
+        self.socket = sock
+        self.botsdir = botsdir
+        self.index = index
+        self.count = count
+        self.bots = {}
+
+    def dispatch(self, event):
+        '''Pass an event from the hub on to the bots it is for'''
+        kind = event.get('event')
+        if kind in ('privatemessage', 'hook'):
+            bots = [self.bots[event['bot']]] if event.get('bot') in self.bots else []
+        else:
+            bots = list(self.bots.values())
+        for bot in bots:
+            try:
+                if kind == 'chat':
+                    bot.gotchat(event['nick'], event['message'])
+                elif kind == 'privatemessage':
+                    bot.gotprivatemessage(event['nick'], event['message'])
+                elif kind == 'join':
+                    bot.gotjoin(event['nick'], event['ip'], event['op'])
+                elif kind == 'quit':
+                    bot.gotquit(event['nick'])
+                elif kind == 'hook':
+                    bot.gothook(event['function'], event['args'])
+            except Exception:
+                self.logexception('Error handling %s event in bot %s' % (kind, bot.nick))
+
+    def loadbots(self):
+        '''Load and register this host's share of the bots in botsdir'''
+        botfiles = sorted([filename for filename in os.listdir(self.botsdir) if filename.endswith('.py')])
+        sys.path.insert(0, self.botsdir)
+        for botfile in botfiles[self.index::self.count]:
+            try:
+                mod = importlib.import_module(botfile[:-3])
+                for item in dir(mod):
+                    item = getattr(mod, item)
+                    if isinstance(item, type) and item is not RemoteBot and getattr(item, 'isRemoteBot', False) and item.active:
+                        bot = item(self)
+                        bot.start()
+                        self.bots[bot.nick] = bot
+                        self.send({'action': 'register', 'bot': bot.nick, 'op': bot.op,
+                          'visible': bot.visible, 'description': bot.description,
+                          'hooks': list(bot.hooks)})
+            except Exception:
+                self.logexception('Error loading bot: %s' % botfile)
+
+    def logexception(self, message):
+        '''Write the message and the current exception to standard error'''
+        sys.stderr.write('%s: %s\n' % (message, traceback.format_exc()))
+        sys.stderr.flush()
+
+    def run(self):
+        '''Load the bots and handle events until the hub closes the connection'''
+        self.loadbots()
+        reader = FrameReader()
+        while True:
+            data = self.socket.recv(65536)
+            if not data:
+                return
+            for event in reader.feed(data):
+                self.dispatch(event)
+
+    def send(self, message):
+        '''Send a message to the hub'''
+        self.socket.sendall(encodeframe(message))
+
+def main(args):
+    '''Run a bot host given its socket's file descriptor, the bots directory,
+    its index, and the number of hosts'''
+    fd, botsdir, index, count = int(args[0]), args[1], int(args[2]), int(args[3])
+    # The module bots import is this one, not a second copy
+    sys.modules.setdefault('bothost', sys.modules[__name__])
+    BotHost(socket.socket(fileno = fd), botsdir, index, count).run()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,8 +1,20 @@
 from .user import DCHubUser
+from .outgoing import OutgoingQueue, messageclass, BULK
 import time
 
+# Commands clients can use when they connect, shared by all new clients
+connectcommands = frozenset('Key Supports ValidateNick'.split())
+
 class DCHubClient(DCHubUser):
-    '''Client connecting to the hub'''
+    '''Client connecting to the hub
+
+    Has a __dict__ slot so hub subclasses can still give clients extra
+    attributes; the dictionary is only created for clients that use it.
+    '''
+    __slots__ = ('socket', 'socketid', 'account', 'port', 'key', 'loggedin',
+        'op', 'idstring', 'validcommands', 'recentmessages', 'searchtimes',
+        'myinfotimes', 'connecttimes', 'incomingconnecttimes', 'recentconnects',
+        'commandtimes', 'incoming', 'outgoing', 'ready', '__dict__')
 
     def __init__(self, struct):
         sock, (ip, port) = struct
@@ -18,13 +30,23 @@ class DCHubClient(DCHubUser):
         self.idstring = '%s:%s/' % (self.ip, self.port)
         myinfoformat = '$MyINFO $ALL %s %s%s$ $%s%s$%s$%i$|'
         self.myinfo = myinfoformat % (self.nick, self.description, self.tag, self.speed, chr(self.speedclass), self.email, self.sharesize)
-        self.validcommands = set('Key Supports ValidateNick'.split())
-        # Necessary for spam/flood prevention
-        self.recentmessages, self.searchtimes, self.myinfotimes = [], [], []
+        # Commands the client may use, a frozenset shared with other clients
+        # in the same state (see DCHub.interncommands)
+        self.validcommands = connectcommands
+        # Necessary for spam/flood prevention.  These are replaced with lists
+        # the first time they are used, so they start as the empty tuple
+        self.recentmessages = self.searchtimes = self.myinfotimes = ()
+        self.connecttimes = self.incomingconnecttimes = ()
+        # ConnectToMe/RevConnectToMe requests recently sent, and when (a
+        # dictionary once the client has sent any)
+        self.recentconnects = ()
         self.commandtimes = []
-        # Incoming and outgoing buffers for client
+        # Incoming and outgoing buffers for client.  Outgoing data is kept
+        # encoded, in priority classes (see OutgoingQueue)
         self.incoming = ['']
-        self.outgoing = ''
+        self.outgoing = OutgoingQueue()
+        # In the hub's ready queue, or parked (see DCHub.queueuser)
+        self.ready = False
 
     def close(self):
         '''Close related socket connection'''
@@ -33,5 +55,11 @@ class DCHubClient(DCHubUser):
     def sendmessage(self, message):
         '''Place a message in the outgoing message buffer for the user'''
         if not self.ignoremessages:
-            self.outgoing += message
+            self.outgoing.append(message.encode('utf-8'), messageclass(message))
+            self.lastcommandtime = time.time()
+
+    def sendraw(self, data, cls = BULK):
+        '''Place already encoded data (bytes) in the outgoing message buffer'''
+        if not self.ignoremessages:
+            self.outgoing.append(data, cls, True)
             self.lastcommandtime = time.time()
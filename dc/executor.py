@@ -0,0 +1,172 @@
+import time
+import queue
+import socket
+import threading
+from collections import deque
+
+class Task(object):
+    '''Function to run in a worker thread, and its outcome
+
+    When the task is done, result is the return value of the function, or
+    error is the exception it raised (a TimeoutError if it didn't finish in
+    time, in which case timedout is True).
+    '''
+    def __init__(self, function, args, kwargs, callback, owner, deadline):
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.callback = callback
+        self.owner = owner
+        self.deadline = deadline
+        self.result = None
+        self.error = None
+        self.started = False
+        self.timedout = False
+
+    def __repr__(self):
+        return '<Task %s%r owner=%s>' % (getattr(self.function, '__name__', self.function), self.args, self.owner)
+
+class TaskExecutor(object):
+    '''Thread pool that runs blocking functions for the hub
+
+    Tasks are run by up to numthreads worker threads, with at most
+    maxperowner tasks for the same owner (usually a bot's nick) running at
+    once, so one slow bot can't occupy every thread.  Tasks without an owner
+    are only limited by the number of threads.  At most maxqueued tasks
+    can be waiting to run.
+
+    Finished tasks are collected and the worker writes a byte to a socket
+    pair, so the hub's select call wakes up and the hub can run the
+    callbacks in its own thread (see completed).
+    '''
+    def __init__(self, numthreads = 4, maxqueued = 1000, maxperowner = 2):
+        self.numthreads = numthreads
+        self.maxqueued = maxqueued
+        self.maxperowner = maxperowner
+        self.lock = threading.Lock()
+        self.tasks = queue.Queue()
+        self.threads = []
+        # Tasks that haven't completed yet, tasks waiting for a free slot for
+        # their owner, and number of running or queued tasks per owner
+        self.pending = set()
+        self.waiting, self.running = {}, {}
+        self.numqueued = 0
+        self.done = deque()
+        # Created with the first task, so idle executors don't use sockets
+        self.wakeupreader = self.wakeupwriter = None
+        self.wakeupfd = None
+
+    def checktimeouts(self, curtime = None):
+        '''Mark tasks that have passed their deadline as done with a TimeoutError
+
+        The threads running them can't be stopped, so their results are
+        discarded when they finish.
+        '''
+        if curtime is None:
+            curtime = time.time()
+        with self.lock:
+            for task in [task for task in self.pending if task.deadline < curtime]:
+                self.pending.discard(task)
+                task.timedout = True
+                task.error = TimeoutError('task did not finish within its time limit')
+                if not task.started:
+                    # If the task is already in the thread queue instead of
+                    # waiting for its owner, the worker skips it
+                    self.numqueued -= 1
+                    waiting = self.waiting.get(task.owner)
+                    if waiting and task in waiting:
+                        waiting.remove(task)
+                self.done.append(task)
+
+    def completed(self):
+        '''Return the tasks that have finished since the last call'''
+        if self.wakeupreader is None:
+            return []
+        try:
+            while self.wakeupreader.recv(4096):
+                pass
+        except socket.error:
+            pass
+        tasks = []
+        while self.done:
+            tasks.append(self.done.popleft())
+        return tasks
+
+    def finish(self, task):
+        '''Record that the worker is done with the task, start the next for its owner'''
+        with self.lock:
+            waiting = self.waiting.get(task.owner)
+            if waiting:
+                self.tasks.put(waiting.popleft())
+            else:
+                self.running[task.owner] -= 1
+                if not self.running[task.owner]:
+                    del self.running[task.owner]
+            if task in self.pending:
+                self.pending.discard(task)
+                self.done.append(task)
+        try:
+            self.wakeupwriter.send(b'x')
+        except socket.error:
+            # Socket buffer is full, so the hub already has a wakeup pending
+            pass
+
+    def stop(self, waittime = 5):
+        '''Stop the worker threads, waiting up to waittime seconds for them'''
+        for thread in self.threads:
+            self.tasks.put(None)
+        endtime = time.time() + waittime
+        for thread in self.threads:
+            thread.join(max(endtime - time.time(), 0))
+        self.threads = []
+
+    def submit(self, function, args = (), kwargs = None, callback = None, owner = None, timeout = 30):
+        '''Queue function to run in a worker thread, returning the Task
+
+        Raises ValueError if too many tasks are already queued.
+        '''
+        task = Task(function, args, kwargs or {}, callback, owner, time.time() + timeout)
+        if self.wakeupfd is None:
+            self.wakeupreader, self.wakeupwriter = socket.socketpair()
+            self.wakeupreader.setblocking(False)
+            self.wakeupwriter.setblocking(False)
+            self.wakeupfd = self.wakeupreader.fileno()
+        with self.lock:
+            if self.numqueued >= self.maxqueued:
+                raise ValueError('task queue full (%i tasks)' % self.numqueued)
+            self.numqueued += 1
+            self.pending.add(task)
+            limit = self.maxperowner
+            if owner is None:
+                limit = self.numthreads
+            if self.running.get(owner, 0) < limit:
+                self.running[owner] = self.running.get(owner, 0) + 1
+                self.tasks.put(task)
+            else:
+                self.waiting.setdefault(owner, deque()).append(task)
+        while len(self.threads) < self.numthreads:
+            thread = threading.Thread(target = self.worker)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        return task
+
+    def worker(self):
+        '''Run tasks from the queue until given None'''
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            with self.lock:
+                if task.timedout:
+                    skip = True
+                else:
+                    skip = False
+                    task.started = True
+                    self.numqueued -= 1
+            if not skip:
+                try:
+                    task.result = task.function(*task.args, **task.kwargs)
+                except Exception as error:
+                    task.error = error
+            self.finish(task)
@@ -0,0 +1,87 @@
+import time
+
+class Hook(object):
+    '''Function run before or after a hub function, and how long it has taken
+
+    execbefore hooks are given the hub function's arguments, and stop the
+    hub function from running by returning something other than None.
+    execafter hooks are given the hub function's return value followed by
+    its arguments, and change what the hub function returns by returning
+    something else.
+    '''
+    __slots__ = ('functionname', 'function', 'owner', 'before', 'calls',
+        'changes', 'totaltime')
+
+    def __init__(self, functionname, function, owner = None, before = True):
+        self.functionname = functionname
+        self.function = function
+        self.owner = owner
+        self.before = before
+        self.calls = 0
+        self.changes = 0
+        self.totaltime = 0.0
+
+    def __repr__(self):
+        return '<Hook %s %s %s owner=%s>' % (self.before and 'before' or 'after',
+            self.functionname, getattr(self.function, '__name__', self.function), self.owner)
+
+def compilechain(functionname, function, before, after, log, loglevel):
+    '''Return function wrapped to run the before and after hooks
+
+    The hooks are fixed when the chain is compiled, so calling the result
+    doesn't look anything up.  Chains without before or after hooks skip
+    that part entirely.  Each hook's calls and time taken are added to the
+    Hook, and changes to the outcome of the function are logged at
+    loglevel.
+    '''
+    before, after = tuple(before), tuple(after)
+    timer = time.perf_counter
+
+    def runbefore(args, kwargs):
+        for hook in before:
+            starttime = timer()
+            try:
+                x = hook.function(*args, **kwargs)
+            finally:
+                hook.calls += 1
+                hook.totaltime += timer() - starttime
+            if x is not None:
+                hook.changes += 1
+                log(loglevel, 'Canceling function execution due to execbefore: function: %s, hook owner: %s, returning: %s, args: %s, keyword args: %s', functionname, hook.owner, x, args, kwargs)
+                return x
+
+    def runafter(returnobj, args, kwargs):
+        for hook in after:
+            starttime = timer()
+            try:
+                x = hook.function(returnobj, *args, **kwargs)
+            finally:
+                hook.calls += 1
+                hook.totaltime += timer() - starttime
+            if x is not returnobj:
+                hook.changes += 1
+                log(loglevel, 'Returning different value due to execafter: function: %s, hook owner: %s, was returning: %s, now returning: %s, args: %s, keyword args: %s', functionname, hook.owner, returnobj, x, args, kwargs)
+                return x
+        return returnobj
+
+    if before and after:
+        def new_function(*args, **kwargs):
+            x = runbefore(args, kwargs)
+            if x is not None:
+                return x
+            return runafter(function(*args, **kwargs), args, kwargs)
+    elif before:
+        def new_function(*args, **kwargs):
+            x = runbefore(args, kwargs)
+            if x is not None:
+                return x
+            return function(*args, **kwargs)
+    elif after:
+        def new_function(*args, **kwargs):
+            return runafter(function(*args, **kwargs), args, kwargs)
+    else:
+        return function
+    new_function.__name__ = getattr(function, '__name__', functionname)
+    new_function.__doc__ = function.__doc__
+    new_function.hooks = before + after
+    return new_function
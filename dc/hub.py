@@ -1,15 +1,34 @@
 import os
 import logging
 import datetime
+import importlib
 from logging.handlers import SysLogHandler
 from .parser import IntelConfigParser
 from select import select
 from .client import DCHubClient
+from .outgoing import OutgoingQueue, CONTROL, classnames
+from .bot import DCHubRemoteBot
+from .bothost import BotHostConnection, encodeframe
+from .user import LimitProfile, LimitOverlay
+from .search import SearchIndex
+from .spam import SpamSketch
+from .bans import BanList
+from .upgrade import sendstate, receivestate
+from .executor import TaskExecutor
+from .timers import TimerWheel
+from .hooks import Hook, compilechain
+from .watchdog import StallWatchdog
+from .accounts import INIAccountStore, SQLiteAccountStore, hashpassword, verifypassword
 import signal
 import socket
+import ssl
+import subprocess
+import struct
 import sys
 import time
 import pwd
+import zlib
+from collections import deque
 
 class DCHub(object):
     '''Direct Connect Hub
@@ -20,6 +39,11 @@ class DCHub(object):
     using this hub might suffice.
     '''
     id = 0
+    # Socket pair written to when a signal arrives, so select returns
+    signalreader = signalwriter = signalfd = None
+    # The BanList is kept in banlist, so bots that replace hub.bans with a
+    # dictionary update it instead (see setbans)
+    bans = property(lambda self: self.banlist, lambda self, bans: self.setbans(bans))
     def __init__(self, **kwargs):
         self.setupsignals()
         self.setupdefaults(**kwargs)
@@ -36,42 +60,23 @@ class DCHub(object):
     def _copydocstring(self, oldfunction, newfunction):
         '''Copy the docstring from the old function to the new function
 
-        Also attempts to copy the function name (works for Python >= 2.4)
+        Also copies the function name
         '''
-        try:
-            # Python 2.4 and higher can change the names of functions
-            newfunction.func_name = oldfunction.func_name
-        except:
-            pass
+        newfunction.__name__ = oldfunction.__name__
         # Keep the same docstring
         newfunction.__doc__ = oldfunction.__doc__
 
-    def _execwrapper(self, function):
-        '''Decorator for functions so that other functions can execute before/after
+    def _execwrapper(self, function, functionname):
+        '''Return function compiled into a chain with its execbefore and execafter hooks
 
         execbefore functions should return None unless they want to stop the
         main function from executing.  execafter functions should return
         returnobj unless they want to make the function return something
         different.  Either function can raise exceptions.
         '''
-        self.log.log(self.loglevels['wrapping'], 'Wrapping %s for execafter and execbefore' % function.func_name)
-        def new_function(*args, **kwargs):
-            if function.func_name in self.execbefore:
-                for f in self.execbefore[function.func_name]:
-                    x = f(*args, **kwargs)
-                    if x is not None:
-                        self.log.log(self.loglevels['execchange'], 'Canceling function execution due to execbefore: function: %s, returning: %s, args: %s, keyword args: %s' % (function.func_name, x, args, kwargs))
-                        return x
-            returnobj = function(*args, **kwargs)
-            if function.func_name in self.execafter:
-                for f in self.execafter[function.func_name]:
-                    x = f(returnobj, *args, **kwargs)
-                    if x is not returnobj:
-                        self.log.log(self.loglevels['execchange'], 'Returning different value due to execafter: function: %s, was returning: %s, now returning: %s, args: %s, keyword args: %s' % (function.func_name, returnobj, x, args, kwargs))
-                        return x
-            return returnobj
-        self._copydocstring(function, new_function)
-        return new_function
+        before, after = self.execbefore.get(functionname, ()), self.execafter.get(functionname, ())
+        self.log.log(self.loglevels['wrapping'], 'Wrapping %s for %i execbefore and %i execafter hooks' % (functionname, len(before), len(after)))
+        return compilechain(functionname, function, before, after, self.log.log, self.loglevels['execchange'])
 
     def _timerwrapper(self, function, loglevel, warningtime, warninglevel = logging.WARNING):
         '''Decorator for functions that logs the amount of time the function takes
@@ -80,7 +85,7 @@ class DCHub(object):
         warningtime.  If it is greater than warningtime, it is logged at
         WARNING.
         '''
-        self.log.log(self.loglevels['wrapping'], 'Wrapping %s for timing' % function.func_name)
+        self.log.log(self.loglevels['wrapping'], 'Wrapping %s for timing' % function.__name__)
         tim = time.time
         def new_function(*args, **kwargs):
             curtime = tim()
@@ -93,17 +98,120 @@ class DCHub(object):
                     if timediff > warningtime:
                         ll = warninglevel
             except Exception as error:
-                self.log.log(ll, '%s took %0.3f seconds (called with %s %s, raising %s: %r)' % (function.func_name, timediff, args, kwargs, error.__class__.__name__, str(error)))
+                self.log.log(ll, '%s took %0.3f seconds (called with %s %s, raising %s: %r)' % (function.__name__, timediff, args, kwargs, error.__class__.__name__, str(error)))
                 raise
             else:
-                self.log.log(ll, '%s took %0.3f seconds (called with %s %s, returning %s)' % (function.func_name, timediff, args, kwargs, str(ret)))
+                self.log.log(ll, '%s took %0.3f seconds (called with %s %s, returning %s)' % (function.__name__, timediff, args, kwargs, str(ret)))
             return ret
         self._copydocstring(function, new_function)
         return new_function
 
+    def acceptconnections(self, listensock, curtime):
+        '''Accept new connections on the listening socket and add them to the hub
+
+        Accepts until no connections are waiting, or maxacceptspertick have
+        been accepted (the rest are accepted on the next pass), so a burst
+        of connections doesn't overflow the listen backlog.
+        '''
+        stats = self.acceptstats
+        stats['batches'] += 1
+        for i in range(self.maxacceptspertick):
+            try:
+                sock, address = listensock.accept()
+            except (BlockingIOError, InterruptedError):
+                break
+            except socket.error:
+                stats['errors'] += 1
+                self.debugexception('Error accepting connection', self.loglevels['useradderror'])
+                break
+            stats['accepted'] += 1
+            # IPv6 addresses have flow info and scope id, which aren't needed
+            connection = (sock, (self.normalizeip(address[0]), address[1]))
+            try:
+                if self.rejectconnection(connection, curtime):
+                    stats['rejected'] += 1
+                    continue
+                if listensock.fileno() in self.tlslisteners:
+                    self.starthandshake(connection)
+                else:
+                    self.adduser(DCHubClient(connection))
+            except:
+                self.debugexception('Error adding user', self.loglevels['useradderror'])
+        else:
+            stats['fullbatches'] += 1
+
+    def continuehandshake(self, id):
+        '''Continue the TLS handshake for the socket now that it is ready
+
+        When the handshake completes, the connection is added to the hub.
+        '''
+        sslsock, address, wantwrite, timer = self.handshakes[id]
+        try:
+            sslsock.do_handshake()
+        except ssl.SSLWantReadError:
+            self.handshakes[id][2] = False
+            return
+        except ssl.SSLWantWriteError:
+            self.handshakes[id][2] = True
+            return
+        except (ssl.SSLError, socket.error) as error:
+            self.acceptstats['tlsfailures'] += 1
+            self.log.log(self.loglevels['useradderror'], 'TLS handshake with %s:%s failed: %s' % (address[0], address[1], error))
+            self.endhandshake(id).close()
+            return
+        self.endhandshake(id)
+        self.acceptstats['tlshandshakes'] += 1
+        if sslsock.session_reused:
+            self.acceptstats['tlsresumed'] += 1
+        try:
+            self.adduser(DCHubClient((sslsock, address)))
+        except:
+            self.debugexception('Error adding user', self.loglevels['useradderror'])
+
+    def addgroup(self, name, condition):
+        '''Add a group of users that messages can be broadcast to, and return it
+
+        condition is given a logged in user and returns whether the user is
+        in the group.  The group is a dictionary of nick -> user that the hub
+        keeps up to date as users log in, send $Supports or $MyINFO, and
+        leave (see updategroups), so broadcasting to the group only looks at
+        its members.  Bots can add their own groups (removing them with
+        removegroup when unloaded).  Adding a group that already exists
+        replaces its condition.
+        '''
+        group = self.groups.setdefault(name, {})
+        self.groupconditions[name] = condition
+        group.clear()
+        for user in self.users.values():
+            if condition(user):
+                group[user.nick] = user
+        return group
+
+    def addtask(self, function, args = (), kwargs = None, callback = None, owner = None, timeout = None):
+        '''Run a function that may block in a worker thread
+
+        When the function finishes (or takes more than timeout seconds,
+        tasktimeout by default), callback is called by the main loop with the
+        Task, which has the function's return value in task.result or the
+        exception it raised in task.error.  Since callbacks run in the main
+        thread, they can safely send messages to users; the function itself
+        should not.
+
+        owner should be the bot's nick (or other name) for tasks run for a
+        bot, so that no more than maxtasksperowner of them run at once.
+        Raises ValueError if more than maxqueuedtasks tasks are waiting.
+        '''
+        if timeout is None:
+            timeout = self.tasktimeout
+        task = self.executor.submit(function, args, kwargs, callback, owner, timeout)
+        self.schedule(timeout, self.checktasktimeouts)
+        self.log.log(self.loglevels['threading'], 'Added task %r' % task)
+        return task
+
     def adduser(self, user):
         '''Add a new user (socket connection) to the hub'''
         self.hubfullcheck(user)
+        self.bancheck(user)
         self.joinfloodcheck(user, 'ip')
         # Python's select seems broken, even if it returns that a given socket
         # is writeable, it can block on writing to it, so you need to add a
@@ -111,7 +219,9 @@ class DCHub(object):
         user.socket.settimeout(0.01)
         self.log.log(self.loglevels['newconnection'],"New user connection from %s" % user.idstring)
         self.setuplimits(user)
+        user.outgoing.stats = self.outgoingstats
         self.sockets[user.socketid] = user
+        user.keepalivetimer = self.schedule(user.limits['pingtime'], self.keepalive, user)
         self.giveLock(user)
         self.giveHubName(user)
 
@@ -151,29 +261,194 @@ class DCHub(object):
         '''Check to see if the user has the privileges to execute the command'''
         return functionname not in user.validcommands
 
+    def bancheck(self, user):
+        '''Check that the user's IP isn't banned, removing the user if it is'''
+        entry = self.bans.findip(user.ip)
+        if entry is not None:
+            self.log.log(self.loglevels['useradderror'], '%s is banned (%s), disconnecting them' % (user.idstring, entry))
+            self.removeuser(user)
+            raise ValueError('banned IP')
+
+    def canceltimer(self, timer):
+        '''Stop a timer returned by schedule from running (None is ignored)'''
+        self.timers.cancel(timer)
+
+    def checkconnectflood(self, user, receiver, request):
+        '''Raise ValueError if a ConnectToMe or RevConnectToMe should be dropped
+
+        request identifies the request (command, receiver, and address), and
+        the same request from the user within connectduplicatetime seconds is
+        dropped as a duplicate.  Otherwise the request is dropped if the user
+        has sent maxconnectspertimeperiod requests, or the receiver has been
+        sent maxincomingconnectspertimeperiod requests, within the time
+        period.
+        '''
+        curtime = time.time()
+        stats = self.connectstats
+        if user.recentconnects:
+            duplicatetime = curtime - user.limits['connectduplicatetime']
+            if user.recentconnects.get(request, 0) > duplicatetime:
+                stats['duplicates'] += 1
+                raise ValueError('duplicate connection request')
+            user.recentconnects = dict([(key, connecttime) for key, connecttime in user.recentconnects.items() if connecttime > duplicatetime])
+        timelimit = curtime - user.limits['timeperiod']
+        user.connecttimes = [connecttime for connecttime in user.connecttimes if connecttime > timelimit]
+        if len(user.connecttimes) >= user.limits['maxconnectspertimeperiod']:
+            stats['senderlimited'] += 1
+            raise ValueError('too many connection requests within time period')
+        # Bots don't get connection requests, so they aren't limited
+        if not hasattr(receiver, 'isDCHubBot'):
+            timelimit = curtime - receiver.limits['timeperiod']
+            receiver.incomingconnecttimes = [connecttime for connecttime in receiver.incomingconnecttimes if connecttime > timelimit]
+            if len(receiver.incomingconnecttimes) >= receiver.limits['maxincomingconnectspertimeperiod']:
+                stats['receiverlimited'] += 1
+                raise ValueError('too many connection requests to %s within time period' % receiver.nick)
+            receiver.incomingconnecttimes.append(curtime)
+        user.connecttimes.append(curtime)
+        if not user.recentconnects:
+            user.recentconnects = {}
+        user.recentconnects[request] = curtime
+        stats['forwarded'] += 1
+
+    def checkspam(self, user, message):
+        '''Raise ValueError if many users have sent messages like message
+
+        Every message is counted in spamsketch (see SpamSketch), which
+        estimates how many similar messages (sharing most of their text,
+        not just a common phrase) have been sent by anyone recently.  Spam
+        bots that send the same message from many nicks and IPs get past per
+        user limits, but not past this.  Messages counted
+        more than the user's maxsimilarmessages limit (0 disables the check)
+        are logged, and dropped if spamfilterdrop is True.
+        '''
+        if not self.spamfilter:
+            return
+        if self.spamsketch is None:
+            self.spamsketch = SpamSketch(self.spamsketchwidth, halflife = self.spamhalflife,
+              minlength = self.spamminlength, curtime = time.time())
+        fingerprints = self.spamsketch.fingerprints(message)
+        if not fingerprints:
+            return
+        stats = self.spamstats
+        stats['checked'] += 1
+        count = self.spamsketch.add(fingerprints, time.time())
+        limit = user.limits['maxsimilarmessages']
+        if limit and count > limit:
+            stats['flagged'] += 1
+            self.log.log(self.loglevels['spam'], 'Message from %s is like %.1f recent messages: %r' % (user.idstring, count, message[:100]))
+            if self.spamfilterdrop:
+                stats['dropped'] += 1
+                raise ValueError('too many similar messages from all users')
+
+    def checktasktimeouts(self):
+        '''Give up on tasks that have passed their deadline'''
+        self.executor.checktimeouts()
+        self.handletasks()
+
     def cleanup(self):
-        '''Close sockets and remove temporary files'''
-        if not self.reloadonexit:
+        '''Close sockets and remove temporary files
+
+        If the hub has been handed over to a new process, the sockets now
+        belong to the new process, so users aren't removed.  Bot hosts are
+        always stopped, since the hub that takes over starts its own.
+        '''
+        if not self.reloadonexit and not self.upgraded:
             for sock in self.listensocks.values():
                 sock.close()
-            for user in self.sockets.values():
-                self.removeuser(user)
+            for sock in self.tarpit.values():
+                sock.close()
+            self.removeusers(list(self.sockets.values()), broadcast = False)
             if os.name == 'posix' and os.path.isfile(self.pidfile):
                 try:
                     os.remove(self.pidfile)
                 except:
                     self.log.exception('Error removing pid file')
+        for host in list(self.bothostsockets.values()):
+            self.stopbothost(host, restart = False)
         self.unloadbots()
+        self.stopwatchdog()
+        if self.searchindex is not None:
+            try:
+                self.searchindex.save()
+            except:
+                self.log.exception('Error saving the +find index')
+        self.executor.stop(self.cleanuptime)
+
+    def compilehooks(self, functionnames = None):
+        '''Replace hooked hub functions with chains that run their hooks
+
+        Compiles the chains for the given functions, or for every function
+        with hooks if functionnames is None.  The chain for a function is
+        built from the original function (kept in wrappedfunctions), so
+        compiling again replaces the old chain.  Functions without hooks are
+        left alone and don't pay anything for the hook system.
+        '''
+        if functionnames is None:
+            functionnames = set(self.execbefore) | set(self.execafter)
+        for functionname in functionnames:
+            if functionname not in self.wrappedfunctions:
+                self.wrappedfunctions[functionname] = getattr(self, functionname)
+            setattr(self, functionname, self._execwrapper(self.wrappedfunctions[functionname], functionname))
+
+    def compressmessage(self, message, key = None):
+        '''Return the message compressed with zlib, as a ZPipe0 block
+
+        The block starts with $ZOn|, so it is queued as one piece of data and
+        nothing can be sent between the two.  If key is given, the compressed
+        message is kept in compressioncache and reused for the same key until
+        userlistversion changes, so a message sent to many users is only
+        compressed once.
+        '''
+        if key is not None:
+            cached = self.compressioncache.get(key)
+            if cached is not None and cached[0] == self.userlistversion:
+                self.zpipestats['cachehits'] += 1
+                return cached[1]
+        cputime = time.thread_time()
+        data = message.encode('utf-8')
+        compressed = zlib.compress(data, self.zpipelevel)
+        stats = self.zpipestats
+        stats['cputime'] += time.thread_time() - cputime
+        stats['blocks'] += 1
+        stats['plainbytes'] += len(data)
+        stats['compressedbytes'] += len(compressed)
+        compressed = b'$ZOn|' + compressed
+        if key is not None:
+            self.compressioncache[key] = (self.userlistversion, compressed)
+        return compressed
 
     def createlisteningsocket(self, ip, port):
-        '''Create an individual listening socket'''
-        listensock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        '''Create an individual listening socket
+
+        IPv6 addresses get an IPv6 socket.  If the IP is blank and ipv6 is
+        True, the socket accepts both IPv6 and IPv4 connections (falling back
+        to IPv4 only if the system doesn't support IPv6).  The socket is
+        nonblocking, so acceptconnections can accept until none are left.
+        '''
+        family, bindip = socket.AF_INET, ip
+        if ':' in ip:
+            family = socket.AF_INET6
+        elif not ip and self.ipv6 and socket.has_ipv6:
+            family, bindip = socket.AF_INET6, '::'
+        try:
+            listensock = socket.socket(family, socket.SOCK_STREAM)
+        except socket.error:
+            if ip:
+                raise
+            family, bindip = socket.AF_INET, ''
+            listensock = socket.socket(family, socket.SOCK_STREAM)
+        if family == socket.AF_INET6 and not ip:
+            listensock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
         listensock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         print("Binding")
-        listensock.bind((ip, port))
+        listensock.bind((bindip, port))
         print("Bound")
-        listensock.listen(1)
+        listensock.listen(self.listenbacklog)
+        listensock.setblocking(False)
         self.listensocks[listensock.fileno()] = listensock
+        self.listenlocations[listensock.fileno()] = (ip, port)
+        if (ip, port) in self.tlslocations:
+            self.tlslisteners.add(listensock.fileno())
 
     def debugexception(self, logmessage, loglevel = logging.DEBUG):
         '''Log an exception if being debugged, log a debug message otherwise'''
@@ -182,6 +457,53 @@ class DCHub(object):
         else:
             self.log.log(loglevel, logmessage)
 
+    def describestall(self):
+        '''Return what the main loop is doing, for the stall watchdog
+
+        Runs in the watchdog thread, so it only reads attributes.
+        '''
+        current = self.currentcommand
+        if current is None:
+            return ' (not processing a command)'
+        user, command = current
+        return ' processing command from %s: %r' % (user.idstring, command[:200])
+
+    def detachuser(self, user):
+        '''Remove user from the hub's data structures without telling anyone
+
+        Returns True if the user was in the user list, so the other users
+        need to be told that they have left.
+        '''
+        self.log.log(self.loglevels['userremove'], "Removing User: %s" % user.idstring)
+        if hasattr(user, 'socketid') and user.socketid in self.sockets \
+          and self.sockets[user.socketid] is user:
+            del self.sockets[user.socketid]
+        try:
+            user.close()
+        except:
+            self.log.exception('Error executing user.close for %s' % user.idstring)
+        if user.nick in self.bots and self.bots[user.nick] is user:
+            del self.bots[user.nick]
+            self.usercommandcache.clear()
+        if user.nick in self.remotebots and self.remotebots[user.nick] is user:
+            del self.remotebots[user.nick]
+            user.host.bots.discard(user.nick)
+            self.removehooks(user.nick)
+        if user.nick in self.nicks and self.nicks[user.nick] is user:
+            del self.nicks[user.nick]
+        listed = user.nick in self.users and self.users[user.nick] is user
+        if listed:
+            del self.users[user.nick]
+        for group in self.groups.values():
+            if group.get(user.nick) is user:
+                del group[user.nick]
+        user.loggedin = False
+        user.op = False
+        self.canceltimer(user.keepalivetimer)
+        self.canceltimer(user.myinfotimer)
+        user.keepalivetimer = user.myinfotimer = None
+        return listed
+
     def dropprivileges(self):
         '''Drop privileges if it makes sense to'''
         if not (os.name == 'posix' and self.changeuidgid):
@@ -195,6 +517,62 @@ class DCHub(object):
             self.log.critical("Can't change group or user ids, exiting")
             self.stop = True
 
+    def endhandshake(self, id, expired = False):
+        '''Stop tracking the TLS handshake for the socket, returning the socket
+
+        expired is True when called from the handshake's timer, which has
+        already run, so it isn't cancelled.
+        '''
+        sslsock, address, wantwrite, timer = self.handshakes.pop(id)
+        if not expired:
+            self.canceltimer(timer)
+        return sslsock
+
+    def expirehandshake(self, id, sslsock):
+        '''Close the connection if its TLS handshake hasn't finished in time'''
+        handshake = self.handshakes.get(id)
+        if handshake is None or handshake[0] is not sslsock:
+            return
+        self.acceptstats['tlsfailures'] += 1
+        self.log.log(self.loglevels['useradderror'], 'TLS handshake with %s:%s timed out' % handshake[1])
+        self.endhandshake(id, expired = True).close()
+
+    def expirejoin(self, key):
+        '''Forget a join once joinfloodtime has passed'''
+        self.jointimes.pop(key, None)
+
+    def filelocation(self, filename):
+        '''Return the location the hub uses for the configured file name'''
+        if os.name == 'posix' and self.chroot and os.getuid() == 0:
+            if not filename.startswith('/'):
+                return '/%s' % filename
+            return filename
+        return os.path.abspath(filename)
+
+    def findentries(self, terms, callback):
+        '''Find the (filename, line) pairs from the searchable files matching
+        terms in a worker thread, calling callback with the Task
+
+        The index is created the first time it is needed and kept up to date
+        by indexing lines appended to the files since the last search.  It is
+        saved (also in a worker thread) searchindexsaveinterval seconds after
+        it first changes, instead of after every search.
+        '''
+        if self.searchindex is None:
+            self.searchindex = SearchIndex(self.searchfiles.split(), self.searchindexfile)
+        index = self.searchindex
+        def found(task):
+            if index.changed and self.searchindexsavetimer is None:
+                self.searchindexsavetimer = self.schedule(self.searchindexsaveinterval, self.savesearchindex)
+            callback(task)
+        self.addtask(index.find, (terms, self.maxfindresults), callback = found, owner = '+find')
+
+    def flushmyinfo(self, user):
+        '''Broadcast the MyINFO changes held back by updatemyinfo, if any'''
+        user.myinfotimer = None
+        if self.users.get(user.nick) is user and user.myinfo != user.sentmyinfo:
+            self.updatemyinfo(user)
+
     def getcommandtype(self, command):
         '''Return type of command and argument string'''
         if command[0] != '$':
@@ -212,6 +590,12 @@ class DCHub(object):
             return '_PrivateMessage', args
         return functionname, args
 
+    def getsupports(self):
+        '''Return the extensions the hub supports with its current options'''
+        if self.zpipe:
+            return self.supports
+        return [feature for feature in self.supports if feature != 'ZPipe0']
+
     def getuidgid(self):
         '''Get the user or group id for given name'''
         results = []
@@ -226,6 +610,37 @@ class DCHub(object):
                 results.append(getattr(globals()[modulename], functionname)(ugname)[2])
         return results
 
+    def getupgradestate(self):
+        '''Return the hub state and file descriptors to give to a new process'''
+        fds = []
+        listeners = []
+        for id, sock in self.listensocks.items():
+            listeners.append(list(self.listenlocations.get(id, ('', 0))))
+            fds.append(sock.fileno())
+        users = []
+        quits = []
+        for user in self.sockets.values():
+            if isinstance(user.socket, ssl.SSLSocket):
+                # TLS session state can't be handed to another process, so
+                # these users have to reconnect, and the new process tells
+                # the other users they have left
+                if self.users.get(user.nick) is user:
+                    quits.append(user.nick)
+                continue
+            record = dict([(attr, getattr(user, attr)) for attr in self.upgradeattrs])
+            record['outgoing'] = user.outgoing.getvalue().decode('latin-1')
+            record['validcommands'] = sorted(user.validcommands)
+            record['supports'] = sorted(user.supports)
+            record['nicks'] = self.nicks.get(user.nick) is user
+            record['users'] = self.users.get(user.nick) is user
+            record['ops'] = self.ops.get(user.nick) is user
+            users.append(record)
+            fds.append(user.socketid)
+        state = {'listeners': listeners, 'users': users, 'quits': quits,
+            'bindinglocations': [list(location) for location in self.bindinglocations],
+            'jointimes': [[jointime, key] for key, jointime in self.jointimes.items()]}
+        return state, fds
+
     def getusercommand(self, user, command):
         '''Return command string if user has permission to use command'''
         perm = command['permission']
@@ -241,15 +656,74 @@ class DCHub(object):
         return command['command']
 
     def getusercommands(self, user):
-        '''Return command string containing all commands the user has access to'''
-        commands = list(self.usercommands.values())
-        commands.sort(key = lambda uc: uc['position'])
-        # Remove all previous user commands for the user
-        message = '$UserCommand 255 7 |'
-        for command in commands:
-            message += self.getusercommand(user, command)
+        '''Return command string containing all commands the user has access to
+
+        Which commands a user gets only depends on whether they are a user,
+        an op, and their account's args, so the string is built once for
+        each combination and cached.  The cache is cleared when the user
+        commands, bots, or accounts change.
+        '''
+        args = None
+        if user.nick in self.accounts:
+            args = self.accounts[user.nick]['args']
+        signature = (user.nick in self.users, user.nick in self.ops, args)
+        message = self.usercommandcache.get(signature)
+        if message is None:
+            commands = list(self.usercommands.values())
+            commands.sort(key = lambda uc: uc['position'])
+            # Remove all previous user commands for the user
+            message = '$UserCommand 255 7 |' + ''.join([self.getusercommand(user, command) for command in commands])
+            self.usercommandcache[signature] = message
         return message
 
+    def givebotevent(self, event, host = None):
+        '''Give an event to a bot host, or to every bot host with bots if host is None
+
+        A host that has fallen more than maxbothostbuffer bytes behind is
+        assumed to be hung and is restarted.
+        '''
+        if host is None:
+            hosts = [host for host in self.bothostsockets.values() if host.bots]
+        else:
+            hosts = [host]
+        if not hosts:
+            return
+        frame = encodeframe(event)
+        for host in hosts:
+            host.outgoing += frame
+            if len(host.outgoing) > self.maxbothostbuffer:
+                self.log.log(self.loglevels['boterror'], 'Bot host %s is not reading events, restarting it' % host.idstring)
+                self.stopbothost(host)
+
+    def gotbotaction(self, host, message):
+        '''Carry out an action sent by a bot host for one of its bots
+
+        Raises ValueError if the bot isn't one the host registered, or the
+        action is unknown.
+        '''
+        action, nick = message.get('action'), message.get('bot')
+        if action == 'register':
+            return self.registerremotebot(host, message)
+        if nick not in host.bots:
+            raise ValueError('bot %r not registered by bot host' % nick)
+        bot = self.remotebots[nick]
+        if action == 'chat':
+            self.give_ChatMessage(bot, message['message'])
+        elif action == 'privatemessage':
+            receiver = self.users.get(message['nick'])
+            if receiver is not None:
+                self.give_PrivateMessage(bot, receiver, message['message'])
+        elif action == 'kick':
+            user = self.nicks.get(message['nick'])
+            if user is not None and not hasattr(user, 'isDCHubBot'):
+                self.log.log(self.loglevels['userremove'], 'Bot %s kicked %s' % (nick, user.idstring))
+                self.removeuser(user)
+        elif action == 'ban':
+            self.bans.add(message['entry'], time.time() + float(message['seconds']))
+            self.purgebans()
+        else:
+            raise ValueError('unknown bot action %r' % action)
+
     def handleconnections(self):
         '''Handle all socket connections
 
@@ -260,34 +734,81 @@ class DCHub(object):
         queue. Send data to writeable sockets.
         '''
         users = self.sockets.values()
-        timeout = 1
+        curtime = time.time()
+        timeout = self.timers.nextdelay(curtime, self.maxpolltime)
+        if self.readyusers:
+            # Users still have commands to process, so just poll
+            timeout = 0
         readsockets = list(self.listensocks.keys()) + [user.socketid for user in users]
-        writesockets = [user.socketid for user in users if user.outgoing]
+        for wakeupfd in self.executor.wakeupfd, self.signalfd:
+            if wakeupfd is not None:
+                readsockets.append(wakeupfd)
+        writesockets = [user.socketid for user in users if user.outgoing or user.ignoremessages]
+        if self.handshakes:
+            readsockets.extend(self.handshakes.keys())
+            writesockets.extend([id for id, handshake in self.handshakes.items() if handshake[2]])
+        if self.bothostsockets:
+            readsockets.extend(self.bothostsockets.keys())
+            writesockets.extend([id for id, host in self.bothostsockets.items() if host.outgoing])
+        if self.watchdog is not None:
+            self.watchdog.idle()
+        selectstart = time.time()
         readsockets, writesockets, errorsockets = select(readsockets, writesockets, readsockets+writesockets, timeout)
+        self.selecttime = time.time() - selectstart
+        if self.watchdog is not None:
+            self.watchdog.busy()
         self.handleerrorsockets(errorsockets)
         self.handlereadsockets(readsockets)
         self.handlewritesockets(writesockets)
 
     def handleerrorsockets(self, errorsockets):
         '''Handle sockets in error state'''
+        dropped = []
         for id in errorsockets:
             if id in self.listensocks:
                 self.log.error('Error in listening socket %s, closing socket' % self.listensocks[id].getsockname())
                 self.listensocks[id].close()
                 del self.listensocks[id]
-            else:
-                self.removeuser(self.sockets[id])
+                self.listenlocations.pop(id, None)
+                self.tlslisteners.discard(id)
+            elif id in self.handshakes:
+                self.endhandshake(id).close()
+            elif id in self.bothostsockets:
+                self.log.log(self.loglevels['boterror'], 'Error in socket for bot host %s' % self.bothostsockets[id].idstring)
+                self.stopbothost(self.bothostsockets[id])
+            elif id in self.sockets:
+                dropped.append(self.sockets[id])
+        self.removeusers(dropped)
 
     def handlereadsockets(self, readsockets):
-        '''Read data from sockets, accept new connections'''
+        '''Read data from sockets, accept new connections
+
+        Users whose connections have closed are removed together at the end,
+        so many connections dropping at once doesn't flood the other users
+        with separate $Quit messages (see removeusers).
+        '''
         curtime = time.time()
+        dropped = []
         for id in readsockets:
-            if id in self.listensocks:
-                # New socket connection, accept and add to hub
+            if id == self.executor.wakeupfd:
+                self.handletasks()
+                continue
+            if id == self.signalfd:
+                # The main loop checks the flags set by the signal handler
                 try:
-                    self.adduser(DCHubClient(self.listensocks[id].accept()))
-                except:
-                    self.debugexception('Error adding user', self.loglevels['useradderror'])
+                    while self.signalreader.recv(4096):
+                        pass
+                except socket.error:
+                    pass
+                continue
+            if id in self.listensocks:
+                self.acceptconnections(self.listensocks[id], curtime)
+                continue
+            if id in self.handshakes:
+                self.continuehandshake(id)
+                continue
+            if id in self.bothostsockets:
+                self.readbothost(self.bothostsockets[id])
                 continue
             try:
                 user = self.sockets[id]
@@ -295,19 +816,26 @@ class DCHub(object):
                 continue
             try:
                 data = user.socket.recv(self.buffersize)
-                data = str(data)
+                if isinstance(user.socket, ssl.SSLSocket):
+                    # Data the TLS layer has already decrypted doesn't make
+                    # the socket readable again, so read all of it now
+                    while user.socket.pending():
+                        data += user.socket.recv(self.buffersize)
                 if not data:
                     self.log.log(self.loglevels['userdisconnect'], "Client disconnected: %s" % user.idstring)
-                    self.removeuser(user)
+                    dropped.append(user)
                     continue
+                data = data.decode('utf-8', 'replace')
                 self.log.log(self.loglevels['datareceived'], 'Data received from %s: %r' % (user.idstring, data))
-            except socket.error:
-                self.log.log(self.loglevels['socketerror'], "Removing connection due to error in receiving data: %s" % user.idstring)
-                self.removeuser(user)
-                continue
             except socket.timeout:
+                # socket.timeout is a socket.error, so it has to come first.
+                # TLS sockets time out when only part of a record has arrived
                 self.log.log(self.loglevels['socketerror'], 'Timeout while reading from socket for user %s' % user.idstring)
                 continue
+            except socket.error:
+                self.log.log(self.loglevels['socketerror'], "Removing connection due to error in receiving data: %s" % user.idstring)
+                dropped.append(user)
+                continue
             # Split data into commands
             # Note that if the data ends with '|', commands[-1] will be ''
             commands = data.split('|')
@@ -317,6 +845,9 @@ class DCHub(object):
             # Add commands to user's incoming command queue
             user.incoming.extend(commands)
             user.commandtimes.extend([curtime] * (len(commands) -1 ))
+            if len(commands) > 1:
+                self.queueuser(user)
+        self.removeusers(dropped)
 
     def handlereloaderror(self):
         '''Reset variables that allow the hub to continue operating'''
@@ -327,25 +858,92 @@ class DCHub(object):
         self.loadbots()
         self.log.exception('Error reloading hub')
 
+    def handletasks(self):
+        '''Run the callbacks for tasks that have finished in worker threads'''
+        for task in self.executor.completed():
+            if task.error is not None:
+                self.log.log(self.loglevels['threading'], 'Task %r failed: %s: %s' % (task, task.error.__class__.__name__, task.error))
+            if task.callback is None:
+                continue
+            try:
+                task.callback(task)
+            except:
+                self.log.exception('Error in callback for task %r' % task)
+
     def handlewritesockets(self, writesockets):
-        '''Write data to sockets'''
+        '''Write data to sockets
+
+        Users are sent at most sendquantum bytes each per pass, and at most
+        sendbudget bytes are sent to all users per pass (0 for no limit), so
+        a user with a lot of data waiting can't hold up the others (a deficit
+        round robin with byte sized quanta).  If the budget runs out, the
+        users that didn't get a turn are served first in the next pass.  Each
+        user's data is sent in priority order (see OutgoingQueue).
+
+        Users that have been set to ignore messages are removed once their
+        outgoing message queue has been flushed.  Like handlereadsockets,
+        users are removed together at the end.
+        '''
+        dropped = []
+        userids = []
         for id in writesockets:
+            if id in self.handshakes:
+                self.continuehandshake(id)
+            elif id in self.bothostsockets:
+                self.writebothost(self.bothostsockets[id])
+            else:
+                userids.append(id)
+        if self.nextwriteid is not None:
+            if self.nextwriteid in userids:
+                start = userids.index(self.nextwriteid)
+                userids = userids[start:] + userids[:start]
+            self.nextwriteid = None
+        budget = self.sendbudget or -1
+        stats = self.outgoingstats
+        for id in userids:
+            if budget == 0:
+                stats['budgetlimited'] += 1
+                self.nextwriteid = id
+                break
             try:
                 user = self.sockets[id]
             except KeyError:
                 continue
-            try:
-                data = user.outgoing.encode('utf-8')
-                sentsize = user.socket.send(data)
-                self.log.log(self.loglevels['datasent'], 'Data sent to %s: %r' % (user.idstring, user.outgoing[:sentsize]))
-            except socket.error:
-                self.log.log(self.loglevels['socketerror'], "Removing connection due to error in sending data: %s" % user.idstring)
-                self.removeuser(user)
+            if user.ignoremessages and not user.outgoing:
+                dropped.append(user)
                 continue
+            limit = self.sendquantum
+            if 0 < budget < limit:
+                limit = budget
+            if len(user.outgoing) > limit:
+                stats['quantumlimited'] += 1
+            try:
+                sentsize = user.outgoing.send(user.socket, limit)
+                self.log.log(self.loglevels['datasent'], 'Data sent to %s: %r', user.idstring, user.outgoing.current[:sentsize])
             except socket.timeout:
                 self.log.log(self.loglevels['socketerror'], 'Timeout while writing to socket for user %s' % user.idstring)
                 continue
-            user.outgoing = user.outgoing[sentsize:]
+            except socket.error:
+                self.log.log(self.loglevels['socketerror'], "Removing connection due to error in sending data: %s" % user.idstring)
+                dropped.append(user)
+                continue
+            user.outgoing.sent(sentsize)
+            if budget > 0:
+                budget = max(budget - sentsize, 0)
+        self.removeusers(dropped)
+
+    def holdsearch(self, user, search):
+        '''Hold back a search while shedding load, keeping only each user's latest
+
+        Held searches are sent by releasesearches.
+        '''
+        stats = self.shedstats
+        stats['searchesheld'] += 1
+        if user.nick in self.heldsearches:
+            stats['searchescoalesced'] += 1
+        self.heldsearches[user.nick] = (user, search)
+        if self.searchtimer is None:
+            self.searchtimer = self.schedule(self.shedsearchdelay, self.releasesearches)
 
     def hubfullcheck(self, user):
         '''Checks if the hub is full, and either denies access or redirects
@@ -361,6 +959,28 @@ class DCHub(object):
                 self.giveHubIsFull(user)
             raise ValueError('Hub is full, user cannot join')
 
+    def interncommands(self, commands):
+        '''Return a shared frozenset equal to the set of commands
+
+        Users with the same permissions share the same set, instead of each
+        having their own copy.
+        '''
+        commands = frozenset(commands)
+        return self.commandsets.setdefault(commands, commands)
+
+    def isgeniecommand(self, message):
+        '''Return True if the message's first word is a command got_Genie handles'''
+        if not message.startswith('+'):
+            return False
+        command = message[1:].split(None, 1)[:1]
+        if not command:
+            return False
+        command = command[0]
+        if command in self.hubgeniecommands:
+            return True
+        genie = self.bots.get('Genie')
+        return genie is not None and command in getattr(genie, 'genie', ())
+
     def ishubfull(self, user):
         '''Check to see if the hub is already full'''
         if len(self.users) >= self.maxusers:
@@ -368,35 +988,73 @@ class DCHub(object):
         return False
 
     def joinfloodcheck(self, user, type='nick'):
-        '''Check that the join flood limits aren't being violated'''
-        curtime = time.time()
-        self.jointimes = [jointime for jointime in self.jointimes if jointime[0] > curtime - self.joinfloodtime]
-        joins = [jointime[1] for jointime in self.jointimes]
+        '''Check that the join flood limits aren't being violated
+
+        Joins are remembered for joinfloodtime seconds, and forgotten by a
+        timer (see expirejoin).
+        '''
+        if self.joinfloodtime <= 0:
+            return
         checkattr = getattr(user, type)
-        if checkattr in joins:
+        if checkattr in self.jointimes:
             self.removeuser(user)
             raise ValueError('join flood detected')
-        self.jointimes.append((curtime, checkattr))
+        self.jointimes[checkattr] = time.time()
+        self.schedule(self.joinfloodtime, self.expirejoin, checkattr)
+
+    def keepalive(self, user):
+        '''Send a keepalive if the user hasn't been sent anything in pingtime
+
+        Reschedules itself for pingtime seconds after the last time the user
+        was sent or sent a command, so active users don't cost anything
+        besides the timer.
+        '''
+        if self.sockets.get(user.socketid) is not user:
+            return
+        curtime = time.time()
+        pingtime = user.limits['pingtime']
+        if user.lastcommandtime <= curtime - pingtime and not user.ignoremessages:
+            self.give_EmptyCommand(user)
+            user.lastcommandtime = curtime
+        user.keepalivetimer = self.schedule(max(user.lastcommandtime + pingtime - curtime, 0), self.keepalive, user)
 
     def loadaccounts(self):
-        '''Load accounts from file'''
-        if not os.path.isfile(self.accountsfile):
+        '''Load accounts from the configured backend
+
+        With the ini backend, the accounts file is read into memory.  With the
+        sqlite backend, the accounts file is an SQLite database and accounts
+        are looked up as needed.
+        '''
+        if self.accountsbackend == 'ini' and not os.path.isfile(self.accountsfile):
             return self.log.log(self.loglevels['missingfile'], 'Accounts file does not exist')
-        accounts = {}
-        self.accountsparser = IntelConfigParser()
         try:
-            self.accountsparser.read(self.accountsfile)
-            truebools = 'yt1'
-            if self.accountsparser.has_section('dchub-accounts'):
-                for key, value in self.accountsparser.items('dchub-accounts'):
-                    password, op, args = value.split('|', 2)
-                    op = bool(op and op.lower() in truebools)
-                    accounts[key] = {'name':key, 'password': password, 'op':op, 'args':args}
+            if self.accountsbackend == 'sqlite':
+                accounts = SQLiteAccountStore(self.accountsfile, self.accountscachesize)
+            else:
+                accounts = INIAccountStore(self.accountsfile, self.accountscachesize)
+                self.accountsparser = accounts.parser
         except:
             return self.debugexception('Error loading accounts', self.loglevels['loadfileerror'])
+        if hasattr(self.accounts, 'close'):
+            self.accounts.close()
         self.accounts = accounts
-        self.log.log(self.loglevels['loading'], 'Loaded %s accounts' % len(accounts.keys()))
-        self.log.log(self.loglevels['loadingdebug'], 'Loaded accounts: %s' % ' '.join(accounts.keys()))
+        self.usercommandcache.clear()
+        self.log.log(self.loglevels['loading'], 'Loaded %s accounts (%s backend)' % (len(accounts), self.accountsbackend))
+        if self.accountsbackend == 'ini':
+            # sqlite accounts aren't loaded, and there may be too many to list
+            self.log.log(self.loglevels['loadingdebug'], 'Loaded accounts: %s' % ' '.join(accounts.keys()))
+
+    def loadbans(self):
+        '''Load bans from the ban journal'''
+        bans = BanList(self.bansfile)
+        try:
+            bans.load()
+        except:
+            return self.debugexception('Error loading bans', self.loglevels['loadfileerror'])
+        self.bans = bans
+        self.log.log(self.loglevels['loading'], 'Loaded %s bans' % len(bans))
+        self.log.log(self.loglevels['loadingdebug'], 'Loaded bans: %s' % ' '.join(bans.keys()))
+        self.purgebans()
 
     def loadbots(self):
         '''Load bots from bots directory'''
@@ -411,7 +1069,7 @@ class DCHub(object):
             for botfile in botfiles:
                 try:
                     mod = __import__(botfile[:-3])
-                    reload(mod)
+                    importlib.reload(mod)
                     for item in dir(mod):
                         item = getattr(mod, item)
                         # issubclass(item, DCHubBot) doesn't work
@@ -429,9 +1087,7 @@ class DCHub(object):
         # Keep track of whether any of the bots was an op, so we can send out
         # a new op list
         opsadded = False
-        botnames = bots.keys()
-        botnames.sort()
-        for botnick in botnames:
+        for botnick in sorted(bots):
             bot = bots[botnick]
             for functionname in bot.replace.keys():
                 if functionname in self.replacedfunctions:
@@ -456,9 +1112,9 @@ class DCHub(object):
                 self.replacedfunctions[functionname] = getattr(self, functionname)
                 setattr(self, functionname, function)
             for functionname, function in bot.execbefore.items():
-                self.wrapfunction(functionname, function, execbefore = True)
+                self.wrapfunction(functionname, function, True, bot.nick, compile = False)
             for functionname, function in bot.execafter.items():
-                self.wrapfunction(functionname, function, execbefore = False)
+                self.wrapfunction(functionname, function, False, bot.nick, compile = False)
             if bot.visible:
                 # Make bot appear as a user to the hub
                 if bot.nick in self.nicks:
@@ -469,9 +1125,16 @@ class DCHub(object):
                 if bot.op:
                     opsadded = True
                     self.ops[bot.nick] = bot
+                self.updategroups(bot)
                 self.log.log(self.loglevels['userlogin'], 'Bot logged in: %s' % bot.idstring)
                 self.giveHello(bot, newuser = True)
                 self.giveMyINFO(bot)
+        # unloadbots removed the hooks of bots in bot hosts too
+        for bot in self.remotebots.values():
+            for functionname in bot.hooks:
+                self.wrapfunction(functionname, bot.hook(functionname), False, bot.nick, compile = False)
+        self.compilehooks()
+        self.usercommandcache.clear()
         if opsadded:
             self.giveOpList()
 
@@ -483,69 +1146,15 @@ class DCHub(object):
         Only booleans, integers, floats, and strings can be given as
         configuration options.
         '''
-        def givewarning(option):
-            '''Give warning that the option is not valid'''
-            print("WARNING: Invalid configuration option or option value:"), option
-        config = {}
-        config.update(self.kwargs)
-        truebools = 'yt1'
-        attrs = dir(self)
-        if not os.path.isfile(self.configfile):
-            print("WARNING: Configuration file does not exist")
-        else:
-            self.configparser = IntelConfigParser()
-            self.configparser.read(self.configfile)
-            if self.configparser.has_section('dchub'):
-                for key, value in self.configparser.items('dchub'):
-                    if key not in config:
-                        config[key] = value
-            for section in 'userlimits', 'loglevels':
-                sectiondict = getattr(self, section)
-                if self.configparser.has_section('dchub-%s' % section):
-                    for key, value in self.configparser.items('dchub-%s' % section):
-                        try:
-                            if key not in sectiondict:
-                                raise ValueError
-                            value = int(value)
-                        except ValueError:
-                            givewarning(key)
-                        else:
-                            sectiondict[key] = value
-            if self.configparser.has_section('dchub-bindings'):
-                for key, value in self.configparser.items('dchub-bindings'):
-                    try:
-                        ip, port = value.split(':')
-                        port = int(port)
-                    except ValueError:
-                        givewarning(value)
-                    else:
-                        self.bindinglocations.append((ip, port))
+        config, sections, bindings = self.readconfig()
+        for section, values in sections.items():
+            getattr(self, section).update(values)
+        self.setuplimitprofiles()
+        self.bindinglocations.extend(bindings)
         for key, value in config.items():
-            try:
-                if key not in attrs:
-                    raise ValueError
-                attr = getattr(self, key)
-                if isinstance(attr, bool):
-                    # Y, T, Yes, yes, True, true, 1, etc. are True
-                    value = bool(value and value[0].lower() in truebools)
-                elif isinstance(attr, int):
-                    value = int(value)
-                elif isinstance(attr, float):
-                    value = float(value)
-                elif not isinstance(attr, str):
-                    # If the variable isn't a bool, int, float, or string, we
-                    # shouldn't be messing with it
-                    raise ValueError
-            except ValueError:
-                givewarning(key)
-            else:
-                setattr(self, key, value)
+            setattr(self, key, value)
         for fil in self.filelocations:
-            if os.name == 'posix' and self.chroot and os.getuid() == 0:
-                if not fil.startswith('/'):
-                    setattr(self, fil, '/%s' % getattr(self, fil))
-            else:
-                setattr(self, fil, os.path.abspath(getattr(self, fil)))
+            setattr(self, fil, self.filelocation(getattr(self, fil)))
 
     def loadusercommands(self):
         '''Load user commands from file'''
@@ -571,6 +1180,7 @@ class DCHub(object):
             return self.debugexception('Error loading user commands', self.loglevels['loadfileerror'])
         self.usercommands.clear()
         self.usercommands.update(usercommands)
+        self.usercommandcache.clear()
         self.log.log(self.loglevels['loading'], 'Loaded %s user commands' % len(usercommands.keys()))
         self.log.log(self.loglevels['loadingdebug'], 'Loaded user commands: %s' % ' '.join(usercommands.keys()))
 
@@ -597,7 +1207,7 @@ class DCHub(object):
         self.hubfullcheck(user)
         self.joinfloodcheck(user)
         curtime = time.time()
-        user.validcommands = self.validusercommands.copy()
+        user.validcommands = self.interncommands(self.validusercommands)
         self.users[user.nick] = user
         user.loggedin = True
         self.log.log(self.loglevels['userlogin'], 'User logged in: %s' % user.idstring)
@@ -612,14 +1222,19 @@ class DCHub(object):
         if user.nick in self.accounts:
             user.account = self.accounts[user.nick]
             if self.accounts[user.nick]['op']:
-                user.validcommands |= self.validopcommands
+                user.validcommands = self.interncommands(self.validusercommands | self.validopcommands)
                 self.ops[user.nick] = user
                 user.op = True
-                self.giveOpList()
-        if self.ops and not user.op:
+        self.updategroups(user)
+        if user.op:
+            self.giveOpList()
+        elif self.ops:
             self.giveOpList(user)
+        self.setuplimits(user)
         self.give_WelcomeMessage(user)
         self.giveUserCommand(user)
+        if self.bothostsockets:
+            self.givebotevent({'event': 'join', 'nick': user.nick, 'ip': user.ip, 'op': user.op})
 
     def logtimes(self, functionname, loglevel, warningtime, warninglevel = logging.WARNING):
         '''Log timing information for every call to function with name
@@ -637,15 +1252,46 @@ class DCHub(object):
     def mainloop(self):
         '''Continuously process, send, and receive data from socket connections'''
         self.setuplisteningsockets()
+        self.updateacceptstats()
+        self.startbothosts()
+        self.startwatchdog()
         self.log.log(self.loglevels['hubstatus'], 'Starting main loop')
         while not self.stop:
             try:
+                if self.reloadconfigpending:
+                    self.reloadconfig()
+                if self.upgradepending:
+                    self.upgrade()
+                passstart = time.time()
                 self.processcommands()
                 self.handleconnections()
+                self.runtimers()
+                busytime = time.time() - passstart - self.selecttime
+                self.updateshedding(busytime)
+                if self.watchdog is not None:
+                    self.watchdog.record(busytime)
             except:
                 self.log.exception('Serious error in main control loop')
         self.cleanup()
 
+    def normalizeip(self, ip):
+        '''Return the IPv4 address for IPv4 mapped IPv6 addresses (::ffff:1.2.3.4)
+
+        Dual stack listening sockets give IPv4 clients these addresses.
+        '''
+        if ip.startswith('::ffff:') and '.' in ip:
+            return ip[7:]
+        return ip
+
+    def parkuser(self, user, delay):
+        '''Keep the user out of the ready queue for delay seconds
+
+        Used for users that have sent too many commands recently.  Commands
+        they send in the meantime are queued but not processed.
+        '''
+        user.ready = True
+        self.schedule(delay, self.unparkuser, user)
+
     def postreload(self):
         '''Commands to preform after reloading the hub
 
@@ -700,42 +1346,316 @@ class DCHub(object):
         getattr(self, 'got%s' % function)(user, *checkedargs)
 
     def processcommands(self):
-        '''Process next command for all users
-
-        Remove users if they have been set to ignore messages and their
-        outgoing message queue has been flushed.  Also send a keep alive to
-        users that haven't sent a command in a while.
+        '''Process queued commands for users in the ready queue
+
+        Users are put in the ready queue when complete commands are received
+        from them (see queueuser), so idle users cost nothing here.  Each
+        pass processes up to maxcommandspertick commands per ready user, and
+        users with commands left go to the back of the queue for the next
+        pass, so a user sending many commands can't hold up the others.
+        Users that have sent more than maxcommandspertimeperiod commands are
+        parked until they may send more (see parkuser).
         '''
         curtime = time.time()
-        # self.sockets.values() doesn't work here because users can be
-        # removed in many of the sub functions, and that modifies the
-        # self.sockets dictionary.  This could be worked around by not removing
-        # any users until after the processing of commands, but that would
-        # require significant changes, and probably wouldn't be worth it except
-        # for the largest sites
-        for user in self.sockets.values():
-            if user.ignoremessages:
-                if not user.outgoing:
-                    self.removeuser(user)
+        readyusers = self.readyusers
+        for i in range(len(readyusers)):
+            user = readyusers.popleft()
+            user.ready = False
+            # Users can be removed while they are in the queue
+            if user.ignoremessages or self.sockets.get(user.socketid) is not user:
                 continue
             incominglen = len(user.incoming)
-            if incominglen > 1:
-                if incominglen > user.limits['maxqueuedcommands']:
-                    self.log.log(self.loglevels['badcommand'], 'User has more than the max number of queued commands (%i queued, %i max): %s' % (incominglen, user.limits['maxqueuedcommands'], user.idstring))
-                    del user.incoming[user.limits['maxqueuedcommands'] - 1:-1]
-                user.lastcommandtime = curtime
-                commandtime = curtime - user.limits['timeperiod']
-                user.commandtimes = [ct for ct in user.commandtimes if ct > commandtime]
-                if len(user.commandtimes) >  user.limits['maxcommandspertimeperiod']:
-                    continue
-                try:
-                    while len(user.incoming) > 1 and not user.ignoremessages:
-                        command = user.incoming.pop(0)
-                        self.processcommand(user, command)
-                except:
-                    self.log.exception('Error processing command from %s: %r' % (user.idstring, command))
-            elif user.lastcommandtime < curtime - user.limits['pingtime']:
-                self.give_EmptyCommand(user)
+            if incominglen < 2:
+                continue
+            if self.shedlevel >= 3 and not user.loggedin:
+                self.shedstats['loginspaused'] += 1
+                self.parkuser(user, self.shedloginpause)
+                continue
+            if incominglen > user.limits['maxqueuedcommands']:
+                self.log.log(self.loglevels['badcommand'], 'User has more than the max number of queued commands (%i queued, %i max): %s' % (incominglen, user.limits['maxqueuedcommands'], user.idstring))
+                # Searches are dropped first, so chat and other commands are
+                # more likely to be kept
+                commands = [command for command in user.incoming[:-1] if not command.startswith('$Search ')]
+                user.incoming[:-1] = commands[:user.limits['maxqueuedcommands'] - 1]
+            user.lastcommandtime = curtime
+            commandtime = curtime - user.limits['timeperiod']
+            user.commandtimes = [ct for ct in user.commandtimes if ct > commandtime]
+            if len(user.commandtimes) >  user.limits['maxcommandspertimeperiod']:
+                resumetime = user.commandtimes[-user.limits['maxcommandspertimeperiod'] - 1] + user.limits['timeperiod']
+                self.parkuser(user, resumetime - curtime)
+                continue
+            budget = self.maxcommandspertick
+            try:
+                while budget and len(user.incoming) > 1 and not user.ignoremessages:
+                    command = user.incoming.pop(0)
+                    self.currentcommand = (user, command)
+                    self.processcommand(user, command)
+                    budget -= 1
+            except:
+                self.log.exception('Error processing command from %s: %r' % (user.idstring, command))
+            self.currentcommand = None
+            if len(user.incoming) > 1:
+                self.queueuser(user)
+
+    def prunerejectcounts(self):
+        '''Forget IPs that haven't been rejected in maxtarpittime seconds'''
+        self.rejectprunetimer = None
+        expired = time.time() - self.maxtarpittime
+        for ip, record in list(self.rejectcounts.items()):
+            if record[1] < expired:
+                del self.rejectcounts[ip]
+        if self.rejectcounts:
+            self.rejectprunetimer = self.schedule(self.maxtarpittime, self.prunerejectcounts)
+
+    def purgebans(self):
+        '''Remove expired bans, and set a timer to do it again
+
+        The timer is set for when the next ban expires, but no more than
+        maxbanpurgetime seconds away, since bans can be added by bots without
+        the hub knowing.  Expired bans are ignored by ban checks even before
+        they are purged.
+        '''
+        self.canceltimer(self.banpurgetimer)
+        self.banpurgetimer = None
+        curtime = time.time()
+        nextexpiry = self.bans.nextexpiry()
+        if nextexpiry is not None and nextexpiry <= curtime:
+            try:
+                expired = self.bans.purge(curtime)
+            except:
+                self.debugexception('Error purging expired bans', self.loglevels['loadfileerror'])
+            else:
+                self.log.log(self.loglevels['loadingdebug'], 'Expired bans: %s' % ' '.join(expired))
+            nextexpiry = self.bans.nextexpiry()
+        delay = self.maxbanpurgetime
+        if nextexpiry is not None:
+            delay = min(max(nextexpiry - curtime, 0), delay)
+        self.banpurgetimer = self.schedule(delay, self.purgebans)
+
+    def queueuser(self, user):
+        '''Put the user in the ready queue, if not already there (or parked)'''
+        if not user.ready:
+            user.ready = True
+            self.readyusers.append(user)
+
+    def readbothost(self, host):
+        '''Read actions from a bot host, restarting the host if it has exited'''
+        try:
+            data = host.socket.recv(self.buffersize)
+        except BlockingIOError:
+            return
+        except socket.error:
+            data = b''
+        if not data:
+            self.log.log(self.loglevels['boterror'], 'Bot host %s exited' % host.idstring)
+            return self.stopbothost(host)
+        try:
+            messages = host.reader.feed(data)
+        except ValueError:
+            self.debugexception('Bad data from bot host %s' % host.idstring, self.loglevels['boterror'])
+            return self.stopbothost(host)
+        for message in messages:
+            try:
+                self.gotbotaction(host, message)
+            except:
+                self.debugexception('Error handling %r from bot host %s' % (message, host.idstring), self.loglevels['boterror'])
+
+    def readconfig(self):
+        '''Read configuration from file and keyword arguments without applying it
+
+        Returns a dictionary of hub attributes and their new values (converted
+        to the type of the current value), a dictionary of new values for the
+        userlimits and loglevels dictionaries, and a list of additional
+        (ip, port) binding locations.
+        '''
+        def givewarning(option):
+            '''Give warning that the option is not valid'''
+            print("WARNING: Invalid configuration option or option value:", option)
+        config, newconfig = {}, {}
+        sections = dict([(section, {}) for section in self.configsections])
+        bindings = []
+        tlslocations = set()
+        config.update(self.kwargs)
+        truebools = 'yt1'
+        attrs = dir(self)
+        if not os.path.isfile(self.configfile):
+            print("WARNING: Configuration file does not exist")
+        else:
+            self.configparser = IntelConfigParser()
+            self.configparser.read(self.configfile)
+            if self.configparser.has_section('dchub'):
+                for key, value in self.configparser.items('dchub'):
+                    if key not in config:
+                        config[key] = value
+            for section, validsection in self.configsections.items():
+                sectiondict = getattr(self, validsection)
+                if self.configparser.has_section('dchub-%s' % section):
+                    for key, value in self.configparser.items('dchub-%s' % section):
+                        try:
+                            if key not in sectiondict:
+                                raise ValueError
+                            value = int(value)
+                        except ValueError:
+                            givewarning(key)
+                        else:
+                            sections[section][key] = value
+            if self.configparser.has_section('dchub-bindings'):
+                for key, value in self.configparser.items('dchub-bindings'):
+                    tls = value.startswith('nmdcs://')
+                    if tls:
+                        value = value[len('nmdcs://'):]
+                    try:
+                        # IPv6 addresses can be given in brackets, [::1]:411
+                        ip, port = value.rsplit(':', 1)
+                        ip = ip.strip('[]')
+                        port = int(port)
+                    except ValueError:
+                        givewarning(value)
+                    else:
+                        bindings.append((ip, port))
+                        if tls:
+                            tlslocations.add((ip, port))
+        for key, value in config.items():
+            try:
+                if key not in attrs:
+                    raise ValueError
+                attr = getattr(self, key)
+                if isinstance(attr, bool):
+                    # Y, T, Yes, yes, True, true, 1, etc. are True
+                    value = bool(value and value[0].lower() in truebools)
+                elif isinstance(attr, int):
+                    value = int(value)
+                elif isinstance(attr, float):
+                    value = float(value)
+                elif not isinstance(attr, str):
+                    # If the variable isn't a bool, int, float, or string, we
+                    # shouldn't be messing with it
+                    raise ValueError
+            except ValueError:
+                givewarning(key)
+            else:
+                newconfig[key] = value
+        newconfig['tlslocations'] = tlslocations
+        return newconfig, sections, bindings
+
+    def readlistenoverflows(self):
+        '''Return the kernel's count of dropped connections due to full backlogs
+
+        Returns None if the count isn't available (only Linux has it).
+        '''
+        try:
+            fil = open('/proc/net/netstat', 'r')
+        except IOError:
+            return None
+        try:
+            lines = fil.readlines()
+        finally:
+            fil.close()
+        for header, values in zip(lines[::2], lines[1::2]):
+            if header.startswith('TcpExt:'):
+                fields = dict(zip(header.split()[1:], values.split()[1:]))
+                if 'ListenOverflows' in fields:
+                    return int(fields['ListenOverflows'])
+        return None
+
+    def receiveupgrade(self):
+        '''Take over listening sockets and users from the hub being upgraded'''
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM, fileno = self.upgradefd)
+        try:
+            state, fds = receivestate(sock)
+            self.restoreupgradestate(state, fds)
+            sock.sendall(b'OK')
+        finally:
+            sock.close()
+        self.log.log(self.loglevels['hubstatus'], 'Took over %i users from upgraded hub' % len(self.sockets))
+
+    def registerremotebot(self, host, message):
+        '''Add a bot running in a bot host to the hub
+
+        Like loadbots, this removes any user already using the bot's nick.
+        '''
+        nick = message['bot']
+        if not isinstance(nick, str) or nick in self.remotebots or nick in self.bots:
+            return self.log.log(self.loglevels['boterror'], 'Bot %r from bot host %s not added, nick in use' % (nick, host.idstring))
+        hooks = [name for name in message.get('hooks', ()) if callable(getattr(self, name, None))]
+        bot = DCHubRemoteBot(self, host, nick, bool(message.get('op')), bool(message.get('visible', True)),
+          str(message.get('description', '')), hooks)
+        host.bots.add(nick)
+        self.remotebots[nick] = bot
+        for functionname in hooks:
+            self.wrapfunction(functionname, bot.hook(functionname), False, nick)
+        if bot.visible:
+            if nick in self.nicks:
+                self.removeuser(self.nicks[nick])
+            self.nicks[nick] = bot
+            self.users[nick] = bot
+            if bot.op:
+                self.ops[nick] = bot
+            self.updategroups(bot)
+            self.log.log(self.loglevels['userlogin'], 'Bot logged in: %s' % bot.idstring)
+            self.giveHello(bot, newuser = True)
+            self.giveMyINFO(bot)
+            if bot.op:
+                self.giveOpList()
+        self.usercommandcache.clear()
+
+    def rejectconnection(self, connection, curtime):
+        '''Close connections from banned IPs before creating a client for them
+
+        Returns True if the connection was rejected.  Rejections are counted
+        per IP, and once an IP has been rejected tarpitthreshold times, its
+        connections are held open without a response (tarpitted) for a time
+        that doubles with each further rejection, up to maxtarpittime.  IPs
+        in their tarpit time are rejected even if their ban has expired.
+        '''
+        sock, address = connection
+        ip = address[0]
+        record = self.rejectcounts.get(ip)
+        if record is not None and record[1] < curtime - self.maxtarpittime:
+            del self.rejectcounts[ip]
+            record = None
+        if (record is None or record[2] <= curtime) and self.bans.findip(ip, curtime) is None:
+            return False
+        if record is None:
+            record = self.rejectcounts[ip] = [0, curtime, curtime]
+            if self.rejectprunetimer is None:
+                self.rejectprunetimer = self.schedule(self.maxtarpittime, self.prunerejectcounts)
+        record[0] += 1
+        record[1] = curtime
+        self.log.log(self.loglevels['rejectedconnection'], 'Rejected connection %i from banned IP %s' % (record[0], ip))
+        if record[0] >= self.tarpitthreshold:
+            tarpittime = min(self.tarpittime * 2 ** (record[0] - self.tarpitthreshold), self.maxtarpittime)
+            record[2] = curtime + tarpittime
+            if len(self.tarpit) < self.maxtarpitsockets:
+                self.tarpit[sock.fileno()] = sock
+                self.schedule(tarpittime, self.releasetarpit, sock.fileno())
+                return True
+        try:
+            # Reset the connection instead of going through TIME_WAIT
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+            sock.close()
+        except socket.error:
+            pass
+        return True
+
+    def releasesearches(self):
+        '''Send the searches held back by holdsearch'''
+        self.searchtimer = None
+        searches = list(self.heldsearches.values())
+        self.heldsearches.clear()
+        for user, search in searches:
+            if self.users.get(user.nick) is user:
+                self.giveSearch(user, *search)
+
+    def releasetarpit(self, socketid):
+        '''Close a tarpitted connection whose time is up'''
+        sock = self.tarpit.pop(socketid, None)
+        if sock is None:
+            return
+        try:
+            sock.close()
+        except socket.error:
+            pass
 
     def reload(self):
         '''Stop the hub's main loop and mark it to be reloaded'''
@@ -743,27 +1663,261 @@ class DCHub(object):
         self.reloadonexit = True
         self.stop = True
 
-    def removeuser(self, user):
-        '''Remove user from hub and related data structures'''
-        self.log.log(self.loglevels['userremove'], "Removing User: %s" % user.idstring)
-        if hasattr(user, 'socketid') and user.socketid in self.sockets \
-          and self.sockets[user.socketid] is user:
-            del self.sockets[user.socketid]
+    def reloadconfig(self):
+        '''Reread the configuration files, applying only what has changed
+
+        Rereads the conf, accounts, welcome, and usercommands files without
+        reloading the hub or the bots.  Changed options and limits are set in
+        place, the limit profiles are updated (so connected users get the
+        new limits at once), listening sockets are opened and closed to match
+        the bindings, and users are sent the hub name and user commands if
+        those changed.
+        Options in restartoptions only take effect when the hub is restarted.
+        '''
+        self.reloadconfigpending = False
+        self.log.log(self.loglevels['hubstatus'], 'Reloading configuration')
         try:
-            user.close()
+            config, sections, bindings = self.readconfig()
         except:
-            self.log.exception('Error executing user.close for %s' % user.idstring)
-        if user.nick in self.bots and self.bots[user.nick] is user:
-            del self.bots[user.nick]
-        if user.nick in self.nicks and self.nicks[user.nick] is user:
-            del self.nicks[user.nick]
-        if user.nick in self.users and self.users[user.nick] is user:
-            del self.users[user.nick]
+            return self.debugexception('Error reading configuration', self.loglevels['loadfileerror'])
+        changed = []
+        for key, value in config.items():
+            if key in self.filelocations:
+                value = self.filelocation(value)
+            if getattr(self, key) == value:
+                continue
+            if key in self.restartoptions:
+                self.log.log(self.loglevels['hubstatus'], 'Changing %s requires restarting the hub, ignoring new value' % key)
+                continue
+            setattr(self, key, value)
+            changed.append(key)
+        for section, values in sections.items():
+            sectiondict = getattr(self, section)
+            for key, value in values.items():
+                if sectiondict.get(key) != value:
+                    sectiondict[key] = value
+                    changed.append('%s.%s' % (section, key))
+        self.setuplimitprofiles()
+        self.updatelisteningsockets([(self.ip, self.port)] + bindings)
+        if 'name' in changed:
+            self.giveHubName()
+        if 'searchfiles' in changed or 'searchindexfile' in changed:
+            self.searchindex = None
+        if 'tlscertfile' in changed or 'tlskeyfile' in changed or 'tlssessiontickets' in changed:
+            self.setuptls()
+        if 'bansfile' in changed:
+            self.loadbans()
+        if [key for key in changed if key.startswith('spam')]:
+            self.spamsketch = None
+        if 'stallthreshold' in changed or 'stallcheckinterval' in changed:
+            self.stopwatchdog()
+            self.startwatchdog()
+        self.setupexecutor()
+        oldusercommands = dict(self.usercommands)
+        self.loadaccounts()
+        self.loadwelcome()
+        self.loadusercommands()
+        if self.usercommands != oldusercommands:
+            self.giveUserCommand()
+        self.log.log(self.loglevels['hubstatus'], 'Reloaded configuration, changed: %s' % (' '.join(changed) or 'nothing'))
+
+    def removegroup(self, name):
+        '''Remove a group added by addgroup'''
+        self.groupconditions.pop(name, None)
+        self.groups.pop(name, None)
+
+    def removehooks(self, owner):
+        '''Remove the hooks added by owner, compiling the chains again
+
+        Functions left without hooks are restored.
+        '''
+        functionnames = set()
+        for place in self.execbefore, self.execafter:
+            for functionname, hooks in list(place.items()):
+                kept = [hook for hook in hooks if hook.owner != owner]
+                if len(kept) < len(hooks):
+                    functionnames.add(functionname)
+                    if kept:
+                        place[functionname] = kept
+                    else:
+                        del place[functionname]
+        for functionname in functionnames:
+            if functionname in self.execbefore or functionname in self.execafter:
+                self.compilehooks([functionname])
+            elif functionname in self.wrappedfunctions:
+                setattr(self, functionname, self.wrappedfunctions.pop(functionname))
+
+    def removestallloghandler(self):
+        '''Remove and close the stall log's file handler, if there is one
+
+        The stalls logger is kept by the logging module, so the handler has to
+        be removed, or restarting the watchdog would log every stall twice.
+        '''
+        handler = self.stallloghandler
+        if handler is None:
+            return
+        self.stallloghandler = None
+        logging.getLogger('dchub.%s.stalls' % self.id).removeHandler(handler)
+        handler.close()
+
+    def removeuser(self, user):
+        '''Remove user from hub and related data structures
+
+        Inside removeusers, the $Quit is left for removeusers to send.
+        '''
+        if self.detachuser(user):
+            if self.pendingquits is not None:
+                self.pendingquits.append(user)
+                return
             self.giveQuit(user)
-        if user.nick in self.ops and self.ops[user.nick] is user:
-            del self.ops[user.nick]
-        user.loggedin = False
-        user.op = False
+            if self.bothostsockets:
+                self.givebotevent({'event': 'quit', 'nick': user.nick})
+
+    def removeusers(self, users, broadcast = True):
+        '''Remove many users from the hub in one pass
+
+        Removing users one at a time gives every remaining user a $Quit for
+        each of them, so removing most of the hub takes time proportional to
+        the square of the number of users.  Each user is still removed with
+        removeuser (so execbefore and execafter hooks on removeuser run for
+        every user, and can stop a user being removed), but the $Quit
+        messages are collected, and each remaining user is given a single
+        block with all of them, or nothing at all if broadcast is False
+        (used when shutting down).
+        '''
+        if self.pendingquits is not None:
+            # Called from a removeuser hook inside removeusers
+            for user in users:
+                self.removeuser(user)
+            return
+        self.pendingquits = quits = []
+        try:
+            for user in users:
+                try:
+                    self.removeuser(user)
+                except:
+                    self.log.exception('Error removing user %s' % user.idstring)
+        finally:
+            self.pendingquits = None
+        if not quits or not broadcast:
+            return
+        self.giveQuits(quits)
+        if self.bothostsockets:
+            for user in quits:
+                self.givebotevent({'event': 'quit', 'nick': user.nick})
+
+    def restoreupgradestate(self, state, fds):
+        '''Recreate listening sockets and users from the state of the old hub
+
+        Users connected with TLS couldn't be handed over, so the other users
+        are told they have left.
+        '''
+        fds = iter(fds)
+        for location in state['listeners']:
+            listensock = socket.socket(fileno = next(fds))
+            listensock.setblocking(False)
+            self.listensocks[listensock.fileno()] = listensock
+            self.listenlocations[listensock.fileno()] = tuple(location)
+            if tuple(location) in self.tlslocations:
+                self.tlslisteners.add(listensock.fileno())
+        self.bindinglocations[:] = [tuple(location) for location in state['bindinglocations']]
+        curtime = time.time()
+        for jointime, key in state['jointimes']:
+            self.jointimes[key] = jointime
+            self.schedule(jointime + self.joinfloodtime - curtime, self.expirejoin, key)
+        for record in state['users']:
+            sock = socket.socket(fileno = next(fds))
+            user = DCHubClient((sock, (record['ip'], record['port'])))
+            for attr in self.upgradeattrs:
+                setattr(user, attr, record[attr])
+            user.outgoing = OutgoingQueue(self.outgoingstats)
+            user.outgoing.append(bytes(record['outgoing'], 'latin-1'), CONTROL)
+            user.validcommands = self.interncommands(record['validcommands'])
+            user.supports = frozenset(record['supports'])
+            sock.settimeout(0.01)
+            self.setuplimits(user)
+            for name, value in record['limits'].items():
+                if user.limits.get(name) != value:
+                    user.setlimit(name, value)
+            self.sockets[user.socketid] = user
+            user.keepalivetimer = self.schedule(user.lastcommandtime + user.limits['pingtime'] - curtime, self.keepalive, user)
+            if len(user.incoming) > 1:
+                self.queueuser(user)
+            for place in 'nicks', 'users', 'ops':
+                if record[place]:
+                    getattr(self, place)[user.nick] = user
+            if user.nick in self.accounts:
+                if user.loggedin:
+                    user.account = self.accounts[user.nick]
+                elif not user.validcommands:
+                    # Password was being checked when the hub was upgraded
+                    self.giveGetPass(user)
+                    user.validcommands = self.validpasswordcommands
+            if record['users']:
+                self.updategroups(user)
+        if state.get('quits'):
+            message = ''.join(['$Quit %s|' % nick for nick in state['quits']])
+            for nick in state['quits']:
+                self.userlistchanged(nick)
+            for user in self.users.values():
+                user.sendmessage(message)
+
+    def runtimers(self):
+        '''Run the callbacks of timers that are due'''
+        for timer in self.timers.advance():
+            try:
+                timer.callback(*timer.args)
+            except:
+                self.log.exception('Error running timer %r' % timer)
+
+    def savesearchindex(self):
+        '''Save the +find index in a worker thread, if it has changed'''
+        self.searchindexsavetimer = None
+        if self.searchindex is not None and self.searchindex.changed:
+            self.addtask(self.searchindex.save, owner = '+find')
+
+    def schedule(self, delay, callback, *args):
+        '''Call callback(*args) from the main loop in delay seconds
+
+        Returns a Timer that can be given to canceltimer.  Timers have a
+        resolution of a tenth of a second.  Bots should use this instead of
+        checking the time on every pass through the main loop.
+        '''
+        return self.timers.schedule(delay, callback, *args)
+
+    def setaccount(self, nick, password, op = False, args = ''):
+        '''Create or change an account, storing a hash of the password
+
+        A blank password lets the account log in without a password.
+        '''
+        if password:
+            password = hashpassword(password, self.passwordhashiterations)
+        self.accounts.setaccount(nick, password, op, args)
+        self.usercommandcache.clear()
+        if self.accountsbackend == 'ini':
+            self.writefile('accounts')
+
+    def setbans(self, bans):
+        '''Replace the hub's bans
+
+        Bots written for the old hub (such as BanBot) load their ban file
+        themselves and set hub.bans to a dictionary of entry -> banned until
+        time.  The entries of the dictionary replace those of the current
+        BanList, so the hub's ban checks keep working.  They aren't written
+        to the journal, since the bot has just read them from it.
+        '''
+        if isinstance(bans, BanList):
+            self.banlist = bans
+            return
+        banlist = self.banlist
+        for entry in list(banlist):
+            banlist.remove(entry, write = False)
+        for entry, banuntil in bans.items():
+            try:
+                banlist.add(entry, banuntil, write = False)
+            except ValueError:
+                self.log.log(self.loglevels['loadfileerror'], 'Ignoring invalid ban entry: %r' % entry)
+        self.purgebans()
 
     def setupdefaults(self, **kwargs):
         '''Setup default values for hub variables'''
@@ -777,16 +1931,54 @@ class DCHub(object):
         self.reloadmodules = []
         self.nonreloadableattrs = set('''supers stop nonreloadableattrs
             execbefore execafter replacedfunctions wrappedfunctions
-            reloadonexit bots kwargs version'''.split())
+            reloadonexit bots kwargs version upgradefd signalreader
+            signalwriter signalfd'''.split())
         self.port = 411
         self.ip = ''
         self.bindinglocations = []
-        self.listensocks = {}
+        self.listensocks, self.listenlocations = {}, {}
+        # Listening sockets use IPv6 (and IPv4) when the IP is blank if ipv6
+        # is True.  Up to maxacceptspertick connections are accepted from a
+        # listening socket each pass through the main loop
+        self.ipv6 = True
+        self.listenbacklog = 128
+        self.maxacceptspertick = 64
+        # Connection counters (see acceptconnections and updateacceptstats)
+        self.acceptstats = {'accepted': 0, 'rejected': 0, 'errors': 0,
+            'batches': 0, 'fullbatches': 0, 'rate': 0.0, 'listenoverflows': 0,
+            'tlshandshakes': 0, 'tlsresumed': 0, 'tlsfailures': 0}
+        # TLS (nmdcs://) bindings, the listening sockets for them, and the
+        # sockets in the middle of a TLS handshake ([socket, address, waiting
+        # to write, timeout timer])
+        self.tlslocations, self.tlslisteners = set(), set()
+        self.tlscertfile = self.tlskeyfile = ''
+        self.tlscontext = None
+        self.tlssessiontickets = 2
+        self.tlshandshaketimeout = 10.0
+        self.maxtlshandshakes = 100
+        self.handshakes = {}
+        self.lastacceptstats = self.acceptstatstimer = None
+        self.statsinterval = 10.0
         self.debug = True
         self.stop = False
         self.handleslashme = False
         self.notifyspammers = False
         self.reloadonexit = False
+        self.reloadconfigpending = False
+        self.sighupreloadshub = False
+        # Upgrading hands the hub over to a new process (upgradefd is the
+        # Unix socket the new process receives the old hub's state on)
+        self.upgradepending, self.upgraded = False, False
+        self.upgradefd = -1
+        self.upgradetimeout = 30.0
+        self.upgradeattrs = '''nick ip port version description tag speed
+            speedclass email sharesize myinfo lastcommandtime ignoremessages
+            givenicklist starttime supports key loggedin op idstring incoming
+            outgoing limits'''.split()
+        # Options that can't be changed by reloadconfig
+        self.restartoptions = set('''chroot changeuidgid username groupname
+            pidfile debug logfile loglevel usesyslog sysloghost syslogfacility
+            configfile botsdir upgradefd bothosts remotebotsdir stalllogfile'''.split())
         self.kwargs = kwargs
         self.badchars = ''.join([chr(i) for i in list(range(9)) + list(range(14,32)) + [11, 12, 127]])
         self.badsrchars = self.badchars.replace('\x05','')
@@ -798,14 +1990,56 @@ class DCHub(object):
         self.badsearchchars = ' '
         self.validsearchdatatypes = set(range(10))
         self.badnickchars = '$<>% \x09\x0A\x0D'
-        self.supports = 'NoGetINFO NoHello UserCommand UserIP2'.split()
+        self.supports = 'NoGetINFO NoHello UserCommand UserIP2 ZPipe0'.split()
+        # Clients supporting ZPipe0 get messages of at least zpipeminsize
+        # characters (user lists, etc.) compressed with zlib
+        self.zpipe = True
+        self.zpipeminsize = 1024
+        self.zpipelevel = 6
+        # Bumped whenever a user joins, leaves, or changes their MyINFO, so
+        # compressed user lists can be shared until the list changes (see
+        # compressmessage)
+        self.userlistversion = 0
+        self.compressioncache = {}
+        # Compressed MyINFO of every user, given to new users along with the
+        # MyINFO or Quit of the users that have changed since it was made.  It
+        # is dropped when more than zpipemaxchanges (or a tenth of the users)
+        # have changed (see userlistchanged)
+        self.myinfosnapshot = None
+        self.myinfochanges = {}
+        self.zpipemaxchanges = 100
+        # A user's MyINFO changes are broadcast at most once every myinfodelay
+        # seconds (tag changes are sent straight away), and unchanged MyINFOs
+        # aren't broadcast at all (see updatemyinfo)
+        self.myinfodelay = 5.0
+        self.myinfostats = {'broadcast': 0, 'unchanged': 0, 'heldback': 0}
+        self.zpipestats = {'blocks': 0, 'plainbytes': 0, 'compressedbytes': 0,
+            'cputime': 0.0, 'cachehits': 0}
         self.replacedfunctions, self.wrappedfunctions = {}, {}
         self.execbefore, self.execafter = {}, {}
         self.usercommands = {}
-        self.filelocations = 'configfile accountsfile welcomefile usercommandsfile botsdir'.split()
-        self.validusercommands = set('''_ChatMessage _PrivateMessage MyINFO GetINFO
+        # $UserCommand strings by user, op, and account args (see
+        # getusercommands)
+        self.usercommandcache = {}
+        self.filelocations = 'configfile accountsfile welcomefile usercommandsfile botsdir remotebotsdir searchindexfile bansfile'.split()
+        # Bots in remotebotsdir run in bothosts separate processes (see
+        # dc/bothost.py).  Hosts that exit are restarted after
+        # bothostrestarttime seconds, and hosts more than maxbothostbuffer
+        # bytes of events behind are assumed to be hung and restarted.
+        self.remotebotsdir = 'remotebots'
+        self.bothosts = 0
+        self.bothostrestarttime = 5.0
+        self.maxbothostbuffer = 1000000
+        self.bothostsockets, self.remotebots = {}, {}
+        # Commands users may use at each stage of logging in.  Users share
+        # these (and the combinations given by interncommands) instead of
+        # having their own sets
+        self.validusercommands = frozenset('''_ChatMessage _PrivateMessage MyINFO GetINFO
             GetNickList Search SR ConnectToMe RevConnectToMe UserIP'''.split())
-        self.validopcommands = set('OpForceMove Kick Close ReloadBots'.split())
+        self.validopcommands = frozenset('OpForceMove Kick Close ReloadBots'.split())
+        self.validhellocommands = frozenset('Version GetNickList MyINFO'.split())
+        self.validpasswordcommands = frozenset(['MyPass'])
+        self.commandsets = {}
         self.lockstring = 'EXTENDEDPROTOCOLABCABCABCABCABCABC'
         self.privatekeystring = 'py-dchub-%s--' % self.version
         self.name = 'py-dchub'
@@ -818,14 +2052,106 @@ class DCHub(object):
         # Users includs all users that have sent MyINFO
         self.sockets, self.users,  self.ops, self.bots = {}, {}, {}, {}
         self.accounts, self.nicks = {}, {}
-        self.jointimes = []
+        # Groups of logged in users that broadcasts go to, and the condition
+        # for being in each group (see addgroup).  ops is the ops group.
+        self.groups, self.groupconditions = {}, {}
+        self.setupgroups()
+        # Users removed by removeuser while removeusers is running, who are
+        # given one $Quit block at the end (None when not in removeusers)
+        self.pendingquits = None
+        # Account storage backend (ini or sqlite), and the number of accounts
+        # the sqlite backend keeps cached
+        self.accountsbackend = 'ini'
+        self.accountscachesize = 1000
+        # Passwords are stored as PBKDF2 hashes with this many iterations.
+        # Plaintext passwords are replaced with hashes when used if
+        # rehashpasswords is True
+        self.passwordhashiterations = 100000
+        self.rehashpasswords = True
+        # Worker threads for blocking tasks (see addtask)
+        self.numtaskrunners = 4
+        self.maxqueuedtasks = 1000
+        self.maxtasksperowner = 2
+        self.tasktimeout = 30.0
+        self.cleanuptime = 5.0
+        self.executor = TaskExecutor(self.numtaskrunners, self.maxqueuedtasks, self.maxtasksperowner)
+        self.bans = BanList()
+        # Rejected connections per IP ([count, last rejection, tarpitted
+        # until]), and the heap of tarpitted sockets
+        self.rejectcounts, self.tarpit = {}, {}
+        self.rejectprunetimer = None
+        self.tarpitthreshold = 3
+        self.tarpittime = 2.0
+        self.maxtarpittime = 300.0
+        self.maxtarpitsockets = 100
+        # Recent joins (IP or nick -> join time), see joinfloodcheck
+        self.jointimes = {}
+        # Timers for keepalives, ban expiry, and bots (see schedule).  select
+        # waits until the next timer is due, but no more than maxpolltime
+        # seconds
+        self.timers = TimerWheel()
+        self.maxpolltime = 30.0
+        self.maxbanpurgetime = 60.0
+        self.banpurgetimer = None
+        # Users with complete commands waiting to be processed, and the
+        # number of commands processed per user on each pass
+        self.readyusers = deque()
+        self.maxcommandspertick = 10
+        # Load shedding (see updateshedding).  looplag is the smoothed time
+        # each pass through the main loop spends working (not waiting for
+        # network activity).  A level is entered when looplag or the number
+        # of users waiting in the ready queue reaches its thresholds (0
+        # disables that threshold): level 1 holds back searches, level 2
+        # also slows MyINFO broadcasts, and level 3 also pauses logins.
+        self.loadshedding = True
+        self.shedlevel = 0
+        self.looplag = self.selecttime = 0.0
+        self.shedlevel1lag, self.shedlevel1backlog = 0.05, 200
+        self.shedlevel2lag, self.shedlevel2backlog = 0.1, 500
+        self.shedlevel3lag, self.shedlevel3backlog = 0.25, 1000
+        # A level is left once looplag and the backlog are below
+        # shedrecoveryratio times its thresholds, and it has lasted at least
+        # shedholdtime seconds
+        self.shedrecoveryratio = 0.5
+        self.shedholdtime = 5.0
+        self.shedchangetime = 0.0
+        # Searches held back are sent every shedsearchdelay seconds (only the
+        # latest from each user), MyINFOs are broadcast at most every
+        # shedmyinfodelay seconds, and users logging in wait shedloginpause
+        # seconds before their commands are looked at again
+        self.shedsearchdelay = 2.0
+        self.shedmyinfodelay = 30.0
+        self.shedloginpause = 1.0
+        self.heldsearches = {}
+        self.searchtimer = None
+        self.shedstats = {'searchesheld': 0, 'searchescoalesced': 0,
+            'myinfosthrottled': 0, 'loginspaused': 0, 'levelchanges': 0}
+        # Outgoing data is sent to each user at most sendquantum bytes at a
+        # time, and at most sendbudget bytes (0 for no limit) are sent to all
+        # users per pass through the main loop (see handlewritesockets)
+        self.sendquantum = 65536
+        self.sendbudget = 4194304
+        self.nextwriteid = None
+        self.outgoingstats = {'messages': [0] * len(classnames),
+            'bytes': [0] * len(classnames), 'quantumlimited': 0,
+            'budgetlimited': 0}
+        # Stall watchdog (see startwatchdog).  If the main loop is busy for
+        # stallthreshold seconds (0 disables the watchdog), the main thread's
+        # stack and the command being processed are logged to stalllogfile,
+        # which is checked every stallcheckinterval seconds.
+        self.stallthreshold = 2.0
+        self.stallcheckinterval = 0.5
+        self.stalllogfile = ''
+        self.watchdog = self.stallloghandler = None
+        self.currentcommand = None
         self.loglevels = {'wrapping':10, 'datasent':1, 'datareceived':5,
             'newconnection': 10, 'useradderror': 10, 'userdisconnect': 10,
             'socketerror': 10, 'loading': 10, 'loadingdebug': 3,
             'loadfileerror': 40, 'missingfile': 30, 'boterror': 20,
             'userlogin': 10, 'hubstatus': 20, 'userremove': 10,
             'duplicatelogin': 20, 'commanderror':10, 'userloginerror':20,
-            'badcommand':5, 'execchange': 10,}
+            'badcommand':5, 'execchange': 10, 'rejectedconnection': 2,
+            'threading': 8, 'spam': 20}
         self.userlimits = {'maxcommandsize':25000, 'maxqueuedcommands':20,
             'maxcommandspertimeperiod':20, 'maxdescriptionlength':50,
             'maxtaglength':50, 'maxnicklength':25, 'maxemaillength':50,
@@ -833,7 +2159,36 @@ class DCHub(object):
             'maxcharacterspertimeperiod':1000, 'maxmessagespertimeperiod':10,
             'maxnewlinespertimeperiod':10, 'maxsearchespertimeperiod':10,
             'maxsearchsize':500, 'maxmyinfopertimeperiod':3, 'pingtime':300,
-            'timeperiod':60}
+            'maxconnectspertimeperiod':60, 'maxincomingconnectspertimeperiod':300,
+            'connectduplicatetime':10, 'maxsimilarmessages':5, 'timeperiod':60}
+        # Hub wide spam detection (see checkspam).  Chat and private messages
+        # are counted in a sketch spamsketchwidth counters wide, in which
+        # counts halve every spamhalflife seconds.  Messages shorter than
+        # spamminlength characters (once normalized) aren't counted.  If
+        # spamfilterdrop is False, spam is only logged.
+        self.spamfilter = True
+        self.spamfilterdrop = True
+        self.spamsketchwidth = 4096
+        self.spamhalflife = 60.0
+        self.spamminlength = 16
+        self.spamsketch = None
+        # Genie commands handled by the hub itself (see got_Genie)
+        self.hubgeniecommands = frozenset(['find', 'stats', 'hooks', 'talkers'])
+        self.spamstats = {'checked': 0, 'flagged': 0, 'dropped': 0}
+        # ConnectToMe and RevConnectToMe requests forwarded and dropped (see
+        # checkconnectflood)
+        self.connectstats = {'forwarded': 0, 'duplicates': 0,
+            'senderlimited': 0, 'receiverlimited': 0}
+        # Limits that differ from userlimits for ops, users with accounts,
+        # and bots.  Users share the profile for their role (see setuplimits)
+        self.oplimits, self.registeredlimits, self.botlimits = {}, {}, {}
+        self.limitprofiles = {}
+        self.setuplimitprofiles()
+        # Configuration file sections, and the dictionary with their valid
+        # options
+        self.configsections = {'userlimits': 'userlimits',
+            'loglevels': 'loglevels', 'oplimits': 'userlimits',
+            'registeredlimits': 'userlimits', 'botlimits': 'userlimits'}
         # Hub Limits
         self.maxusers = 500
         self.joinfloodtime = 60
@@ -855,6 +2210,38 @@ class DCHub(object):
         self.welcomefile = 'welcome'
         self.usercommandsfile = 'usercommands'
         self.botsdir = 'bots'
+        self.bansfile = 'bans'
+        self.searchindexfile = 'searchindex'
+        # Files searched by +find, and the maximum number of lines returned
+        self.searchfiles = 'board requests dwds'
+        self.maxfindresults = 50
+        # Number of users listed by +talkers
+        self.maxtalkers = 10
+        # The +find index is saved searchindexsaveinterval seconds after it
+        # changes (see findentries)
+        self.searchindexsaveinterval = 300.0
+        self.searchindex = self.searchindexsavetimer = None
+
+    def setupexecutor(self):
+        '''Give the task executor the configured limits'''
+        self.executor.numthreads = self.numtaskrunners
+        self.executor.maxqueued = self.maxqueuedtasks
+        self.executor.maxperowner = self.maxtasksperowner
+
+    def setupgroups(self):
+        '''Add the groups the hub broadcasts to
+
+        ops, registered, active and passive users, users that get $Hello for
+        new users (they don't support NoHello), users that support
+        UserCommand, and ops that support UserIP2.
+        '''
+        self.ops = self.addgroup('ops', lambda user: user.op)
+        self.addgroup('registered', lambda user: getattr(user, 'account', None) is not None)
+        self.addgroup('active', lambda user: 'M:A' in user.tag)
+        self.addgroup('passive', lambda user: 'M:P' in user.tag or 'M:5' in user.tag)
+        self.addgroup('hello', lambda user: 'NoHello' not in user.supports)
+        self.addgroup('usercommand', lambda user: 'UserCommand' in user.supports)
+        self.addgroup('userip2ops', lambda user: user.op and 'UserIP2' in user.supports)
 
     def setuphub(self):
         '''Commands the hub needs to preform when not reloaded'''
@@ -864,17 +2251,52 @@ class DCHub(object):
         self.rootdir = os.path.abspath(os.path.dirname(sys.argv[0]))
         os.chdir(self.rootdir)
         self.loadconfig()
+        self.setupexecutor()
         self.unixconfig()
         self.setuplogging()
+        self.setuptls()
         self.loadaccounts()
+        self.loadbans()
         self.loadwelcome()
         self.loadusercommands()
+        if self.upgradefd >= 0:
+            self.receiveupgrade()
         self.loadbots()
 
+    def setuplimitprofiles(self):
+        '''Update the limit profiles from userlimits and the role limits
+
+        Profiles are updated in place, so users attached to them get the
+        new limits immediately.
+        '''
+        for name, limits in (('default', {}), ('op', self.oplimits),
+          ('registered', self.registeredlimits), ('bot', self.botlimits)):
+            profile = self.limitprofiles.get(name)
+            if profile is None:
+                profile = self.limitprofiles[name] = LimitProfile(name)
+            profile.clear()
+            profile.update(self.userlimits)
+            profile.update(limits)
+
     def setuplimits(self, user):
-        '''Give user the default limits for the hub'''
-        user.limits.clear()
-        user.limits.update(self.userlimits)
+        '''Attach the user to the limit profile for their role
+
+        Bots get the bot profile, ops the op profile, users with accounts the
+        registered profile, and everyone else the default profile.  Limits
+        set for just the user (see DCHubUser.setlimit) are kept.
+        '''
+        if getattr(user, 'isDCHubBot', False):
+            profile = self.limitprofiles['bot']
+        elif getattr(user, 'op', False):
+            profile = self.limitprofiles['op']
+        elif getattr(user, 'account', None) is not None:
+            profile = self.limitprofiles['registered']
+        else:
+            profile = self.limitprofiles['default']
+        if isinstance(user.limits, LimitOverlay):
+            user.limits.profile = profile
+        else:
+            user.limits = profile
 
     def setuplisteningsockets(self):
         '''Setup the listening sockets if it has not already been created'''
@@ -950,19 +2372,53 @@ class DCHub(object):
     def setupsignals(self):
         '''Do an orderly shutdown upon receiving a signal.
 
-        SIGABRT, SIGBREAK, SIGILL, SIGINT, SIGQUIT, SIGTERM, SIGUSR1, and
-        SIGUSR2 all cause an orderly shutdown. SIGHUP will reload the hub (not
-        reread it's config file as other daemons commonly do, due to the fact
-        that handling changes to the various configuration options is often not
-        possible). Other signals aren't caught and will cause the program to
-        terminate immediately.
+        SIGABRT, SIGBREAK, SIGILL, SIGINT, SIGQUIT, SIGTERM, and SIGUSR1 all
+        cause an orderly shutdown. SIGHUP rereads the configuration files (see
+        reloadconfig), or reloads the entire hub if sighupreloadshub is True.
+        SIGUSR2 upgrades the hub to a new process (see upgrade). Other signals
+        aren't caught and will cause the program to terminate immediately.
         '''
         if os.name == 'posix':
             signal.signal(signal.SIGHUP, self.sighuphandler)
-        for sig in 'SIGABRT SIGBREAK SIGILL SIGINT SIGQUIT SIGTERM SIGUSR1 SIGUSR2'.split():
+            signal.signal(signal.SIGUSR2, self.sigusr2handler)
+            # Wake up select when a signal arrives, since it may otherwise
+            # wait up to maxpolltime before the main loop sees the signal
+            if self.signalreader is None:
+                self.signalreader, self.signalwriter = socket.socketpair()
+                self.signalreader.setblocking(False)
+                self.signalwriter.setblocking(False)
+                self.signalfd = self.signalreader.fileno()
+            try:
+                signal.set_wakeup_fd(self.signalwriter.fileno(), warn_on_full_buffer = False)
+            except ValueError:
+                # Only possible in the main thread
+                pass
+        for sig in 'SIGABRT SIGBREAK SIGILL SIGINT SIGQUIT SIGTERM SIGUSR1'.split():
             try: signal.signal(getattr(signal, sig), self.sighandler)
             except: pass
 
+    def setuptls(self):
+        '''Create the TLS context for nmdcs:// bindings from tlscertfile and tlskeyfile
+
+        TLS 1.3 session tickets (tlssessiontickets per handshake) and TLS 1.2
+        tickets let reconnecting clients resume their session instead of
+        doing a full handshake, as long as the hub keeps running.
+        '''
+        self.tlscontext = None
+        if not self.tlscertfile:
+            if self.tlslocations:
+                self.log.log(self.loglevels['hubstatus'], 'No tlscertfile given, TLS connections will be refused')
+            return
+        try:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(self.filelocation(self.tlscertfile), self.tlskeyfile and self.filelocation(self.tlskeyfile) or None)
+            context.options &= ~ssl.OP_NO_TICKET
+            if hasattr(context, 'num_tickets'):
+                context.num_tickets = self.tlssessiontickets
+        except:
+            return self.debugexception('Error setting up TLS', self.loglevels['loadfileerror'])
+        self.tlscontext = context
+
     def sighandler(self, signum, frame):
         '''Set the flag to stop the server normally'''
         if not self.stop and hasattr(self, 'log'):
@@ -970,10 +2426,128 @@ class DCHub(object):
         self.stop = True
 
     def sighuphandler(self, signum, frame):
-        '''Reload the hub on receiving a SIGHUP'''
+        '''Reload the configuration (or the hub) on receiving a SIGHUP
+
+        The configuration is reloaded by the main loop, not inside the signal
+        handler.
+        '''
         if hasattr(self, 'log'):
             self.log.log(self.loglevels['hubstatus'], 'Reloading due to signal %s' % signum)
-        self.reload()
+        if self.sighupreloadshub:
+            self.reload()
+        else:
+            self.reloadconfigpending = True
+
+    def sigusr2handler(self, signum, frame):
+        '''Upgrade the hub on receiving a SIGUSR2
+
+        The upgrade is done by the main loop, not inside the signal handler.
+        '''
+        if hasattr(self, 'log'):
+            self.log.log(self.loglevels['hubstatus'], 'Upgrading due to signal %s' % signum)
+        self.upgradepending = True
+
+    def startbothost(self, index):
+        '''Start bot host process number index
+
+        The host is started with the same python executable, so like
+        upgrade, this doesn't work if the hub has been chrooted to a
+        directory without it.
+        '''
+        if self.stop or index >= self.bothosts:
+            return
+        parent, child = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            args = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bothost.py'),
+              str(child.fileno()), self.remotebotsdir, str(index), str(self.bothosts)]
+            process = subprocess.Popen(args, pass_fds = [child.fileno()])
+        except:
+            parent.close()
+            self.debugexception('Error starting bot host %i' % index, self.loglevels['boterror'])
+            self.schedule(self.bothostrestarttime, self.startbothost, index)
+            return
+        finally:
+            child.close()
+        parent.setblocking(False)
+        host = BotHostConnection(index, process, parent)
+        self.bothostsockets[host.socketid] = host
+        self.log.log(self.loglevels['loading'], 'Started bot host %s' % host.idstring)
+
+    def startbothosts(self):
+        '''Start the bot host processes, if there are any remote bots'''
+        if not self.bothosts:
+            return
+        if not os.path.isdir(self.remotebotsdir):
+            return self.log.log(self.loglevels['missingfile'], 'Remote bots directory does not exist')
+        for index in range(self.bothosts):
+            self.startbothost(index)
+
+    def starthandshake(self, connection):
+        '''Start the TLS handshake for a connection to an nmdcs:// binding
+
+        The handshake proceeds as the socket becomes ready (see
+        continuehandshake), so slow clients don't hold up the hub.  If it
+        doesn't finish within tlshandshaketimeout seconds, the connection is
+        closed.
+        '''
+        sock, address = connection
+        if self.tlscontext is None or len(self.handshakes) >= self.maxtlshandshakes:
+            sock.close()
+            raise ValueError('TLS not set up or too many TLS handshakes in progress')
+        sock.setblocking(False)
+        sslsock = self.tlscontext.wrap_socket(sock, server_side = True, do_handshake_on_connect = False)
+        id = sslsock.fileno()
+        timer = self.schedule(self.tlshandshaketimeout, self.expirehandshake, id, sslsock)
+        self.handshakes[id] = [sslsock, address, False, timer]
+        self.continuehandshake(id)
+
+    def startwatchdog(self):
+        '''Start the stall watchdog thread, unless stallthreshold is 0
+
+        Stalls are logged to stalllogfile, or the main log if it is blank.
+        The watchdog only notices the main loop being busy, not waiting for
+        network activity, so a quiet hub isn't reported as stalled.
+        '''
+        if not self.stallthreshold or self.watchdog is not None:
+            return
+        stalllog = self.log
+        if self.stalllogfile:
+            stalllog = logging.getLogger('dchub.%s.stalls' % self.id)
+            stalllog.setLevel(logging.WARNING)
+            try:
+                self.stallloghandler = logging.FileHandler(self.stalllogfile)
+                self.stallloghandler.setFormatter(self.defaultlogfileformatter)
+                stalllog.addHandler(self.stallloghandler)
+                if os.name == 'posix' and self.changeuidgid:
+                    os.chown(self.stalllogfile, self.uid, self.gid)
+            except:
+                self.log.exception('Error setting up stall log, logging stalls to main log')
+                self.removestallloghandler()
+                stalllog = self.log
+        self.watchdog = StallWatchdog(stalllog, self.stallthreshold, self.stallcheckinterval, self.describestall)
+        self.watchdog.start()
+
+    def stopbothost(self, host, restart = True):
+        '''Stop a bot host and remove its bots, restarting it unless restart is False'''
+        if self.bothostsockets.get(host.socketid) is not host:
+            return
+        del self.bothostsockets[host.socketid]
+        try:
+            host.close()
+        except:
+            self.debugexception('Error stopping bot host %s' % host.idstring, self.loglevels['boterror'])
+        for nick in list(host.bots):
+            if nick in self.remotebots:
+                self.removeuser(self.remotebots[nick])
+        if restart:
+            self.schedule(self.bothostrestarttime, self.startbothost, host.index)
+
+    def stopwatchdog(self):
+        '''Stop the stall watchdog thread, if it is running'''
+        if self.watchdog is not None:
+            self.watchdog.stop()
+            self.watchdog = None
+        self.removestallloghandler()
 
     def stringoverlaps(self, string1, string2):
         '''Check if any character in either string is in the other string
@@ -1027,10 +2601,14 @@ class DCHub(object):
 
     def unloadbots(self):
         '''Remove all bots and unwrap related functions'''
-        for bot in self.bots.values():
-            self.removeuser(bot)
+        self.removeusers(list(self.bots.values()))
         self.unwrapfunctions()
 
+    def unparkuser(self, user):
+        '''Return a parked user to the ready queue'''
+        user.ready = False
+        self.queueuser(user)
+
     def unwrapfunctions(self):
         '''Restore default hub functions'''
         for functionname, function in self.wrappedfunctions.items():
@@ -1044,22 +2622,238 @@ class DCHub(object):
         self.wrappedfunctions.clear()
         self.replacedfunctions.clear()
 
-    def wrapfunction(self, functionname, function, execbefore):
+    def updateacceptstats(self):
+        '''Update the accept rate and listen overflow count every statsinterval
+
+        The listen overflow count is the number of connections the kernel
+        dropped since the hub started because a listen backlog was full.
+        It counts every program on the system, and is only available on
+        Linux.
+        '''
+        self.acceptstatstimer = None
+        stats = self.acceptstats
+        curtime = time.time()
+        overflows = self.readlistenoverflows()
+        if self.lastacceptstats is not None:
+            lasttime, lastaccepted, lastoverflows = self.lastacceptstats
+            if curtime > lasttime:
+                stats['rate'] = (stats['accepted'] - lastaccepted) / (curtime - lasttime)
+            if overflows is not None and lastoverflows is not None:
+                stats['listenoverflows'] += max(overflows - lastoverflows, 0)
+        self.lastacceptstats = (curtime, stats['accepted'], overflows)
+        self.acceptstatstimer = self.schedule(self.statsinterval, self.updateacceptstats)
+
+    def updategroups(self, user):
+        '''Put a logged in user in the groups whose conditions they meet
+
+        Called when the user logs in and when their supports, MyINFO, or op
+        status change, so each check only costs a condition per group.
+        Bots that change something a group depends on should call this.
+        detachuser removes users from every group.
+        '''
+        for name, condition in self.groupconditions.items():
+            group = self.groups[name]
+            try:
+                member = condition(user)
+            except:
+                self.debugexception('Error checking group %s for %s' % (name, user.idstring), self.loglevels['boterror'])
+                member = False
+            if member:
+                group[user.nick] = user
+            elif group.get(user.nick) is user:
+                del group[user.nick]
+
+    def updatelisteningsockets(self, locations):
+        '''Open and close listening sockets so the hub listens on the locations'''
+        self.bindinglocations[:] = locations
+        for id, location in list(self.listenlocations.items()):
+            if location not in locations or (id in self.tlslisteners) != (location in self.tlslocations):
+                self.log.log(self.loglevels['hubstatus'], 'No longer listening on %s:%s' % location)
+                self.listensocks.pop(id).close()
+                del self.listenlocations[id]
+                self.tlslisteners.discard(id)
+        listening = set(self.listenlocations.values())
+        for ip, port in locations:
+            if (ip, port) in listening:
+                continue
+            try:
+                self.createlisteningsocket(ip, port)
+            except socket.error:
+                self.debugexception('Error listening on %s:%s' % (ip, port), self.loglevels['hubstatus'])
+            else:
+                listening.add((ip, port))
+                self.log.log(self.loglevels['hubstatus'], 'Listening on %s:%s' % (ip, port))
+
+    def updatemyinfo(self, user):
+        '''Broadcast a logged in user's new MyINFO
+
+        MyINFOs identical to the last one broadcast are dropped.  After a
+        broadcast, changes within myinfodelay seconds are held back, and only
+        the latest is broadcast when the delay is over.  Changes to the tag
+        (client, mode, hubs and slots) are broadcast straight away, unless
+        the hub is shedding load, which also lengthens the delay.
+        '''
+        stats = self.myinfostats
+        if user.myinfo == user.sentmyinfo:
+            stats['unchanged'] += 1
+            return
+        # Tag changes aren't broadcast early while shedding load
+        throttled = self.shedlevel >= 2
+        if user.myinfotimer is not None and (throttled or user.tag == user.senttag):
+            stats['heldback'] += 1
+            return
+        stats['broadcast'] += 1
+        self.giveMyINFO(user)
+        delay = self.myinfodelay
+        if throttled:
+            self.shedstats['myinfosthrottled'] += 1
+            delay = max(delay, self.shedmyinfodelay)
+        if delay > 0:
+            self.canceltimer(user.myinfotimer)
+            user.myinfotimer = self.schedule(delay, self.flushmyinfo, user)
+
+    def updateshedding(self, busytime):
+        '''Update the loop lag and change the load shedding level if needed
+
+        busytime is the time the last pass through the main loop spent
+        working.  The level goes up as soon as the loop lag or the number of
+        users waiting in the ready queue reaches a higher level's thresholds,
+        and down one level at a time once both are well below the current
+        level's thresholds (see shedrecoveryratio and shedholdtime).
+        '''
+        self.looplag += (busytime - self.looplag) * 0.2
+        if not self.loadshedding and not self.shedlevel:
+            return
+        backlog = len(self.readyusers)
+        thresholds = [(self.shedlevel1lag, self.shedlevel1backlog),
+          (self.shedlevel2lag, self.shedlevel2backlog),
+          (self.shedlevel3lag, self.shedlevel3backlog)]
+        level = 0
+        if self.loadshedding:
+            for i, (lag, waiting) in enumerate(thresholds):
+                if (lag > 0 and self.looplag >= lag) or (waiting > 0 and backlog >= waiting):
+                    level = i + 1
+        curtime = time.time()
+        if level < self.shedlevel:
+            lag, waiting = thresholds[self.shedlevel - 1]
+            ratio = self.shedrecoveryratio
+            if self.loadshedding and (curtime - self.shedchangetime < self.shedholdtime
+              or (lag > 0 and self.looplag >= lag * ratio) or (waiting > 0 and backlog >= waiting * ratio)):
+                return
+            level = self.shedlevel - 1
+        if level == self.shedlevel:
+            return
+        self.log.log(self.loglevels['hubstatus'], 'Load shedding level %i -> %i (loop lag %.1fms, %i users waiting)' % (self.shedlevel, level, self.looplag * 1000, backlog))
+        self.shedlevel = level
+        self.shedchangetime = curtime
+        self.shedstats['levelchanges'] += 1
+        if not level and self.heldsearches:
+            self.canceltimer(self.searchtimer)
+            self.releasesearches()
+
+    def upgrade(self):
+        '''Hand the hub over to a new process running the current code
+
+        Starts the hub program again with the same arguments, and passes it
+        the state of every user (including queued data) and the file
+        descriptors of the listening and client sockets over a Unix socket.
+        Once the new process has taken over, this hub exits without closing
+        any connections, so users don't notice the upgrade.  Bots are
+        reloaded by the new process.  If anything goes wrong, the new
+        process is killed and this hub keeps running.
+
+        The new process is started with the same python executable, so this
+        doesn't work if the hub has been chrooted to a directory without it.
+        '''
+        self.upgradepending = False
+        self.log.log(self.loglevels['hubstatus'], 'Upgrading hub')
+        process = None
+        parent, child = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            try:
+                state, fds = self.getupgradestate()
+                command, cwd = self.upgradecommand()
+                args = [arg for arg in sys.argv[1:] if not arg.startswith('--upgradefd=')]
+                process = subprocess.Popen(command + args + ['--upgradefd=%i' % child.fileno()],
+                  pass_fds = [child.fileno()], cwd = cwd)
+                child.close()
+                parent.settimeout(self.upgradetimeout)
+                sendstate(parent, state, fds)
+                if parent.recv(2) != b'OK':
+                    raise ValueError('new hub did not accept the upgrade')
+            finally:
+                child.close()
+                parent.close()
+        except:
+            self.log.exception('Error upgrading hub, continuing to run')
+            if process is not None and process.poll() is None:
+                process.kill()
+            return
+        self.log.log(self.loglevels['hubstatus'], 'Hub upgraded, handed over to process %i' % process.pid)
+        self.upgraded = True
+        self.stop = True
+
+    def upgradecommand(self):
+        '''Return the command that starts the hub program, and the directory
+        to run it in (None for the current directory)
+
+        If the hub was started with python -m (such as python -m dc.main),
+        the new process is started the same way, from the directory
+        containing the package, since the hub has changed to the directory
+        of the module itself.  Otherwise the script is run again.
+        '''
+        spec = getattr(sys.modules['__main__'], '__spec__', None)
+        if spec is None or not spec.name:
+            # setuphub has changed to the script's directory (rootdir)
+            return [sys.executable, os.path.join(self.rootdir, os.path.basename(sys.argv[0]))], None
+        top = sys.modules[spec.name.split('.')[0]]
+        if hasattr(top, '__path__'):
+            cwd = os.path.dirname(os.path.abspath(list(top.__path__)[0]))
+        else:
+            cwd = os.path.dirname(os.path.abspath(top.__file__))
+        return [sys.executable, '-m', spec.name], cwd
+
+    def userlistchanged(self, nick):
+        '''Record that a user has joined, left, or changed their MyINFO
+
+        Invalidates the cached compressed user lists, and drops the MyINFO
+        snapshot once so many users have changed that it isn't worth using.
+        '''
+        self.userlistversion += 1
+        if self.myinfosnapshot is not None:
+            self.myinfochanges.pop(nick, None)
+            self.myinfochanges[nick] = True
+            if len(self.myinfochanges) > max(self.zpipemaxchanges, len(self.users) // 10):
+                self.myinfosnapshot = None
+                self.myinfochanges.clear()
+
+    def wrapfunction(self, functionname, function, execbefore, owner = None, compile = True):
         '''Set new function to execute before/after hub function
 
-        If function has not already been wrapped, wrap the function with a
-        decorator.  Add the old function to the list of wrapped functions.
+        owner is the nick of the bot adding the function, shown with the
+        hook's statistics.  Unless compile is False, the hub function is
+        compiled into a new chain of hooks straight away (loadbots compiles
+        every chain once all the bots have been added).
         '''
-        if functionname not in self.wrappedfunctions:
-            oldfunction = getattr(self, functionname)
-            self.wrappedfunctions[functionname] = oldfunction
-            setattr(self, functionname, self._execwrapper(oldfunction))
         place = self.execafter
         if execbefore:
             place = self.execbefore
         if functionname not in place:
             place[functionname] = []
-        place[functionname].append(function)
+        place[functionname].append(Hook(functionname, function, owner, execbefore))
+        if compile:
+            self.compilehooks([functionname])
+
+    def writebothost(self, host):
+        '''Send queued events to a bot host'''
+        try:
+            sentsize = host.socket.send(host.outgoing)
+        except BlockingIOError:
+            return
+        except socket.error:
+            self.log.log(self.loglevels['boterror'], 'Error sending events to bot host %s' % host.idstring)
+            return self.stopbothost(host)
+        del host.outgoing[:sentsize]
 
     def writefile(self, type):
         '''Write file of specified type to disk
@@ -1079,9 +2873,9 @@ class DCHub(object):
             assert os.path.isfile(filename)
             try:
                 icp = getattr(self, '%sparser' % type)
-                oldfil = file(filename, 'rb')
+                oldfil = open(filename, 'r')
                 try:
-                    fil = file('%s.new' % filename, 'wb')
+                    fil = open('%s.new' % filename, 'w')
                     try:
                         fil.write(icp.get_config(oldfil))
                     finally:
@@ -1089,7 +2883,7 @@ class DCHub(object):
                 finally: oldfil.close()
             except AttributeError:
                 text = getattr(self, type)
-                fil = file('%s.new' % filename, 'wb')
+                fil = open('%s.new' % filename, 'w')
                 try:
                     fil.write(text)
                 finally:
@@ -1150,10 +2944,16 @@ class DCHub(object):
         numnewlines = sum([messageinfo[2] for messageinfo in user.recentmessages]) + numnl
         if numnewlines >= user.limits['maxnewlinespertimeperiod']:
             raise ValueError( 'too many newlines within time period')
-        user.recentmessages.append((curtime, messagesize, numnl, message))
+        # Genie commands are often the same for many users, so they aren't
+        # checked for spam (other messages starting with + are)
+        if not self.isgeniecommand(message):
+            self.checkspam(user, message)
+        user.recentmessages.append((curtime, messagesize, numnl))
 
     def got_ChatMessage(self, user, nick, message, *args):
         self.give_ChatMessage(user, message)
+        if self.bothostsockets:
+            self.givebotevent({'event': 'chat', 'nick': user.nick, 'message': message})
         if message.startswith('+'):
             self.got_Genie(user,message,'sendmessage')
         if message.startswith('!tvinfo'):
@@ -1161,16 +2961,23 @@ class DCHub(object):
 
     ######### JohnDoe %TVInfo Handles These Commands
     def got_TVInfo(self, user, message):
+        # TVInfo looks shows up online, so it runs in a worker thread and
+        # give_TVInfo sends the reply
+        if message.startswith('!tvinfo'):
+            message = ''
         try:
-       	    if message.startswith('!tvinfo'):
-                taskStat = getattr(self.bots['TVInfo'],'tvinfo')('')
-            else:
-                taskStat = getattr(self.bots['TVInfo'],'tvinfo')(message)
-            self.log.log(self.loglevels['hubstatus'],'User:%s issued %s. Status:Success.'%(user.nick,message))
-            self.give_PrivateMessage(self.bots['TVInfo'],user,'%s|'%(taskStat))
+            bot = self.bots['TVInfo']
+            self.addtask(bot.tvinfo, (message, ), callback = lambda task: self.give_TVInfo(bot, user, message, task), owner = bot.nick)
         except Exception as e:
             self.log.log(self.loglevels['hubstatus'],'User:%s issued %s. Exception:%s'%(user.nick,message,e))
-            self.give_PrivateMessage(self.bots['TVInfo'],user,'Some unexpected error Occured. Cut the programmer some slack.|')
+
+    def give_TVInfo(self, bot, user, message, task):
+        if task.error is None:
+            self.log.log(self.loglevels['hubstatus'],'User:%s issued %s. Status:Success.'%(user.nick,message))
+            self.give_PrivateMessage(bot,user,'%s|'%(task.result))
+        else:
+            self.log.log(self.loglevels['hubstatus'],'User:%s issued %s. Exception:%s'%(user.nick,message,task.error))
+            self.give_PrivateMessage(bot,user,'Some unexpected error Occured. Cut the programmer some slack.|')
 	################################################
 
     ######### JohnDoe %Genie Handles These Commands
@@ -1178,6 +2985,14 @@ class DCHub(object):
         messageParts = message.split()
         userCommand = messageParts[0][1:]
         userCommandArgs = ' '.join(messageParts[1:])+'\r\n'
+        if userCommand == 'find':
+            return self.got_Find(user, ' '.join(messageParts[1:]), messageType)
+        if userCommand == 'stats' and user.op:
+            return self.got_Stats(user, messageType)
+        if userCommand == 'hooks' and user.op:
+            return self.got_Hooks(user, messageType)
+        if userCommand == 'talkers' and user.op:
+            return self.got_Talkers(user, messageType)
         if userCommand in self.bots['Genie'].genie:
             if messageType == 'sendmessage':
                 user.sendmessage('<Hub-Genie> %s, you issued a +%s command. Your word is my command!|'%(user.nick,userCommand))
@@ -1195,6 +3010,100 @@ class DCHub(object):
                 self.give_PrivateMessage(self.bots['Genie'],user,'%s, I will ignore that and pretend you never said that. If you want something done, speak to me in a language I understand. %s |'%(user.nick,self.bots['Genie'].availableCommands))
     ########## JohnDoe
 
+    def got_Find(self, user, terms, messageType):
+        # The search runs in a worker thread, and give_Find replies
+        try:
+            self.findentries(terms, lambda task: self.give_Find(user, terms, messageType, task))
+        except:
+            self.debugexception('Error searching for %r' % terms, self.loglevels['commanderror'])
+            self.give_GenieReply(user, 'Search failed, try again later.', messageType)
+
+    def give_Find(self, user, terms, messageType, task):
+        '''Give the user the board/request lines matching the search terms'''
+        results = task.result
+        if task.error is not None:
+            self.log.log(self.loglevels['commanderror'], 'Error searching for %r: %r' % (terms, task.error))
+            results = None
+        if results is None:
+            message = 'Search failed, try again later.'
+        elif not results:
+            message = 'Nothing found for: %s' % terms
+        else:
+            message = 'Found %i entries for: %s\r\n%s' % (len(results), terms,
+              '\r\n'.join(['[%s] %s' % (os.path.basename(filename), line) for filename, line in results]))
+        self.give_GenieReply(user, message, messageType)
+
+    def got_Hooks(self, user, messageType):
+        '''Give an op the calls and time taken by each bot hook, slowest first'''
+        hooks = [hook for hooks in list(self.execbefore.values()) + list(self.execafter.values()) for hook in hooks]
+        if not hooks:
+            return self.give_GenieReply(user, 'No bot hooks are active.', messageType)
+        hooks.sort(key = lambda hook: hook.totaltime, reverse = True)
+        lines = []
+        for hook in hooks:
+            lines.append('%s %s %s (%s): %i calls, %.3fs total, %.1fus per call, changed outcome %i times' % (
+              hook.owner, hook.before and 'before' or 'after', hook.functionname,
+              getattr(hook.function, '__name__', hook.function), hook.calls, hook.totaltime,
+              1000000.0 * hook.totaltime / max(hook.calls, 1), hook.changes))
+        self.give_GenieReply(user, 'Bot hooks:\r\n%s' % '\r\n'.join(lines), messageType)
+
+    def got_Stats(self, user, messageType):
+        '''Give an op the hub's connection counters'''
+        stats = self.acceptstats
+        message = ('Connections accepted: %(accepted)i (%(rate).1f/s), rejected: %(rejected)i, '
+          'accept errors: %(errors)i\r\nAccept batches: %(batches)i, batches that hit '
+          'maxacceptspertick: %(fullbatches)i, listen backlog overflows: %(listenoverflows)i' % stats)
+        message += '\r\nTLS handshakes: %(tlshandshakes)i (%(tlsresumed)i resumed), failed: %(tlsfailures)i' % stats
+        message += ('\r\nMyINFO updates broadcast: %(broadcast)i, dropped as unchanged: %(unchanged)i, '
+          'held back: %(heldback)i' % self.myinfostats)
+        stats = self.zpipestats
+        if stats['blocks']:
+            message += ('\r\nZPipe blocks compressed: %i, %i bytes to %i (%.1f%%) in %.3fs CPU, '
+              'cached blocks reused: %i' % (stats['blocks'], stats['plainbytes'], stats['compressedbytes'],
+              100.0 * stats['compressedbytes'] / max(stats['plainbytes'], 1), stats['cputime'], stats['cachehits']))
+        message += ('\r\nLoad shedding level: %i, loop lag: %.1fms, users waiting: %i\r\nSearches held back: %i '
+          '(%i replaced by newer ones), MyINFO broadcasts slowed: %i, logins paused: %i, level changes: %i' % (
+          (self.shedlevel, self.looplag * 1000, len(self.readyusers)) + tuple([self.shedstats[key] for key in
+          ('searchesheld', 'searchescoalesced', 'myinfosthrottled', 'loginspaused', 'levelchanges')])))
+        message += ('\r\nMessages checked for spam: %(checked)i, like too many recent messages: %(flagged)i, '
+          'dropped: %(dropped)i' % self.spamstats)
+        waiting = [0] * len(classnames)
+        for client in self.sockets.values():
+            for cls, size in enumerate(client.outgoing.waiting()):
+                waiting[cls] += size
+        stats = self.outgoingstats
+        message += '\r\nOutgoing messages (queued, bytes queued, bytes waiting): %s' % ', '.join(['%s: %i, %i, %i' %
+          (name, stats['messages'][cls], stats['bytes'][cls], waiting[cls]) for cls, name in enumerate(classnames)])
+        message += ('\r\nUsers limited to sendquantum: %(quantumlimited)i, passes that used up sendbudget: %(budgetlimited)i' % stats)
+        if self.watchdog is not None:
+            message += ('\r\nMain loop stalls: %i, longest: %.1fs\r\nMain loop pass times: %s' %
+              (self.watchdog.stalls, self.watchdog.longeststall, ', '.join(self.watchdog.histogramlines()) or 'none'))
+        message += '\r\nConnected sockets: %i, users: %i' % (len(self.sockets), len(self.users))
+        self.give_GenieReply(user, message, messageType)
+
+    def got_Talkers(self, user, messageType):
+        '''Give an op the users sending and receiving the most connection requests
+
+        Counts ConnectToMe and RevConnectToMe requests forwarded within each
+        user's time period.
+        '''
+        curtime = time.time()
+        senders, receivers = [], []
+        for client in self.sockets.values():
+            timelimit = curtime - client.limits['timeperiod']
+            sent = len([connecttime for connecttime in client.connecttimes if connecttime > timelimit])
+            received = len([connecttime for connecttime in client.incomingconnecttimes if connecttime > timelimit])
+            if sent:
+                senders.append((sent, client.nick))
+            if received:
+                receivers.append((received, client.nick))
+        senders.sort(reverse = True)
+        receivers.sort(reverse = True)
+        message = ('Connection requests forwarded: %(forwarded)i, dropped as duplicates: %(duplicates)i, '
+          'dropped for flooding: %(senderlimited)i (sender), %(receiverlimited)i (receiver)' % self.connectstats)
+        message += '\r\nTop senders: %s' % (', '.join(['%s (%i)' % (nick, count) for count, nick in senders[:self.maxtalkers]]) or 'none')
+        message += '\r\nTop receivers: %s' % (', '.join(['%s (%i)' % (nick, count) for count, nick in receivers[:self.maxtalkers]]) or 'none')
+        self.give_GenieReply(user, message, messageType)
 
     def bad_ChatMessage(self, user, args, parsedargs = None):
         if self.notifyspammers and parsedargs is not None:
@@ -1218,6 +3127,8 @@ class DCHub(object):
             raise ValueError( 'bad sent from')
         if sentto not in self.users:
             raise ValueError( 'bad sent to')
+        if not hasattr(self.users[sentto], 'isDCHubBot'):
+            self.checkspam(user, message)
 
     def got_PrivateMessage(self, user, sentto, sentfrom, nick, message, *args):
         self.give_PrivateMessage(user, self.users[sentto], message)
@@ -1251,6 +3162,7 @@ class DCHub(object):
     def checkConnectToMe(self, user, nick, ip, port, *args):
         if nick not in self.users:
             raise ValueError( 'bad nick')
+        self.checkconnectflood(user, self.users[nick], ('ConnectToMe', nick, ip, port))
 
     def gotConnectToMe(self, user, nick, ip, port, *args):
         self.giveConnectToMe(user, self.users[nick], ip, port)
@@ -1375,7 +3287,8 @@ class DCHub(object):
             except:
                 self.debugexception('Error logging in user', self.loglevels['userloginerror'])
         else:
-            self.giveMyINFO(user)
+            self.updategroups(user)
+            self.updatemyinfo(user)
 
     def badMyINFO(self, user, args, parsedargs = None):
         if not user.loggedin:
@@ -1396,18 +3309,55 @@ class DCHub(object):
         return (password, )
 
     def checkMyPass(self, user, password, *args):
-        if password != self.accounts[user.nick]['password']:
+        # Passwords are checked in a worker thread, and gotPasswordCheck
+        # finishes processing the command.  The checks have no owner, so
+        # logins can use every worker thread.  If too many tasks are queued,
+        # the user is disconnected instead of being told the password is bad
+        user.validcommands = self.interncommands(())
+        try:
+            self.addtask(verifypassword, (password, self.accounts[user.nick]['password'], self.passwordhashiterations),
+              callback = lambda task: self.handlepasswordcheck(user, password, task))
+        except ValueError:
+            self.log.log(self.loglevels['userloginerror'], 'Too many queued tasks to check the password for %s, disconnecting' % user.idstring)
+            self.removeuser(user)
+        return False
+
+    def handlepasswordcheck(self, user, password, task):
+        if self.sockets.get(getattr(user, 'socketid', None)) is not user:
+            # User disconnected while the password was being checked
+            return
+        if task.timedout:
+            # The password may well be right, so don't say it isn't
+            self.log.log(self.loglevels['userloginerror'], 'Password check timed out for %s, disconnecting' % user.idstring)
+            return self.removeuser(user)
+        try:
+            if task.error is not None:
+                raise task.error
+            valid, newhash = task.result
+            self.gotPasswordCheck(user, password, valid, newhash)
+        except:
+            self.debugexception('Error checking password for %s' % user.idstring, self.loglevels['commanderror'])
+            self.badMyPass(user, password, (password, ))
+
+    def gotPasswordCheck(self, user, password, valid, newhash):
+        if not valid:
             raise ValueError( 'bad pass')
+        if newhash is not None and self.rehashpasswords:
+            account = self.accounts[user.nick]
+            self.accounts.setaccount(user.nick, newhash, account['op'], account['args'])
+            if self.accountsbackend == 'ini':
+                self.writefile('accounts')
         if user.nick in self.nicks and self.nicks[user.nick] is not user:
             self.log.log(self.loglevels['duplicatelogin'], 'Duplicate correct login, removing current user %s, adding new user %s' % (self.nicks[user.nick].idstring, user.idstring))
             self.removeuser(self.nicks[user.nick])
+        self.gotMyPass(user, password)
 
     def gotMyPass(self, user, password, *args):
         self.nicks[user.nick] = user
         if self.accounts[user.nick]['op']:
             self.giveLogedIn(user)
         self.giveHello(user)
-        user.validcommands = set('Version GetNickList MyINFO'.split())
+        user.validcommands = self.validhellocommands
 
     def badMyPass(self, user, args, parsedargs = None):
         self.giveBadPass(user)
@@ -1450,6 +3400,7 @@ class DCHub(object):
             raise ValueError( 'bad sender')
         if receiver not in self.users:
             raise ValueError( 'badreceiver')
+        self.checkconnectflood(user, self.users[receiver], ('RevConnectToMe', receiver))
 
     def gotRevConnectToMe(self, user, sender, receiver, *args):
         self.giveRevConnectToMe(user, self.users[receiver])
@@ -1495,6 +3446,8 @@ class DCHub(object):
         user.searchtimes.append(curtime)
 
     def gotSearch(self, user, host, sizerestricted, isminimumsize, size, datatype, searchpattern, *args):
+        if self.shedlevel >= 1:
+            return self.holdsearch(user, (host, sizerestricted, isminimumsize, size, datatype, searchpattern))
         self.giveSearch(user, host, sizerestricted, isminimumsize, size, datatype, searchpattern)
 
     def badSearch(self, user, args, parsedargs = None):
@@ -1548,12 +3501,15 @@ class DCHub(object):
         return (supports, )
 
     def checkSupports(self, user, supports, *args):
-        supports = [feature for feature in supports if feature in self.supports]
+        hubsupports = self.getsupports()
+        supports = frozenset([feature for feature in supports if feature in hubsupports])
         return (supports, )
 
     def gotSupports(self, user, supports, *args):
         user.supports = supports
-        if self.supports:
+        if user.loggedin:
+            self.updategroups(user)
+        if self.getsupports():
             self.giveSupports(user)
 
     def badSupports(self, user, args, parsedargs = None):
@@ -1600,6 +3556,8 @@ class DCHub(object):
                     raise ValueError( 'nick already in use')
         elif self.stringoverlaps(nick, self.badnickchars):
             raise ValueError( 'bad nick character')
+        if self.bans.isnickbanned(nick):
+            raise ValueError( 'banned nick')
 
     def gotValidateNick(self, user, nick, *args):
         user.nick = nick
@@ -1608,11 +3566,11 @@ class DCHub(object):
             if not self.accounts[nick]['password']:
                 return self.gotMyPass(user, '')
             self.giveGetPass(user)
-            user.validcommands = set(['MyPass'])
+            user.validcommands = self.validpasswordcommands
         else:
             self.nicks[nick] = user
             self.giveHello(user)
-            user.validcommands = set('Version GetNickList MyINFO'.split())
+            user.validcommands = self.validhellocommands
 
     def badValidateNick(self, user, args, parsedargs = None):
         self.giveValidateDenide(user)
@@ -1651,6 +3609,13 @@ class DCHub(object):
         '''Send an empty command to a user (as a keep alive)'''
         user.sendmessage('|')
 
+    def give_GenieReply(self, user, message, messageType):
+        '''Reply to a + command in private (from Genie) or in main chat'''
+        if messageType == 'give_PrivateMessage' and 'Genie' in self.bots:
+            self.give_PrivateMessage(self.bots['Genie'], user, message)
+        else:
+            user.sendmessage('<Hub-Genie> %s|' % message)
+
     def give_HubFullRedirect(self, user):
         '''Give the user a redirect, and ignore the user afterwards'''
         user.sendmessage('$ForceMove %s|' % self.hubredirectwhenfull)
@@ -1712,8 +3677,8 @@ class DCHub(object):
         '''
         message = '$Hello %s|' % user.nick
         if newuser:
-            for client in self.users.values():
-                if client is not user and 'NoHello' not in client.supports:
+            for client in self.groups['hello'].values():
+                if client is not user:
                     client.sendmessage(message)
         else:
             user.sendmessage(message)
@@ -1750,18 +3715,45 @@ class DCHub(object):
         If newuser is True, give that user the MyINFO for everyuser in the hub
         '''
         if newuser:
-            message = []
-            for user in self.users.values():
-                message.append(user.myinfo)
-            message = ''.join(message)
-            client.sendmessage(message)
+            self.givemyinfos(client)
+        client.sentmyinfo, client.senttag = client.myinfo, client.tag
+        self.userlistchanged(client.nick)
         myinfo = client.myinfo
         for user in self.users.values():
             user.sendmessage(myinfo)
 
+    def givemyinfos(self, client):
+        '''Give the client the MyINFO of every user
+
+        Clients supporting ZPipe0 get the compressed snapshot of the MyINFOs
+        (made again if it has been dropped, see userlistchanged), followed by the MyINFO or Quit of each user that has changed since.
+        '''
+        if 'ZPipe0' not in client.supports or not self.zpipe:
+            client.sendmessage(''.join([user.myinfo for user in self.users.values()]))
+            return
+        if self.myinfosnapshot is None:
+            message = ''.join([user.myinfo for user in self.users.values()])
+            if len(message) < self.zpipeminsize:
+                client.sendmessage(message)
+                return
+            self.myinfosnapshot = self.compressmessage(message)
+            self.myinfochanges.clear()
+        else:
+            self.zpipestats['cachehits'] += 1
+        client.sendraw(self.myinfosnapshot)
+        changes = []
+        for nick in self.myinfochanges:
+            user = self.users.get(nick)
+            if user is None:
+                changes.append('$Quit %s|' % nick)
+            else:
+                changes.append(user.myinfo)
+        if changes:
+            self.givezpipe(client, ''.join(changes))
+
     def giveNickList(self, user):
         '''Give the nick list to the user'''
-        user.sendmessage('$NickList %s$$|' % '$$'.join(self.users.keys()))
+        self.givezpipe(user, '$NickList %s$$|' % '$$'.join(self.users.keys()), 'NickList')
 
     def giveOpList(self, user = None):
         '''Give the op list to a user or the all users
@@ -1782,6 +3774,15 @@ class DCHub(object):
     def giveQuit(self, user):
         '''Give hub a message that the user has disconnected'''
         message = '$Quit %s|' % user.nick
+        self.userlistchanged(user.nick)
+        for client in self.users.values():
+            client.sendmessage(message)
+
+    def giveQuits(self, users):
+        '''Give hub one block of messages that the users have disconnected'''
+        message = ''.join(['$Quit %s|' % user.nick for user in users])
+        for user in users:
+            self.userlistchanged(user.nick)
         for client in self.users.values():
             client.sendmessage(message)
 
@@ -1799,9 +3800,21 @@ class DCHub(object):
         '''Give search response from resulter to searcher'''
         searcher.sendmessage('$SR %s %s\x05%i %i/%i\x05%s (%s)|'% (resulter.nick, path, filesize, freeslots, totalslots, hubname, hubhost))
 
+    def givezpipe(self, user, message, key = None):
+        '''Give message to user, compressed if the user supports ZPipe0
+
+        Messages shorter than zpipeminsize are sent as they are.  If key is
+        given, the compressed message is shared with other users given the
+        same message until the user list changes (see compressmessage).
+        '''
+        if not self.zpipe or 'ZPipe0' not in user.supports or len(message) < self.zpipeminsize:
+            user.sendmessage(message)
+            return
+        user.sendraw(self.compressmessage(message, key))
+
     def giveSupports(self, user):
         '''Give user a list of extensions that the server supports'''
-        user.sendmessage('$Supports %s|' % ' '.join(self.supports))
+        user.sendmessage('$Supports %s|' % ' '.join(self.getsupports()))
 
     def giveUserCommand(self, user = None, command = None):
         '''Give user command(s) to user or hub
@@ -1814,13 +3827,11 @@ class DCHub(object):
         '''
         if user is None:
             if command is None:
-                for user in self.users.values():
-                    if 'UserCommand' in user.supports:
-                        user.sendmessage(self.getusercommands(user))
+                for user in self.groups['usercommand'].values():
+                    user.sendmessage(self.getusercommands(user))
             else:
-                for user in self.users.values():
-                    if 'UserCommand' in user.supports:
-                        user.sendmessage(self.getusercommand(user, command))
+                for user in self.groups['usercommand'].values():
+                    user.sendmessage(self.getusercommand(user, command))
         else:
             if command is None:
                 command = self.getusercommands(user)
@@ -1841,12 +3852,11 @@ class DCHub(object):
         if requestor is not None and requestee is not None:
             requestor.sendmessage('$UserIP %s %s|' % (requestee.nick, requestee.ip))
         elif requestor is not None:
-            requestor.sendmessage('$UserIP %s$$|' % '$$'.join(['%s %s' % (user.nick, user.ip) for user in self.users.values()]))
+            self.givezpipe(requestor, '$UserIP %s$$|' % '$$'.join(['%s %s' % (user.nick, user.ip) for user in self.users.values()]), 'UserIP')
         elif requestee is not None:
             message = '$UserIP %s %s|' % (requestee.nick, requestee.ip)
-            for op in self.ops.values():
-                if 'UserIP2' in op.supports:
-                    op.sendmessage(message)
+            for op in self.groups['userip2ops'].values():
+                op.sendmessage(message)
 
     def giveValidateDenide(self, user):
         '''Give a user a message that their login has been denied'''
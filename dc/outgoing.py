@@ -0,0 +1,172 @@
+CONTROL, CHAT, SEARCH, BULK = range(4)
+classnames = ('control', 'chat', 'search', 'bulk')
+
+# Class of each command (the text between $ and the first space or |).
+# Commands that change the user list share a class, so they can't be
+# reordered relative to each other (a Quit can't overtake the user's
+# MyINFO).  Other commands are control messages.
+commandclasses = {'To:': CHAT, 'Search': SEARCH, 'SR': SEARCH,
+    'MyINFO': BULK, 'Quit': BULK, 'Hello': BULK, 'NickList': BULK,
+    'OpList': BULK, 'UserIP': BULK, 'ZOn': BULK}
+
+# Chat messages longer than this (such as long +find replies) are bulk
+maxchatsize = 4096
+
+# Small messages in the same class are joined into chunks of up to this size
+chunksize = 16384
+
+def messageclass(message):
+    '''Return the priority class of a message (or several joined messages)'''
+    first = message[:1]
+    if first == '<' or first == '*':
+        return CHAT if len(message) <= maxchatsize else BULK
+    if first != '$':
+        return CONTROL
+    end = message.find('|', 1, 13)
+    space = message.find(' ', 1, 13)
+    if space != -1 and (end == -1 or space < end):
+        end = space
+    cls = commandclasses.get(message[1:end], CONTROL)
+    if cls == CHAT and len(message) > maxchatsize:
+        return BULK
+    return cls
+
+class OutgoingQueue(object):
+    '''Data waiting to be sent to a client, in priority classes
+
+    Messages are queued in their class (see messageclass), and sent control
+    first, then chat, search, and bulk (user lists).  Messages are only
+    reordered between classes, so messages in the same class are sent in
+    the order they were queued.  Small messages in a class are joined into
+    chunks, and long runs of messages are split into chunks between
+    messages, so another class can go first between chunks but never in the
+    middle of a message.  Raw data (such as a compressed ZPipe0 block) is
+    kept in one chunk.
+
+    Data for the next send is moved from the classes into current, so data
+    queued while earlier data is still being sent waits for at most what is
+    already in current (about one send's worth).  A chunk that is only
+    partly moved is finished before anything else is moved.
+
+    If stats is given, it is a dictionary with 'messages' and 'bytes' lists
+    that are increased for each class as messages are queued.
+    '''
+    __slots__ = ('classes', 'current', 'partial', 'offset', 'size', 'stats')
+
+    def __init__(self, stats = None):
+        # Lists of chunks for each class, a tuple of lists once anything
+        # has been queued in a class
+        self.classes = ()
+        self.current = bytearray()
+        # Class whose first chunk has been partly moved to current, and how
+        # much of it has been moved
+        self.partial = None
+        self.offset = 0
+        self.size = 0
+        self.stats = stats
+
+    def __len__(self):
+        return self.size
+
+    def append(self, data, cls = BULK, raw = False):
+        '''Queue data (bytes holding whole messages) in the given class
+
+        If raw is True, data isn't split between messages.
+        '''
+        size = len(data)
+        self.size += size
+        if self.stats is not None:
+            self.stats['messages'][cls] += 1
+            self.stats['bytes'][cls] += size
+        if not self.classes:
+            if len(self.current) + size <= chunksize:
+                # Nothing is waiting, so small messages go straight to current
+                self.current += data
+                return
+            self.classes = ([], [], [], [])
+        chunks = self.classes[cls]
+        if size >= chunksize:
+            if raw:
+                chunks.append(data)
+                return
+            start = 0
+            while size - start > chunksize:
+                end = data.rfind(b'|', start, start + chunksize) + 1
+                if end <= start:
+                    end = data.find(b'|', start + chunksize) + 1 or size
+                chunks.append(data[start:end])
+                start = end
+            if start < size:
+                chunks.append(data[start:])
+        elif chunks and isinstance(chunks[-1], bytearray) and len(chunks[-1]) + size <= chunksize:
+            chunks[-1] += data
+        else:
+            chunks.append(bytearray(data))
+
+    def fill(self, limit):
+        '''Move data into current, highest priority first, until current
+        has limit bytes or nothing else is waiting'''
+        current = self.current
+        classes = self.classes
+        while len(current) < limit:
+            cls = self.partial
+            if cls is None:
+                for cls, chunks in enumerate(classes):
+                    if chunks:
+                        break
+                else:
+                    break
+            chunks = classes[cls]
+            chunk, offset = chunks[0], self.offset
+            end = offset + limit - len(current)
+            if offset or end < len(chunk):
+                with memoryview(chunk) as view:
+                    current += view[offset:end]
+            else:
+                current += chunk
+            if end < len(chunk):
+                self.partial, self.offset = cls, end
+            else:
+                del chunks[0]
+                self.partial, self.offset = None, 0
+        if len(current) == self.size:
+            self.classes = ()
+
+    def getvalue(self):
+        '''Return everything waiting to be sent, in the order it would be sent'''
+        data = bytearray(self.current)
+        if self.partial is not None:
+            data += self.classes[self.partial][0][self.offset:]
+        for cls, chunks in enumerate(self.classes):
+            for chunk in chunks[cls == self.partial:]:
+                data += chunk
+        return data
+
+    def send(self, sock, limit):
+        '''Send up to limit bytes with sock.send, returning the bytes sent
+
+        The data sent is left at the start of current until sent is called,
+        so it can be logged.
+        '''
+        if len(self.current) < limit and self.classes:
+            self.fill(limit)
+        current = self.current
+        if len(current) <= limit:
+            return sock.send(current)
+        with memoryview(current) as view:
+            with view[:limit] as part:
+                return sock.send(part)
+
+    def sent(self, size):
+        '''Remove size bytes that have been sent from current'''
+        del self.current[:size]
+        self.size -= size
+
+    def waiting(self):
+        '''Return the number of bytes waiting in each class (not in current)'''
+        if not self.classes:
+            return [0, 0, 0, 0]
+        waiting = [sum([len(chunk) for chunk in chunks]) for chunks in self.classes]
+        if self.partial is not None:
+            waiting[self.partial] -= self.offset
+        return waiting
@@ -39,7 +39,7 @@ class IntelConfigParser(RawConfigParser):
                     sections.remove(currentsection)
                 currentsection = strippedline[1:-1]
                 if currentsection in sections:
-                    items = dict([(unicode(item[0]).strip(), unicode(item[1]).strip()) for item in self.items(currentsection)])
+                    items = dict([(str(item[0]).strip(), str(item[1]).strip()) for item in self.items(currentsection)])
                 else:
                     # Section was removed from the configuration, so delete
                     # all related lines
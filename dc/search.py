@@ -0,0 +1,190 @@
+import os
+import re
+import zlib
+import pickle
+import threading
+from array import array
+
+class SearchIndex(object):
+    '''Inverted index over line based text files (read board, requests, etc.)
+
+    Each line of the indexed files is broken into tokens (release name parts,
+    IMDb IDs such as tt1321870, TTH hashes from magnet links, nicks, etc.), and
+    every token maps to the line numbers containing it.  Only the byte offsets
+    of lines are kept in memory, matching lines are read back from the files
+    themselves.
+
+    The files are expected to grow by appending lines (even if they are
+    rewritten through a temporary file, as Genie does).  update only indexes
+    the new lines in that case, and only rebuilds the index for a file if the
+    already indexed part of it has changed (or the file has been rewritten
+    at the same size, which its modification time shows).  The index is
+    saved to indexfile so that it doesn't need to be rebuilt on startup.
+
+    find and save can take seconds on large files, so the hub runs them in
+    worker threads.  Both hold lock, so they never run at the same time.
+    '''
+    version = 1
+    tokenpattern = re.compile(r'[0-9a-z]+')
+    # Number of bytes before the indexed offset used to check that the
+    # already indexed part of a file hasn't been changed
+    checksize = 256
+
+    def __init__(self, filenames, indexfile):
+        self.filenames = filenames
+        self.indexfile = indexfile
+        self.files = {}
+        self.loaded = False
+        self.changed = False
+        self.lock = threading.Lock()
+
+    def checksum(self, fil, offset):
+        '''Return the checksum of the bytes in fil just before offset'''
+        fil.seek(max(offset - self.checksize, 0))
+        return zlib.crc32(fil.read(offset - fil.tell()))
+
+    def find(self, terms, limit = 50):
+        '''Return the last limit (filename, line) pairs that contain all terms
+
+        The index is brought up to date first, but not saved (see save).
+        '''
+        with self.lock:
+            if not self.loaded:
+                self.load()
+            self.update()
+            return self.search(terms, limit)
+
+    def getlines(self, filename, linenumbers):
+        '''Read the given lines from the file, opening it once'''
+        offsets = self.files[filename]['lines']
+        fil = open(filename, 'rb')
+        try:
+            lines = []
+            for linenumber in linenumbers:
+                fil.seek(offsets[linenumber])
+                lines.append(fil.readline().decode('utf-8', 'replace').rstrip('\r\n'))
+            return lines
+        finally:
+            fil.close()
+
+    def indexlines(self, entry, fil, start):
+        '''Index all complete lines in fil starting at byte offset start'''
+        fil.seek(start)
+        data = fil.read()
+        end = data.rfind(b'\n') + 1
+        lines, postings = entry['lines'], entry['postings']
+        offset = start
+        for line in data[:end].split(b'\n')[:-1]:
+            linenumber = len(lines)
+            lines.append(offset)
+            offset += len(line) + 1
+            for token in set(self.tokenize(line.decode('utf-8', 'replace'))):
+                if token not in postings:
+                    postings[token] = array('I')
+                postings[token].append(linenumber)
+        if end or not start:
+            entry['offset'] = start + end
+            entry['check'] = self.checksum(fil, entry['offset'])
+            self.changed = True
+
+    def load(self):
+        '''Load the saved index from disk, starting with an empty index on errors'''
+        self.loaded = True
+        if not os.path.isfile(self.indexfile):
+            return
+        try:
+            fil = open(self.indexfile, 'rb')
+            try:
+                data = pickle.loads(zlib.decompress(fil.read()))
+            finally:
+                fil.close()
+        except Exception:
+            return
+        if data.get('version') == self.version:
+            self.files = data['files']
+
+    def save(self):
+        '''Write the index to disk if it has changed'''
+        with self.lock:
+            if not self.changed:
+                return
+            data = zlib.compress(pickle.dumps({'version': self.version, 'files': self.files}, pickle.HIGHEST_PROTOCOL))
+            fil = open('%s.new' % self.indexfile, 'wb')
+            try:
+                fil.write(data)
+            finally:
+                fil.close()
+            os.rename('%s.new' % self.indexfile, self.indexfile)
+            self.changed = False
+
+    def search(self, terms, limit = 50):
+        '''Return the last limit (filename, line) pairs in the index that
+        contain all terms, without updating the index'''
+        tokens = set(self.tokenize(terms))
+        if not tokens:
+            return []
+        results = []
+        for filename in self.filenames:
+            entry = self.files.get(filename)
+            if entry is None:
+                continue
+            postings = []
+            for token in tokens:
+                linenumbers = entry['postings'].get(token)
+                if linenumbers is None:
+                    break
+                postings.append(linenumbers)
+            else:
+                # Intersect starting with the rarest token
+                postings.sort(key = len)
+                matches = set(postings[0])
+                for linenumbers in postings[1:]:
+                    matches.intersection_update(linenumbers)
+                results.extend([(filename, linenumber) for linenumber in sorted(matches)])
+        results = results[-limit:]
+        found = []
+        for filename in self.filenames:
+            linenumbers = [linenumber for resultfile, linenumber in results if resultfile == filename]
+            if linenumbers:
+                found.extend(zip([filename] * len(linenumbers), self.getlines(filename, linenumbers)))
+        return found
+
+    def tokenize(self, text):
+        '''Break text into lowercase alphanumeric tokens
+
+        Splitting on everything that isn't a letter or digit breaks release
+        names (Some.Show.S01E02.720p) into their parts, and leaves IMDb IDs
+        and the base32 hashes in magnet links (xt=urn:tree:tiger:HASH) as
+        single tokens.
+        '''
+        return [token for token in self.tokenpattern.findall(text.lower()) if len(token) > 1]
+
+    def update(self):
+        '''Index lines added to the files since the last update
+
+        The index isn't saved, so saving can be done less often (see save).
+        '''
+        for filename in self.filenames:
+            if not os.path.isfile(filename):
+                if filename in self.files:
+                    del self.files[filename]
+                    self.changed = True
+                continue
+            entry = self.files.get(filename)
+            stat = os.stat(filename)
+            if entry is not None and entry['offset'] == stat.st_size and entry.get('mtime') == stat.st_mtime_ns:
+                continue
+            fil = open(filename, 'rb')
+            try:
+                start = 0
+                if entry is not None and entry['offset'] < stat.st_size:
+                    if self.checksum(fil, entry['offset']) == entry['check']:
+                        start = entry['offset']
+                if not start:
+                    entry = self.files[filename] = {'offset': 0, 'check': 0, 'lines': array('I'), 'postings': {}}
+                self.indexlines(entry, fil, start)
+            finally:
+                fil.close()
+            if entry.get('mtime') != stat.st_mtime_ns:
+                entry['mtime'] = stat.st_mtime_ns
+                self.changed = True
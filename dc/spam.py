@@ -0,0 +1,130 @@
+import re
+import math
+import heapq
+from array import array
+
+class SpamSketch(object):
+    '''Hub wide count of similar chat messages, in bounded memory
+
+    Messages are normalized (lower case, only letters and digits, digits all
+    the same, runs of a character collapsed), so spam that only changes case,
+    punctuation, spacing or numbers normalizes to the same text.  Every
+    shinglesize character window of the normalized text is hashed with a
+    rolling (Rabin-Karp) hash, and the numfingerprints smallest hashes are
+    the message's fingerprints, so messages that share most of their text
+    (such as spam with a random nick or suffix added) share most of their
+    fingerprints.  A message is scored by the median count of its
+    fingerprints, so messages that only share a common phrase (and so at
+    most a few fingerprints) aren't counted as copies of each other.
+
+    Fingerprints are counted in a count-min sketch of depth rows of width
+    counters.  Counts decay with a half life of halflife seconds, which is
+    done by adding ever larger amounts instead of shrinking every counter
+    (the counters are rescaled when the amounts get large).  Memory use is
+    fixed, and estimates can only be too high (by hash collisions), never
+    too low.
+    '''
+    normalizepattern = re.compile(r'[\W_]+')
+    repeatpattern = re.compile(r'(.)\1+')
+    digits = str.maketrans('123456789', '000000000')
+    modulus = (1 << 61) - 1
+    base = 1000003
+    multipliers = (0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9,
+        0xD6E8FEB86659FD93, 0xFF51AFD7ED558CCD, 0xC4CEB9FE1A85EC53,
+        0x27D4EB2F165667C5, 0x94D049BB133111EB)
+
+    def __init__(self, width = 4096, depth = 4, halflife = 60.0,
+      shinglesize = 10, numfingerprints = 8, minlength = 16, curtime = 0.0):
+        if depth > len(self.multipliers):
+            raise ValueError('depth can be at most %i' % len(self.multipliers))
+        # The width is rounded up to a power of two, so counters can be
+        # picked with the top bits of a multiplicative hash
+        self.bits = max(width - 1, 1).bit_length()
+        self.width = 1 << self.bits
+        self.depth = depth
+        self.halflife = halflife
+        self.shinglesize = shinglesize
+        self.numfingerprints = numfingerprints
+        self.minlength = minlength
+        self.rows = [array('d', bytes(8 * self.width)) for i in range(depth)]
+        # Counts added at starttime have weight 1, and weights double every
+        # halflife seconds after that
+        self.starttime = curtime
+        self.dropfactor = pow(self.base, shinglesize - 1, self.modulus)
+
+    def add(self, fingerprints, curtime):
+        '''Count the fingerprints, returning the median estimated count'''
+        if curtime - self.starttime > 32 * self.halflife:
+            self.rescale(curtime)
+        weight = self.weight(curtime)
+        counts = []
+        for fingerprint in fingerprints:
+            count = None
+            for row, index in zip(self.rows, self.indexes(fingerprint)):
+                row[index] += weight
+                if count is None or row[index] < count:
+                    count = row[index]
+            counts.append(count)
+        return self.median(counts) / weight
+
+    def estimate(self, fingerprints, curtime):
+        '''Return the median estimated count of the fingerprints'''
+        if curtime - self.starttime > 32 * self.halflife:
+            self.rescale(curtime)
+        counts = [min([row[index] for row, index in zip(self.rows, self.indexes(fingerprint))])
+            for fingerprint in fingerprints]
+        return self.median(counts) / self.weight(curtime)
+
+    def fingerprints(self, message):
+        '''Return the message's fingerprints, or [] if it is too short'''
+        text = self.normalize(message)
+        if len(text) < self.minlength:
+            return []
+        modulus, base, dropfactor = self.modulus, self.base, self.dropfactor
+        codes = [ord(char) for char in text]
+        size = self.shinglesize
+        value = 0
+        for code in codes[:size]:
+            value = (value * base + code) % modulus
+        hashes = {value}
+        for i in range(size, len(codes)):
+            value = ((value - codes[i - size] * dropfactor) * base + codes[i]) % modulus
+            hashes.add(value)
+        return heapq.nsmallest(self.numfingerprints, hashes)
+
+    def indexes(self, fingerprint):
+        '''Return the counter used for the fingerprint in each row'''
+        shift = 64 - self.bits
+        return [((fingerprint * multiplier) & 0xFFFFFFFFFFFFFFFF) >> shift
+            for multiplier in self.multipliers[:self.depth]]
+
+    def median(self, counts):
+        '''Return the median of counts (the lower middle one if there are an
+        even number), or 0 if there are none'''
+        if not counts:
+            return 0.0
+        return sorted(counts)[(len(counts) - 1) // 2]
+
+    def normalize(self, message):
+        '''Return the text of message that is compared with other messages'''
+        text = self.normalizepattern.sub('', message.lower()).translate(self.digits)
+        return self.repeatpattern.sub(r'\1', text)
+
+    def rescale(self, curtime):
+        '''Make counts added at curtime have weight 1 again
+
+        Counts that would have decayed to nothing are just cleared.
+        '''
+        halflives = (curtime - self.starttime) / self.halflife
+        if halflives > 64:
+            self.rows = [array('d', bytes(8 * self.width)) for i in range(self.depth)]
+        else:
+            weight = math.pow(2.0, halflives)
+            for row in self.rows:
+                for i in range(self.width):
+                    row[i] /= weight
+        self.starttime = curtime
+
+    def weight(self, curtime):
+        '''Return the weight of a count added at curtime'''
+        return math.pow(2.0, (curtime - self.starttime) / self.halflife)
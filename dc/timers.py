@@ -0,0 +1,132 @@
+import time
+
+class Timer(object):
+    '''Callback scheduled on a TimerWheel'''
+    __slots__ = ('tick', 'callback', 'args', 'cancelled')
+
+    def __init__(self, tick, callback, args):
+        self.tick = tick
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def __repr__(self):
+        return '<Timer %s%r>' % (getattr(self.callback, '__name__', self.callback), self.args)
+
+class TimerWheel(object):
+    '''Hierarchical timer wheel
+
+    Time is divided into ticks of resolution seconds.  The first wheel has a
+    slot for each of the next numslots ticks, the second wheel a slot for
+    each of the next numslots groups of numslots ticks, and so on.  Timers
+    are put in the slot for their tick, and when the first wheel completes a
+    revolution, the timers in the next slot of the second wheel are moved
+    down into the first wheel (and so on for the other wheels).  Scheduling
+    and cancelling timers takes constant time, and advancing only looks at
+    timers that are due or need to move to a lower wheel.
+
+    Cancelled timers are left in their slots and skipped when they come up.
+    '''
+    def __init__(self, resolution = 0.1, numslots = 256, numwheels = 4, curtime = None):
+        if curtime is None:
+            curtime = time.time()
+        self.resolution = resolution
+        self.numslots = numslots
+        self.wheels = [[[] for i in range(numslots)] for j in range(numwheels)]
+        self.maxticks = numslots ** numwheels - 1
+        self.tick = int(curtime / resolution)
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, timer):
+        '''Put the timer in the slot for its tick'''
+        delta = max(timer.tick - self.tick, 0)
+        if delta > self.maxticks:
+            timer.tick = self.tick + self.maxticks
+            delta = self.maxticks
+        tick = timer.tick
+        for wheel in self.wheels:
+            if delta < self.numslots:
+                wheel[tick % self.numslots].append(timer)
+                return
+            delta //= self.numslots
+            tick //= self.numslots
+
+    def advance(self, curtime = None):
+        '''Move time forward, returning the timers that are now due'''
+        if curtime is None:
+            curtime = time.time()
+        target = int(curtime / self.resolution)
+        due = []
+        if not self.count:
+            self.tick = max(self.tick, target)
+            return due
+        numslots = self.numslots
+        first = self.wheels[0]
+        while self.tick < target and self.count:
+            self.tick += 1
+            tick = self.tick
+            # Cascade timers from the higher wheels when the lower ones wrap
+            level = 1
+            while tick % numslots == 0 and level < len(self.wheels):
+                tick //= numslots
+                slot = self.wheels[level][tick % numslots]
+                timers = slot[:]
+                del slot[:]
+                for timer in timers:
+                    if not timer.cancelled:
+                        self.add(timer)
+                level += 1
+            slot = first[self.tick % numslots]
+            if slot:
+                timers = slot[:]
+                del slot[:]
+                for timer in timers:
+                    if timer.cancelled:
+                        continue
+                    if timer.tick <= self.tick:
+                        # Due timers are marked cancelled, so cancelling
+                        # them from their callback (or later) does nothing
+                        timer.cancelled = True
+                        self.count -= 1
+                        due.append(timer)
+                    else:
+                        slot.append(timer)
+        self.tick = max(self.tick, target)
+        return due
+
+    def cancel(self, timer):
+        '''Stop the timer from running (does nothing if it has already run)'''
+        if timer is not None and not timer.cancelled:
+            timer.cancelled = True
+            self.count -= 1
+
+    def nextdelay(self, curtime = None, maxdelay = 60.0):
+        '''Return the number of seconds until the next timer may be due
+
+        Only looks at the first wheel, so if the first wheel is empty, returns
+        the time until timers will be moved down from the second wheel (or
+        maxdelay, if that is smaller).
+        '''
+        if curtime is None:
+            curtime = time.time()
+        if not self.count:
+            return maxdelay
+        first = self.wheels[0]
+        for i in range(1, self.numslots + 1):
+            tick = self.tick + i
+            if tick % self.numslots == 0:
+                break
+            for timer in first[tick % self.numslots]:
+                if not timer.cancelled:
+                    return min(max(tick * self.resolution - curtime, 0), maxdelay)
+        return min(max((self.tick + i) * self.resolution - curtime, 0), maxdelay)
+
+    def schedule(self, delay, callback, *args):
+        '''Schedule callback(*args) to run in delay seconds, returning the Timer'''
+        timer = Timer(self.tick + max(int(-(-delay // self.resolution)), 1), callback, args)
+        self.add(timer)
+        self.count += 1
+        return timer
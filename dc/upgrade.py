@@ -0,0 +1,45 @@
+import json
+import socket
+import struct
+
+# Linux refuses to pass more than 253 file descriptors in one message
+maxfdspermessage = 250
+
+def receiveexactly(sock, size):
+    '''Receive exactly size bytes from the socket'''
+    data = []
+    while size:
+        chunk = sock.recv(min(size, 65536))
+        if not chunk:
+            raise EOFError('connection closed while receiving upgrade state')
+        data.append(chunk)
+        size -= len(chunk)
+    return b''.join(data)
+
+def receivestate(sock):
+    '''Receive the hub state and file descriptors sent by sendstate
+
+    Returns the state and the list of file descriptors, in the order they
+    were given to sendstate.
+    '''
+    size, numfds = struct.unpack('!II', receiveexactly(sock, 8))
+    state = json.loads(receiveexactly(sock, size).decode('utf-8'))
+    fds = []
+    while len(fds) < numfds:
+        message, newfds, flags, address = socket.recv_fds(sock, 4, maxfdspermessage)
+        if not message:
+            raise EOFError('connection closed while receiving file descriptors')
+        fds.extend(newfds)
+    return state, fds
+
+def sendstate(sock, state, fds):
+    '''Send the hub state (anything JSON can encode) and file descriptors
+
+    The state is sent as a length prefixed JSON document, followed by the
+    file descriptors in batches passed with SCM_RIGHTS.
+    '''
+    data = json.dumps(state).encode('utf-8')
+    sock.sendall(struct.pack('!II', len(data), len(fds)) + data)
+    for i in range(0, len(fds), maxfdspermessage):
+        batch = fds[i:i + maxfdspermessage]
+        socket.send_fds(sock, [struct.pack('!I', len(batch))], batch)
@@ -1,7 +1,54 @@
 import time
 
+class LimitProfile(dict):
+    '''Named set of limits shared by every user attached to it
+
+    The hub keeps one profile per role (see DCHub.setuplimits), and users
+    refer to their role's profile instead of having their own limits.
+    Changing a profile changes the limits of all users attached to it, so
+    use DCHubUser.setlimit to change the limits of a single user.
+    '''
+    __slots__ = ('name', )
+
+    def __init__(self, name, limits = ()):
+        dict.__init__(self, limits)
+        self.name = name
+
+class LimitOverlay(dict):
+    '''Limits set for a single user on top of a shared LimitProfile
+
+    Only the limits set for the user are stored, so iterating over an
+    overlay only gives those.  Other limits are looked up in the profile,
+    so changes to the profile still apply to the user.
+    '''
+    __slots__ = ('profile', )
+
+    def __init__(self, profile, limits = ()):
+        dict.__init__(self, limits)
+        self.profile = profile
+
+    def __contains__(self, name):
+        return dict.__contains__(self, name) or name in self.profile
+
+    def __missing__(self, name):
+        return self.profile[name]
+
+    def get(self, name, default = None):
+        if dict.__contains__(self, name):
+            return dict.__getitem__(self, name)
+        return self.profile.get(name, default)
+
 class DCHubUser(object):
-    '''Any user of a DC Hub (client or bot)'''
+    '''Any user of a DC Hub (client or bot)
+
+    Attributes are kept in slots instead of a dictionary to keep the memory
+    used per user down on large hubs.  Subclasses without __slots__ (such as
+    bots) get a dictionary as usual.
+    '''
+    __slots__ = ('nick', 'version', 'description', 'tag', 'ip', 'speed',
+        'speedclass', 'email', 'sharesize', 'myinfo', 'lastcommandtime',
+        'keepalivetimer', 'ignoremessages', 'givenicklist', 'starttime',
+        'supports', 'limits', 'sentmyinfo', 'senttag', 'myinfotimer')
 
     def __init__(self):
         self.nick = None
@@ -15,16 +62,36 @@ class DCHubUser(object):
         self.sharesize = 0
         self.myinfo = ''
         self.lastcommandtime = time.time()
+        # Timer for the next keepalive (see DCHub.keepalive)
+        self.keepalivetimer = None
         self.ignoremessages = False
         self.givenicklist = False
         self.starttime = time.time()
-        self.supports = []
-        # Limits for each user, usually the same as the hub's defaults
+        # Extensions from $Supports the hub also supports
+        self.supports = frozenset()
+        # Limits for the user, a LimitProfile shared with other users, or a
+        # LimitOverlay if any limits have been set for just this user
         self.limits = {}
+        # MyINFO and tag last broadcast to the hub, and timer for broadcasting
+        # changes held back since then (see DCHub.updatemyinfo)
+        self.sentmyinfo = self.senttag = ''
+        self.myinfotimer = None
 
     def close(self):
         pass
 
+    def setlimit(self, name, value):
+        '''Change one of the user's limits without affecting other users
+
+        The first time, the user gets an overlay on top of their profile.
+        '''
+        if not isinstance(self.limits, LimitOverlay):
+            self.limits = LimitOverlay(self.limits)
+        self.limits[name] = value
+
     def sendmessage(self, message):
         pass
 
+    def sendraw(self, data, cls = None):
+        pass
+
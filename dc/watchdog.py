@@ -0,0 +1,95 @@
+import sys
+import time
+import bisect
+import threading
+import traceback
+
+class StallWatchdog(object):
+    '''Thread that reports when the hub's main loop stops making progress
+
+    The main loop calls busy when select returns and idle just before it
+    calls select again, so waiting for network activity doesn't count as a
+    stall.  Every interval seconds, the watchdog thread checks how long the
+    main loop has been busy, and once that reaches threshold seconds, it
+    logs the main thread's stack (from sys._current_frames) and whatever
+    describe returns (such as the command being processed), once per stall.
+
+    The main loop also gives record the time each pass spent working, which
+    is counted in a histogram with buckets ending at the given bounds (in
+    seconds, with a final bucket for longer passes).
+    '''
+    def __init__(self, log, threshold = 2.0, interval = None, describe = None,
+      bounds = (0.01, 0.05, 0.1, 0.5, 1, 2, 5, 10, 30)):
+        self.log = log
+        self.threshold = threshold
+        self.interval = interval or threshold / 4.0
+        self.describe = describe
+        self.bounds = bounds
+        self.histogram = [0] * (len(bounds) + 1)
+        self.stalls = 0
+        self.longeststall = 0.0
+        # When the main loop became busy (time.monotonic), None while idle
+        self.busysince = None
+        self.reportedsince = None
+        self.threadid = threading.current_thread().ident
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def busy(self):
+        '''Record that the main loop has started working'''
+        self.busysince = time.monotonic()
+
+    def idle(self):
+        '''Record that the main loop is waiting for network activity'''
+        self.busysince = None
+
+    def record(self, busytime):
+        '''Count the time a pass through the main loop spent working'''
+        self.histogram[bisect.bisect_left(self.bounds, busytime)] += 1
+        if busytime >= self.threshold:
+            self.stalls += 1
+            self.longeststall = max(self.longeststall, busytime)
+
+    def histogramlines(self):
+        '''Return the histogram as a list of "<= bound: count" strings'''
+        labels = ['<= %gs' % bound for bound in self.bounds] + ['> %gs' % self.bounds[-1]]
+        return ['%s: %i' % (label, count) for label, count in zip(labels, self.histogram) if count]
+
+    def run(self):
+        '''Check the main loop every interval seconds until stopped'''
+        while not self.stopping.wait(self.interval):
+            since = self.busysince
+            if since is None or since == self.reportedsince:
+                continue
+            stalled = time.monotonic() - since
+            if stalled < self.threshold:
+                continue
+            self.reportedsince = since
+            frame = sys._current_frames().get(self.threadid)
+            if frame is None:
+                stack = '(main thread has exited)\n'
+            else:
+                stack = ''.join(traceback.format_stack(frame))
+            description = ''
+            if self.describe is not None:
+                try:
+                    description = self.describe()
+                except Exception:
+                    description = ' (error describing main loop state)'
+            self.log.warning('Main loop stalled for %.1f seconds%s\n%s', stalled, description, stack.rstrip('\n'))
+            del frame
+
+    def start(self):
+        '''Start the watchdog thread, watching the thread calling start'''
+        self.threadid = threading.current_thread().ident
+        self.stopping.clear()
+        self.thread = threading.Thread(target = self.run, name = 'StallWatchdog')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        '''Stop the watchdog thread'''
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join(self.interval + 1)
+            self.thread = None